@@ -3,6 +3,8 @@ import unittest
 import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
+import time
+from UltrasoundSimModuleLib import *
 
 #
 # UltrasoundSimModule
@@ -60,8 +62,14 @@ class UltrasoundSimModuleWidget(ScriptedLoadableModuleWidget):
     self.layout.addWidget(uiWidget)
     self.ui = slicer.util.childWidgetVariables(uiWidget)
 
+    self.logic = UltrasoundSimModuleLogic()
+
     #to choose the input TRUS.
     #self.ui.inputTRUSSelector.setMRMLScene(slicer.mrmlScene)
+    # the patient list comes from the manifest, item 0 is "Not Selected"
+    self.patientIds = self.logic.manifest.patientIds()
+    for patient in self.patientIds:
+      self.ui.ComboBox.addItem(self.logic.manifest.patientName(patient))
     self.ui.ComboBox.currentIndexChanged.connect(self.makeScene)
 
     #connect buttons
@@ -70,9 +78,21 @@ class UltrasoundSimModuleWidget(ScriptedLoadableModuleWidget):
     self.ui.rightButton.connect('clicked(bool)', lambda: self.onRightLeftArrowButton("right"))
     self.ui.leftButton.connect('clicked(bool)', lambda: self.onRightLeftArrowButton("left"))
     self.ui.saveButton.connect('clicked(bool)', self.onSaveButton)
+    self.ui.compactButton.connect('clicked(bool)', self.onCompactButton)
+    self.ui.saveDirectoryButton.directory = self.logic.saveDirectory
+    self.ui.saveDirectoryButton.connect('directoryChanged(QString)', self.logic.setSaveDirectory)
     self.ui.Zones.connect('toggled(bool)', self.showZones)
     #self.ui.PZone.connect('clicked(bool)', self.onPZClick)
     self.ui.zoneSelect.currentIndexChanged.connect(self.identifyZone)
+    self.ui.trackedProbeCheckBox.connect('toggled(bool)', self.onTrackedProbeToggled)
+    self.ui.fireNeedleButton.connect('clicked(bool)', self.onFireNeedleButton)
+    self.ui.recordSessionCheckBox.connect('toggled(bool)', self.onRecordSessionToggled)
+    self.ui.replaySessionButton.connect('clicked(bool)', self.onReplaySessionButton)
+    self.ui.syntheticImageCheckBox.connect('toggled(bool)', self.logic.setSyntheticEnabled)
+
+    self.trackerStatusTimer = qt.QTimer()
+    self.trackerStatusTimer.setInterval(1000)
+    self.trackerStatusTimer.connect('timeout()', self.updateTrackerStatus)
 
     self.shortcutUp = qt.QShortcut(slicer.util.mainWindow())
     self.shortcutUp.setKey(qt.QKeySequence("Up"))
@@ -114,77 +134,29 @@ class UltrasoundSimModuleWidget(ScriptedLoadableModuleWidget):
     # Switch to the new custom layout
     layoutManager.setLayout(customLayoutId)
 
+  def selectedPatient(self):
+    """Patient id of the ComboBox selection, 0 if none is selected"""
+    index = self.ui.ComboBox.currentIndex
+    return self.patientIds[index - 1] if 0 < index <= len(self.patientIds) else 0
+
   #function to create the scene
   def makeScene(self):
-
-    # set up slicer scene
-    slicer.mrmlScene.Clear()
-    patient = self.ui.ComboBox.currentIndex
+    patient = self.selectedPatient()
 
     #only set up the scene if a patient is selected
-    if patient != 0:
-      scene = self.resourcePath('scene'+ str(patient) + '.mrb')
-      slicer.util.loadScene(scene)
+    if patient == 0:
+      self.logic.deactivatePatientScene()
+      return
 
-      TRUSVolume = slicer.mrmlScene.GetFirstNodeByName("TRUS")
-      probeModel = slicer.mrmlScene.GetFirstNodeByName("probe_v01")
-      zoneNode = slicer.mrmlScene.GetFirstNodeByName("Segmentation")
+    # swaps in the cached node set if the patient was loaded before
+    with self.logic.timing.stage('makeScene'):
+      self.logic.setupPatientScene(patient)
       self.splitSliceViewer()  # get the yellow slice
+      self.showZones()
 
-      #load TRUS and probe
-      if TRUSVolume is None:
-        US_path = self.resourcePath('registered_zones/Patient_' + str(patient) + '/TRUS.nrrd')
-        slicer.util.loadVolume(US_path)
-      if probeModel is None:
-        probe_path = self.resourcePath('probe_v01.stl')
-        probeModel = slicer.util.loadModel(probe_path)
-      #load zone segmentation
-      if zoneNode is None:
-        zone_path = self.resourcePath('registered_zones/Patient_' + str(patient) + '/Zones.seg.nrrd')
-        zoneNode = slicer.util.loadLabelVolume(zone_path)
-
-        labelmapVolumeNode = zoneNode
-        seg = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode')
-        slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmapVolumeNode, seg)
-        seg.CreateClosedSurfaceRepresentation()
-        slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
-        segDisplay = seg.GetDisplayNode()
-        segDisplay.SetVisibility(False)
-
-      # create and name all transforms
-      ReferenceToRAS =  slicer.mrmlScene.GetFirstNodeByName("ReferenceToRAS")
-      ProbeToReference =  slicer.mrmlScene.GetFirstNodeByName(self.PROBE_TO_REFERENCE)
-      SliceToImage =  slicer.mrmlScene.GetFirstNodeByName("SliceToImage")
-      ProbeModelToProbe =  slicer.mrmlScene.GetFirstNodeByName(self.PROBEMODEL_TO_PROBE)
-      RotatedToProbeModel = slicer.mrmlScene.GetFirstNodeByName(self.ROTATED_TO_PROBEMODEL)
-      ImageToProbe = slicer.mrmlScene.GetFirstNodeByName(self.IMAGE_TO_PROBE)
-
-      if RotatedToProbeModel is None:
-        RotatedToProbeModel = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", self.ROTATED_TO_PROBEMODEL)
-      if ProbeModelToProbe is None:
-        ProbeModelToProbe = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", self.PROBEMODEL_TO_PROBE)
-      if SliceToImage is None:
-        SliceToImage = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", "SliceToImage")
-      if ReferenceToRAS is None:
-        ReferenceToRAS = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", "ReferenceToRAS")
-      if ProbeToReference is None:
-        ProbeToReference = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", self.PROBE_TO_REFERENCE)
-      if ImageToProbe is None:
-        ImageToProbe = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", self.IMAGE_TO_PROBE)
-
-      # Create hierarchy
-      probeModel.SetAndObserveTransformNodeID(RotatedToProbeModel.GetID())
-      ProbeModelToProbe.SetAndObserveTransformNodeID(ProbeToReference.GetID())
-      SliceToImage.SetAndObserveTransformNodeID(ImageToProbe.GetID())
-      ProbeToReference.SetAndObserveTransformNodeID(ReferenceToRAS.GetID())
-      RotatedToProbeModel.SetAndObserveTransformNodeID(ProbeModelToProbe.GetID())
-      ImageToProbe.SetAndObserveTransformNodeID(ProbeToReference.GetID())
-
-      # Clean up extra camera nodes
-      for i in range(3):
-        camera = slicer.mrmlScene.GetFirstNodeByClass('vtkMRMLCameraNode')
-        slicer.mrmlScene.RemoveNode(camera)
-
+    # decode the neighbouring patients while the trainee is scanning
+    index = self.patientIds.index(patient)
+    self.logic.prefetchPatientScenes(self.patientIds[max(index - 1, 0):index] + self.patientIds[index + 1:index + 2])
 
   def enter(self):
     """Runs whenever the module is reopened"""
@@ -203,18 +175,26 @@ class UltrasoundSimModuleWidget(ScriptedLoadableModuleWidget):
   #show and hide zones based on check box
   def showZones(self):
     checked = self.ui.Zones.isChecked()
-    zoneNode = slicer.mrmlScene.GetFirstNodeByName("Segmentation")
+    referenceModel = self.logic.getNode("PZ_Intersection")
+    if referenceModel is not None and referenceModel.GetDisplayNode():
+      referenceModel.GetDisplayNode().SetVisibility(checked)
+    zoneNode = self.logic.getNode("Segmentation")
+    if zoneNode is None:
+      return
     segDisplay = zoneNode.GetDisplayNode()
 
     if checked:
       segDisplay.SetVisibility(True)
     else:
       segDisplay.SetVisibility(False)
+    # the decimated zone models follow the segmentation while the probe moves
+    self.logic.applyMeshLevel(self.logic.meshLevel, force=True)
 
   #NEXT. GET FIDUCIALS WORKING
   def identifyZone(self):
     zones = ["Peripheral", "Central", "Anterior", "Transitional"]
     index = self.ui.zoneSelect.currentIndex
+    self.logic.recordSessionEvent(SESSION_ZONE_SELECTED, index)
     interactionNode = slicer.app.applicationLogic().GetInteractionNode()
     selectionNode = slicer.app.applicationLogic().GetSelectionNode()
     selectionNode.SetReferenceActivePlaceNodeClassName("vtkMRMLMarkupsFiducialNode")
@@ -222,147 +202,106 @@ class UltrasoundSimModuleWidget(ScriptedLoadableModuleWidget):
     slicer.mrmlScene.AddNode(fiducialNode)
     fiducialNode.CreateDefaultDisplayNodes()
     fiducialNode.SetName(zones[index-1])
+    fiducialNode.SetAttribute(self.logic.PATIENT_ATTRIBUTE, str(self.logic.activePatient))
+    # score every placed point against the chosen zone
+    fiducialNode.AddObserver(slicer.vtkMRMLMarkupsNode.PointPositionDefinedEvent, self.onFiducialPlaced)
     selectionNode.SetActivePlaceNodeID(fiducialNode.GetID())
     interactionNode.SetCurrentInteractionMode(interactionNode.Place)
 
+  def onFiducialPlaced(self, fiducialNode, event):
+    position = [0.0, 0.0, 0.0]
+    fiducialNode.GetNthControlPointPositionWorld(fiducialNode.GetNumberOfControlPoints() - 1, position)
+    result = self.logic.scorePlacement(position, fiducialNode.GetName())
+    if result is None:
+      return
+    inZone, distance = result
+    if inZone:
+      slicer.util.showStatusMessage("{0}: placed in the correct zone".format(fiducialNode.GetName()), 3000)
+    else:
+      slicer.util.showStatusMessage("{0}: missed the zone by {1:.1f} mm".format(fiducialNode.GetName(), distance), 3000)
+
 #FOR SCORING LATER. Draw ROI around each segment.
   def bindSegments(self):
-    segmentationNode = slicer.mrmlScene.GetFirstNodeByName('Segmentation')
-
-    # Compute bounding boxes
-    import SegmentStatistics
-    segStatLogic = SegmentStatistics.SegmentStatisticsLogic()
-    segStatLogic.getParameterNode().SetParameter("Segmentation", segmentationNode.GetID())
-    segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin.obb_origin_ras.enabled", str(True))
-    segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin.obb_diameter_mm.enabled", str(True))
-    segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin.obb_direction_ras_x.enabled",
-                                                 str(True))
-    segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin.obb_direction_ras_y.enabled",
-                                                 str(True))
-    segStatLogic.getParameterNode().SetParameter("LabelmapSegmentStatisticsPlugin.obb_direction_ras_z.enabled",
-                                                 str(True))
-    segStatLogic.computeStatistics()
-    stats = segStatLogic.getStatistics()
-
-    # Draw ROI for each oriented bounding box.
-    import numpy as np
-    for segmentId in stats['SegmentIDs']:
-      # Get bounding box
-      obb_origin_ras = np.array(stats[segmentId, "LabelmapSegmentStatisticsPlugin.obb_origin_ras"])
-      obb_diameter_mm = np.array(stats[segmentId, "LabelmapSegmentStatisticsPlugin.obb_diameter_mm"])
-      obb_direction_ras_x = np.array(stats[segmentId, "LabelmapSegmentStatisticsPlugin.obb_direction_ras_x"])
-      obb_direction_ras_y = np.array(stats[segmentId, "LabelmapSegmentStatisticsPlugin.obb_direction_ras_y"])
-      obb_direction_ras_z = np.array(stats[segmentId, "LabelmapSegmentStatisticsPlugin.obb_direction_ras_z"])
-      # Create ROI
-      segment = segmentationNode.GetSegmentation().GetSegment(segmentId)
-      roi = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLAnnotationROINode")
-      roi.SetName(segment.GetName() + ' bounding box')
-      roi.SetXYZ(0.0, 0.0, 0.0)
-      roi.SetRadiusXYZ(*(0.5 * obb_diameter_mm))
-      # Position and orient ROI using a transform
-      obb_center_ras = obb_origin_ras + 0.5 * (
-                obb_diameter_mm[0] * obb_direction_ras_x + obb_diameter_mm[1] * obb_direction_ras_y + obb_diameter_mm[
-          2] * obb_direction_ras_z)
-      boundingBoxToRasTransform = np.row_stack((np.column_stack(
-        (obb_direction_ras_x, obb_direction_ras_y, obb_direction_ras_z, obb_center_ras)), (0, 0, 0, 1)))
-      boundingBoxToRasTransformMatrix = slicer.util.vtkMatrixFromArray(boundingBoxToRasTransform)
-      transformNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLTransformNode')
-      transformNode.SetAndObserveMatrixTransformToParent(boundingBoxToRasTransformMatrix)
-      roi.SetAndObserveTransformNodeID(transformNode.GetID())
-      box = roi.GetDisplayNode()
-      box.SetVisibility(False)
+    self.logic.bindSegments()
 
 
   #arrow buttons now connected to probe model. up/down rotation.
   def onUpDownArrowButton(self, arrow):
-    RotatedToProbeModel = slicer.mrmlScene.GetFirstNodeByName(self.ROTATED_TO_PROBEMODEL)
-    ImageToProbe = slicer.mrmlScene.GetFirstNodeByName(self.IMAGE_TO_PROBE)
-
-    ProbeModelToCOR = vtk.vtkTransform()
-    Rotation = vtk.vtkTransform()
-    CORToRotatedtModel = vtk.vtkTransform()
-    RotatedToProbeModelTransform = vtk.vtkTransform()
-    ImageToProbeModelTransform = vtk.vtkTransform()
-    ImageToCOR = vtk.vtkTransform()
-    CORToImage = vtk.vtkTransform()
-    ImageRotation = vtk.vtkTransform()
-
-    RotatedMatrix = RotatedToProbeModel.GetMatrixTransformFromParent()
-
-    if arrow == "up":
-        NumberOfRotations = RotatedMatrix.GetElement(2, 1) / 0.034
-        rotationAngle = -2
-
-    if arrow == "down":
-        NumberOfRotations = (RotatedMatrix.GetElement(1, 2) / 0.034)
-        rotationAngle = 2
-
-    # Do not allow the user to move the probe more than 3 times in one direction. To be amended during scanning protocols
-    if NumberOfRotations <= 1:
-        # rotate probe model
-        ProbeModelToCOR.Translate(8, 4, -150)
-        Rotation.RotateX(rotationAngle * (NumberOfRotations + 1))
-        CORToRotatedtModel.Translate(-8, -4, 150)
-        RotatedToProbeModelTransform.Concatenate(CORToRotatedtModel)
-        RotatedToProbeModelTransform.Concatenate(Rotation)
-        RotatedToProbeModelTransform.Concatenate(ProbeModelToCOR)
-        # rotate TRUS
-        ImageToCOR.Translate(0, 20, 90)
-        ImageRotation.RotateX(rotationAngle * (NumberOfRotations + 1))
-        CORToImage.Translate(0, -20, -90)
-        ImageToProbeModelTransform.Concatenate(CORToImage)
-        ImageToProbeModelTransform.Concatenate(ImageRotation)
-        ImageToProbeModelTransform.Concatenate(ImageToCOR)
-
-        RotatedToProbeModel.SetMatrixTransformToParent(RotatedToProbeModelTransform.GetMatrix())
-        ImageToProbe.SetMatrixTransformToParent(ImageToProbeModelTransform.GetMatrix())
+    self.logic.stepProbe(pitch=-1 if arrow == "up" else 1)
 
   #right left rotation
   def onRightLeftArrowButton(self, arrow):
-    RotatedToProbeModel = slicer.mrmlScene.GetFirstNodeByName(self.ROTATED_TO_PROBEMODEL)
-    ImageToProbe = slicer.mrmlScene.GetFirstNodeByName(self.IMAGE_TO_PROBE)
-
-    ProbeModelToCOR = vtk.vtkTransform()
-    Rotation = vtk.vtkTransform()
-    CORToRotatedtModel = vtk.vtkTransform()
-    RotatedToProbeModelTransform = vtk.vtkTransform()
-    RotatedMatrix = RotatedToProbeModel.GetMatrixTransformFromParent()
-    # transforms to rotate the image
-    ImageToProbeModelTransform = vtk.vtkTransform()
-    ImageToCOR = vtk.vtkTransform()
-    CORToImage = vtk.vtkTransform()
-    ImageRotation = vtk.vtkTransform()
-
-    # Check current rotatedtoprobe matrix against its original positioning to determine how much the user has already
-    # rotated it
-    if arrow == "right":
-        NumberOfRotations = (RotatedMatrix.GetElement(2, 0) / 0.02)
-        rotationAngle = 1
-    if arrow == "left":
-        NumberOfRotations = (RotatedMatrix.GetElement(0, 2) / 0.02)
-        rotationAngle = -1
-
-     # Do not allow the user to move the probe more than 3 times in one direction. To be amended during scanning protocols
-    if NumberOfRotations <= 6:
-      ProbeModelToCOR.Translate(8, 4, -150)
-      Rotation.RotateY(rotationAngle * (NumberOfRotations + 1))
-      CORToRotatedtModel.Translate(-8, -4, 150)
-      RotatedToProbeModelTransform.Concatenate(CORToRotatedtModel)
-      RotatedToProbeModelTransform.Concatenate(Rotation)
-      RotatedToProbeModelTransform.Concatenate(ProbeModelToCOR)
-
-      RotatedToProbeModelTransform.Update()
-
-      # rotate TRUS
-      ImageToCOR.Translate(0, 20, 90)
-      ImageRotation.RotateY((rotationAngle*1.5) * (NumberOfRotations + 1))
-      CORToImage.Translate(0, -20, -90)
-      ImageToProbeModelTransform.Concatenate(CORToImage)
-      ImageToProbeModelTransform.Concatenate(ImageRotation)
-      ImageToProbeModelTransform.Concatenate(ImageToCOR)
-
-      RotatedToProbeModel.SetMatrixTransformToParent(RotatedToProbeModelTransform.GetMatrix())
-      ImageToProbe.SetMatrixTransformToParent(ImageToProbeModelTransform.GetMatrix())
+    self.logic.stepProbe(yaw=1 if arrow == "right" else -1)
+
+
+  #drive ProbeToReference from the optical marker tracker instead of leaving it fixed
+  def onTrackedProbeToggled(self, enabled):
+    if not enabled:
+      self.logic.stopTrackedProbe()
+      self.trackerStatusTimer.stop()
+      self.ui.trackerStatusLabel.text = ""
+      return
+    try:
+      self.logic.startTrackedProbe()
+    except OSError as e:
+      slicer.util.errorDisplay("Could not connect to the tracker: " + str(e))
+      self.ui.trackedProbeCheckBox.checked = False
+      return
+    self.trackerStatusTimer.start()
+
+  def updateTrackerStatus(self):
+    summary = self.logic.getTrackerStatistics()
+    if summary is None:
+      return
+    latency = summary['meanLatencyMs']
+    self.ui.trackerStatusLabel.text = "Latency: {0} ms, applied: {1}, dropped: {2}".format(
+      "-" if latency is None else "{0:.1f}".format(latency), summary['appliedFrames'],
+      summary['droppedFrames'] + summary['staleFrames'])
+
+  def onFireNeedleButton(self):
+    summary = self.logic.fireNeedle()
+    if summary is None:
+      self.ui.needleResultLabel.text = "No zone segmentation for this patient"
+      return
+    if not summary['zones']:
+      self.ui.needleResultLabel.text = "Missed the prostate"
+      return
+    zones = [name for name in dict.fromkeys(summary['zonesTraversed']) if name in summary['zones']]
+    self.ui.needleResultLabel.text = ", ".join(
+      "{0}: {1:.1f} mm".format(name, summary['zones'][name]['coreLength']) for name in zones)
+    self.showProtocolScore()
+
+  def onRecordSessionToggled(self, enabled):
+    if not enabled:
+      self.logic.stopSessionRecording()
+      return
+    try:
+      path = self.logic.startSessionRecording()
+    except (IOError, OSError) as e:
+      slicer.util.errorDisplay("Could not start recording: " + str(e))
+      self.ui.recordSessionCheckBox.checked = False
+      return
+    slicer.util.showStatusMessage("Recording session to " + path, 3000)
+
+  def onReplaySessionButton(self):
+    path = qt.QFileDialog.getOpenFileName(slicer.util.mainWindow(), "Replay session", self.logic.sessionDirectory(),
+                                          "Session recordings (*" + SESSION_EXTENSION + ")")
+    if not path:
+      return
+    self.ui.recordSessionCheckBox.checked = False
+    try:
+      self.logic.replaySession(path, finishedCallback=lambda statistics: slicer.util.showStatusMessage(
+        "Replayed {0} events".format(statistics['events']), 3000))
+    except (IOError, OSError, ValueError) as e:
+      slicer.util.errorDisplay("Could not replay the session: " + str(e))
+
+  def showProtocolScore(self):
+    score = self.logic.scoreProtocol()
+    if score is None or not score['regions']:
+      return
+    covered = len(score['regions']) - len(score['gaps'])
+    slicer.util.showStatusMessage("{0} protocol: {1} of {2} regions covered".format(
+      score['protocol'], covered, len(score['regions'])), 5000)
 
 
 #unsure about this...
@@ -378,32 +317,32 @@ class UltrasoundSimModuleWidget(ScriptedLoadableModuleWidget):
     self.disconnectKeyboardShortcuts()
     logging.info("done")
 
-  #save the scene to resources to be reloaded later
+  #save the changes since the last save, the live scene is left as it is
   def onSaveButton(self):
-
-    #clean up nodes that do not need to be saved
-    delete = [slicer.mrmlScene.GetFirstNodeByName(self.PROBE_TO_REFERENCE), slicer.mrmlScene.GetFirstNodeByName(self.ROTATED_TO_PROBEMODEL),
-              slicer.mrmlScene.GetFirstNodeByName(self.IMAGE_TO_PROBE),slicer.mrmlScene.GetFirstNodeByName('probe_v01'),
-              slicer.mrmlScene.GetFirstNodeByName("Segmentation")]
-
-    for i in delete:
-      slicer.mrmlScene.RemoveNode(i)
-
-    patient = self.ui.ComboBox.currentIndex
-    # Generate file name
-    sceneSaveFilename = "C:/Users/cat_w/OneDrive - Queen's University/Perk Lab/USRA project 2020/ProstateBiopsySim" \
-                        "/UltrasoundSimModule/Resources/scene" + str(patient) + ".mrb"
-
-    # Save scene
-    if slicer.util.saveScene(sceneSaveFilename):
-      logging.info("Scene saved to: {0}".format(sceneSaveFilename))
+    if not self.logic.activePatient:
+      return
+    if self.logic.saveSnapshot() is None:
+      slicer.util.showStatusMessage("No changes since the last save", 3000)
     else:
-      logging.error("Scene saving failed")
-
-
+      slicer.util.showStatusMessage("Saving changes to " + self.logic.saveDirectory, 3000)
+
+  #merge the saved changes into a full scene file, only when asked for
+  def onCompactButton(self):
+    if not self.logic.activePatient:
+      return
+    try:
+      path = self.logic.compactSavedScene()
+    except (IOError, OSError) as e:
+      slicer.util.errorDisplay("Could not write the scene: " + str(e))
+      return
+    if path is None:
+      slicer.util.errorDisplay("Scene saving failed")
+    else:
+      slicer.util.showStatusMessage("Scene saved to " + path, 3000)
 
   def cleanup(self):
-    pass
+    self.trackerStatusTimer.stop()
+    self.logic.cleanup()
 
   def onSelect(self):
     self.applyButton.enabled = self.inputSelector.currentNode() and self.outputSelector.currentNode()
@@ -424,6 +363,1504 @@ class UltrasoundSimModuleLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  IMAGE_TO_PROBE = UltrasoundSimModuleWidget.IMAGE_TO_PROBE
+  PROBE_TO_REFERENCE = UltrasoundSimModuleWidget.PROBE_TO_REFERENCE
+  PROBEMODEL_TO_PROBE = UltrasoundSimModuleWidget.PROBEMODEL_TO_PROBE
+  ROTATED_TO_PROBEMODEL = UltrasoundSimModuleWidget.ROTATED_TO_PROBEMODEL
+  PATIENT_ATTRIBUTE = "UltrasoundSim.Patient"
+
+  # transforms that come with every patient scene
+  PATIENT_TRANSFORMS = ["ReferenceToRAS", "SliceToImage", PROBEMODEL_TO_PROBE]
+  # nodes that are shared by all patients and re-parented when the patient changes
+  SHARED_TRANSFORMS = [PROBE_TO_REFERENCE, ROTATED_TO_PROBEMODEL, IMAGE_TO_PROBE]
+
+  def __init__(self, parent=None):
+    ScriptedLoadableModuleLogic.__init__(self, parent)
+    self.cacheDirectory = os.path.join(slicer.app.cachePath, 'UltrasoundSim')
+    self.surfaceCache = ZoneSurfaceCache(os.path.join(self.cacheDirectory, 'surfaces'))
+    self.boundingBoxCache = SegmentBoundingBoxCache(os.path.join(self.cacheDirectory, 'boundingboxes'))
+    self.distanceMapCache = DistanceMapCache(os.path.join(self.cacheDirectory, 'distancemaps'))
+    # patients and their files; refreshing only lists and stats files, no patient data is read
+    self.manifest = PatientManifest(os.path.dirname(self.resourcePath('')),
+                                    os.path.join(self.cacheDirectory, 'manifest.json'),
+                                    {'boundingBoxes': self.boundingBoxCache.cacheDirectory,
+                                     'distanceMaps': self.distanceMapCache.cacheDirectory})
+    self.manifest.refresh()
+    self.sceneCache = PatientSceneCache(self.resourcePath,
+                                        os.path.join(slicer.app.temporaryPath, 'UltrasoundSim', 'scenes'),
+                                        manifest=self.manifest)
+    self.activePatient = 0
+    self.sharedNodeIDs = {}
+    self.probePose = ProbePoseEngine()
+    self.placementScores = []
+    # needle guide in the slice plane, follows the ImageToProbe frame
+    self.needleGuide = {'entry': (0.0, 0.0), 'angle': 0.0, 'depth': 10.0, 'throw': DEFAULT_THROW}
+    self.needleShots = []
+    # reused for every pose update so that arrow key handling does not create VTK objects
+    self.rotatedToProbeModelMatrix = vtk.vtkMatrix4x4()
+    self.imageToProbeMatrix = vtk.vtkMatrix4x4()
+    # latency histograms of the hot paths, off unless enabled
+    self.timing = TimingProbes()
+    self.transformScheduler = TransformUpdateScheduler(maximumFrameRate=60, timingProbes=self.timing)
+    self.renderObservations = []
+    self.renderStartTime = None
+    self.transformScheduler.flushCallbacks.append(self.onTransformsFlushed)
+    self.trackerClient = None
+    self.trackerTimer = None
+    self.trackerSampleInFlight = None
+
+    # resolution pyramid: show the coarse level while the probe moves, refine once it has been still
+    self.pyramidEnabled = True
+    self.pyramidMotionFactor = 2
+    self.pyramidStatus = {'activeFactor': 1, 'refinementDelay': 0.3, 'coarseSwitches': 0, 'refinements': 0,
+                          'lastMotionTime': None, 'lastRefinementTime': None}
+    self.refinementTimer = qt.QTimer()
+    self.refinementTimer.setSingleShot(True)
+    self.refinementTimer.connect('timeout()', self.onRefinementTimer)
+
+    # decimated meshes in the 3D view while the probe moves, switched by the measured 3D frame time
+    self.lodEnabled = True
+    self.meshLevelCache = MeshLevelCache(os.path.join(self.cacheDirectory, 'meshlevels'))
+    self.levelOfDetail = LevelOfDetailController(len(LOD_REDUCTIONS))
+    self.sharedMeshLevels = {}
+    self.meshLevel = 0
+    self.lodStillTimer = qt.QTimer()
+    self.lodStillTimer.setSingleShot(True)
+    self.lodStillTimer.connect('timeout()', self.onLodStillTimer)
+    self.lodRenderObservations = []
+    self.lodRenderStartTime = None
+
+    # probe steps are checked against the patient's anatomy instead of fixed step limits
+    self.poseConstraintsEnabled = True
+    self.probeClearance = 2.0
+    self.probeConstraint = None
+
+    # synthetic TRUS image stage, off by default
+    self.syntheticEnabled = False
+    self.syntheticRenderer = None
+    self.syntheticOptions = {'outputSize': (256, 256), 'blend': 0.5, 'speckleContrast': 0.8}
+    self.speckleCache = SpeckleTileCache(os.path.join(self.cacheDirectory, 'speckle'))
+
+    # session recording and replay
+    self.sessionRecorder = None
+    self.sessionFlushTimer = qt.QTimer()
+    self.sessionFlushTimer.setInterval(1000)
+    self.sessionFlushTimer.connect('timeout()', self.flushSessionRecording)
+    self.sessionReplay = None
+    self.replayTimer = qt.QTimer()
+    self.replayTimer.setSingleShot(True)
+    self.replayTimer.connect('timeout()', self.onReplayTimer)
+
+    # incremental saves of transforms, fiducials and session state
+    self.saveDirectory = qt.QSettings().value('UltrasoundSim/SaveDirectory') or \
+                         os.path.join(slicer.app.defaultScenePath, 'UltrasoundSimSaves')
+    self.sceneDeltas = SceneDeltaStore(self.saveDirectory)
+
+  def resourcePath(self, filename):
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Resources', filename)
+
+  def getNode(self, name):
+    """Find a node of the active patient by name, falling back to the first node in the scene with that name"""
+    entry = self.sceneCache.getEntry(self.activePatient) if self.activePatient else None
+    nodeID = None
+    if entry is not None:
+      nodeID = entry.nodeIDs.get(name)
+    if nodeID is None:
+      nodeID = self.sharedNodeIDs.get(name)
+    node = slicer.mrmlScene.GetNodeByID(nodeID) if nodeID else None
+    if node is None:
+      node = slicer.mrmlScene.GetFirstNodeByName(name)
+    return node
+
+  def isEntryValid(self, entry):
+    # helper nodes such as bounding boxes are recreated on demand, only the loaded data matters here
+    required = self.PATIENT_TRANSFORMS + ["TRUS", "Segmentation"]
+    return all(slicer.mrmlScene.GetNodeByID(nodeID) is not None
+               for name, nodeID in entry.nodeIDs.items() if name in required)
+
+  def loadPatientEntry(self, patient, keepPatients=()):
+    """Scene cache entry of a patient, loading its nodes only if they are not already resident in the scene.
+    Patients other than this one and keepPatients may be evicted. Returns (entry, loaded); the active patient
+    is not changed.
+    """
+    entry = self.sceneCache.getEntry(patient)
+    if entry is not None and not self.isEntryValid(entry):
+      # scene was cleared or nodes were deleted behind our back
+      self.removePatientNodes(self.sceneCache.removeEntry(patient))
+      entry = None
+    loaded = entry is None
+    if loaded:
+      with self.timing.stage('takeAssets'):
+        assets = self.sceneCache.takeAssets(patient)
+      with self.timing.stage('createPatientNodes'):
+        entry = self.createPatientNodes(assets)
+      self.sceneCache.addEntry(entry)
+      for evicted in self.sceneCache.evict(keepPatients=[patient] + list(keepPatients)):
+        logging.info('Evicting patient {0} from the scene cache'.format(evicted.patient))
+        self.removePatientNodes(evicted)
+    return entry, loaded
+
+  def setupPatientScene(self, patient):
+    """Make the patient's node set active, loading it only if it is not already resident in the scene"""
+    entry, loaded = self.loadPatientEntry(patient)
+    with self.timing.stage('activatePatientNodes'):
+      self.activatePatientNodes(entry)
+    # full meshes for the new patient, frame times are measured again since the meshes changed
+    self.levelOfDetail.reset()
+    self.applyMeshLevel(0, force=True)
+    if self.lodEnabled and not self.lodRenderObservations:
+      self.observeThreeDFrameTimes(True)
+    if self.syntheticEnabled:
+      self.setupSyntheticImage()
+    self.updateProbeConstraint()
+    if loaded and self.sceneDeltas.hasSavedState(patient):
+      self.restoreSnapshot(patient)
+    self.recordSessionEvent(SESSION_PATIENT, patient)
+    return entry
+
+  def prefetchPatientScenes(self, patients):
+    self.sceneCache.prefetch(patients)
+
+  def createPatientNodes(self, assets):
+    entry = PatientSceneEntry(assets.patient)
+    if assets.bundle is not None:
+      return self.createPatientNodesFromBundle(assets, entry)
+    existingIDs = set(self.sceneNodeIDs())
+
+    # import (not load) the scene so that other cached patients stay in the scene
+    with self.timing.stage('loadScene'):
+      slicer.util.loadScene(assets.mrmlPath)
+    for nodeID in self.sceneNodeIDs():
+      if nodeID in existingIDs:
+        continue
+      node = slicer.mrmlScene.GetNodeByID(nodeID)
+      if node.IsA('vtkMRMLCameraNode'):
+        # Clean up extra camera nodes
+        slicer.mrmlScene.RemoveNode(node)
+        continue
+      if node.GetName() in self.PATIENT_TRANSFORMS or node.GetName() == "TRUS":
+        entry.nodeIDs[node.GetName()] = node.GetID()
+
+    for name in self.PATIENT_TRANSFORMS:
+      if name not in entry.nodeIDs:
+        entry.nodeIDs[name] = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", name).GetID()
+
+    #load TRUS
+    if "TRUS" not in entry.nodeIDs and assets.trus is not None:
+      TRUSVolume = slicer.util.addVolumeFromArray(assets.trus.voxels, ijkToRAS=assets.trus.ijkToRas, name="TRUS")
+      TRUSVolume.CreateDefaultDisplayNodes()
+      entry.nodeIDs["TRUS"] = TRUSVolume.GetID()
+
+    #load zone segmentation
+    if assets.zones is not None:
+      labelmapVolumeNode = slicer.util.addVolumeFromArray(assets.zones.labelVoxels(), ijkToRAS=assets.zones.ijkToRas,
+                                                          name="Zones", nodeClassName="vtkMRMLLabelMapVolumeNode")
+      seg = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode')
+      with self.timing.stage('importLabelmap'):
+        slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmapVolumeNode, seg)
+      with self.timing.stage('createZoneSurfaces'):
+        self.createZoneSurfaces(seg, assets.zonesPath, assets.zones.contentHash)
+      slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
+      seg.GetDisplayNode().SetVisibility(False)
+      entry.nodeIDs["Segmentation"] = seg.GetID()
+
+    return self.finishPatientEntry(entry, assets)
+
+  def finishPatientEntry(self, entry, assets):
+    if "TRUS" in entry.nodeIDs:
+      self.createPyramidNodes(entry)
+    if assets.zones is not None:
+      entry.zoneIndex = ZoneIndex.fromNrrdVolume(assets.zones)
+      entry.zonesPath = assets.zonesPath
+      entry.zonesHash = assets.zones.contentHash
+      segmentationNode = slicer.mrmlScene.GetNodeByID(entry.nodeIDs.get("Segmentation", ""))
+      if segmentationNode is not None:
+        with self.timing.stage('createMeshLevels'):
+          entry.meshLevels = self.createZoneMeshLevels(segmentationNode, entry.zonesHash)
+    for nodeID in entry.nodeIDs.values():
+      node = slicer.mrmlScene.GetNodeByID(nodeID)
+      node.SetAttribute(self.PATIENT_ATTRIBUTE, str(assets.patient))
+      entry.memorySize += self.nodeMemorySize(node)
+    return entry
+
+  def createPyramidNodes(self, entry):
+    """Add downsampled copies of the TRUS volume that are shown while the probe is moving"""
+    TRUSVolume = slicer.mrmlScene.GetNodeByID(entry.nodeIDs["TRUS"])
+    ijkToRas = vtk.vtkMatrix4x4()
+    TRUSVolume.GetIJKToRASMatrix(ijkToRas)
+    displayNode = TRUSVolume.GetDisplayNode()
+    levels = buildPyramid(slicer.util.arrayFromVolume(TRUSVolume), slicer.util.arrayFromVTKMatrix(ijkToRas))
+    for factor, voxels, levelIjkToRas in levels:
+      name = "TRUS_{0}x".format(factor)
+      levelVolume = slicer.util.addVolumeFromArray(voxels, ijkToRAS=levelIjkToRas, name=name)
+      levelVolume.SetHideFromEditors(True)
+      # same place as TRUS when it sits under a transform
+      levelVolume.SetAndObserveTransformNodeID(TRUSVolume.GetTransformNodeID())
+      levelVolume.CreateDefaultDisplayNodes()
+      if displayNode is not None:
+        levelDisplayNode = levelVolume.GetDisplayNode()
+        levelDisplayNode.SetAutoWindowLevel(False)
+        levelDisplayNode.SetWindowLevel(displayNode.GetWindow(), displayNode.GetLevel())
+        levelDisplayNode.SetAndObserveColorNodeID(displayNode.GetColorNodeID())
+      entry.nodeIDs[name] = levelVolume.GetID()
+
+  def createPatientNodesFromBundle(self, assets, entry):
+    """Build the patient's nodes from a memory-mapped asset bundle. Volumes and mesh points use the mapped
+    buffers directly.
+    """
+    for name, matrix in assets.bundle.transforms().items():
+      transformNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", name)
+      transformNode.SetMatrixTransformToParent(slicer.util.vtkMatrixFromArray(matrix))
+      entry.nodeIDs[name] = transformNode.GetID()
+
+    if assets.trus is not None:
+      TRUSVolume = self.addMappedVolume(assets.trus, "TRUS")
+      parentName = assets.bundle.metadata['volumes']['TRUS'].get('parentTransform')
+      if parentName in entry.nodeIDs:
+        TRUSVolume.SetAndObserveTransformNodeID(entry.nodeIDs[parentName])
+      entry.nodeIDs["TRUS"] = TRUSVolume.GetID()
+
+    if assets.zones is not None:
+      labelmapVolumeNode = self.addMappedVolume(assets.zones, "Zones", "vtkMRMLLabelMapVolumeNode")
+      seg = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLSegmentationNode')
+      slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmapVolumeNode, seg)
+      slicer.mrmlScene.RemoveNode(labelmapVolumeNode)
+      surfaces = [self.polyDataFromArrays(points, offsets, connectivity)
+                  for name, points, offsets, connectivity in assets.bundle.meshes()]
+      if not self.setClosedSurfaces(seg, surfaces):
+        seg.CreateClosedSurfaceRepresentation()
+      seg.GetDisplayNode().SetVisibility(False)
+      entry.nodeIDs["Segmentation"] = seg.GetID()
+
+    return self.finishPatientEntry(entry, assets)
+
+  def addMappedVolume(self, volume, name, className="vtkMRMLScalarVolumeNode"):
+    """Volume node whose image data points straight at the (memory-mapped) voxel array, without copying"""
+    from vtk.util import numpy_support
+    voxels = volume.voxels
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(voxels.shape[2], voxels.shape[1], voxels.shape[0])
+    imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(voxels.reshape(-1), deep=False))
+    volumeNode = slicer.mrmlScene.AddNewNodeByClass(className, name)
+    volumeNode.SetIJKToRASMatrix(slicer.util.vtkMatrixFromArray(volume.ijkToRas))
+    volumeNode.SetAndObserveImageData(imageData)
+    volumeNode.CreateDefaultDisplayNodes()
+    return volumeNode
+
+  def polyDataFromArrays(self, points, offsets, connectivity):
+    from vtk.util import numpy_support
+    vtkPoints = vtk.vtkPoints()
+    vtkPoints.SetData(numpy_support.numpy_to_vtk(points, deep=False))
+    polys = vtk.vtkCellArray()
+    polys.SetData(numpy_support.numpy_to_vtkIdTypeArray(offsets, deep=False),
+                  numpy_support.numpy_to_vtkIdTypeArray(connectivity, deep=False))
+    polyData = vtk.vtkPolyData()
+    polyData.SetPoints(vtkPoints)
+    polyData.SetPolys(polys)
+    return polyData
+
+  def setClosedSurfaces(self, segmentationNode, surfaces):
+    """Use precomputed polydata (one per segment, in segment order) as the closed surface representation"""
+    segmentation = segmentationNode.GetSegmentation()
+    if surfaces is None or len(surfaces) != segmentation.GetNumberOfSegments():
+      return False
+    closedSurfaceName = slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName()
+    for index, polyData in enumerate(surfaces):
+      segmentation.GetNthSegment(index).AddRepresentation(closedSurfaceName, polyData)
+    # representation already exists, so this only sets up display
+    segmentationNode.CreateClosedSurfaceRepresentation()
+    return True
+
+  def exportAssetBundle(self, patient, path=None):
+    """Convert a patient's .mrb scene and registered_zones files into an uncompressed asset bundle. The patient's
+    nodes are loaded if needed but not activated, so the current patient and any session recording stay as they
+    are.
+    """
+    if path is None:
+      path = self.sceneCache.bundlePath(patient)
+    if not os.path.exists(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+
+    # importing a scene can replace the slice view backgrounds
+    backgrounds = [(compositeNode, compositeNode.GetBackgroundVolumeID())
+                   for compositeNode in slicer.util.getNodesByClass('vtkMRMLSliceCompositeNode')]
+    entry, loaded = self.loadPatientEntry(patient, keepPatients=[self.activePatient] if self.activePatient else [])
+    try:
+      self.writePatientBundle(entry, path)
+    finally:
+      for compositeNode, volumeID in backgrounds:
+        compositeNode.SetBackgroundVolumeID(volumeID)
+      if loaded and patient != self.activePatient:
+        self.removePatientNodes(self.sceneCache.removeEntry(patient))
+    logging.info('Asset bundle written to: {0}'.format(path))
+    self.manifest.refresh()
+    return path
+
+  def writePatientBundle(self, entry, path):
+    """Write the loaded nodes of a cached patient and its zone file to an asset bundle"""
+    import numpy as np
+    from vtk.util import numpy_support
+    if self.sceneCache.zonesVariant(entry.patient) != 0:
+      raise ValueError('Asset bundles hold the default zones, patient {0} uses zones variant {1}'.format(
+        entry.patient, self.sceneCache.zonesVariant(entry.patient)))
+    assets = self.sceneCache.decodePatient(entry.patient, useBundle=False)
+    arrays = {}
+    metadata = {'patient': entry.patient, 'zonesPath': assets.zonesPath, 'volumes': {}, 'transforms': {},
+                'meshes': []}
+
+    def patientNode(name):
+      return slicer.mrmlScene.GetNodeByID(entry.nodeIDs.get(name, ""))
+
+    for name in self.PATIENT_TRANSFORMS:
+      metadata['transforms'][name] = slicer.util.arrayFromTransformMatrix(patientNode(name)).tolist()
+    # the TRUS volume usually comes from the .mrb scene, not from a TRUS.nrrd file
+    TRUSVolume = patientNode("TRUS")
+    if TRUSVolume is not None:
+      arrays['TRUS'] = slicer.util.arrayFromVolume(TRUSVolume)
+      ijkToRas = vtk.vtkMatrix4x4()
+      TRUSVolume.GetIJKToRASMatrix(ijkToRas)
+      ijkToRas = slicer.util.arrayFromVTKMatrix(ijkToRas)
+      description = {'array': 'TRUS', 'header': {},
+                     'contentHash': assets.trus.contentHash if assets.trus is not None else None}
+      parent = TRUSVolume.GetParentTransformNode()
+      patientTransformIDs = dict((entry.nodeIDs[name], name) for name in self.PATIENT_TRANSFORMS)
+      if parent is not None and parent.GetID() in patientTransformIDs:
+        # recreated under the same transform when the bundle is loaded
+        description['parentTransform'] = patientTransformIDs[parent.GetID()]
+      elif parent is not None:
+        ijkToRas = slicer.util.arrayFromTransformMatrix(parent, toWorld=True).dot(ijkToRas)
+      description['ijkToRas'] = ijkToRas.tolist()
+      metadata['volumes']['TRUS'] = description
+    if assets.zones is not None:
+      arrays['Zones'] = assets.zones.labelVoxels()
+      metadata['volumes']['Zones'] = volumeDescription('Zones', assets.zones)
+
+    segmentationNode = slicer.mrmlScene.GetNodeByID(entry.nodeIDs.get("Segmentation", ""))
+    if segmentationNode is not None:
+      segmentation = segmentationNode.GetSegmentation()
+      closedSurfaceName = slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName()
+      for index in range(segmentation.GetNumberOfSegments()):
+        segment = segmentation.GetNthSegment(index)
+        triangles = vtk.vtkTriangleFilter()
+        triangles.SetInputData(segment.GetRepresentation(closedSurfaceName))
+        triangles.Update()
+        surface = triangles.GetOutput()
+        prefix = 'Mesh{0}'.format(index)
+        arrays[prefix + 'Points'] = numpy_support.vtk_to_numpy(surface.GetPoints().GetData()).astype(np.float32)
+        arrays[prefix + 'Offsets'] = numpy_support.vtk_to_numpy(surface.GetPolys().GetOffsetsArray()).astype(np.int64)
+        arrays[prefix + 'Connectivity'] = numpy_support.vtk_to_numpy(
+          surface.GetPolys().GetConnectivityArray()).astype(np.int64)
+        metadata['meshes'].append({'name': segment.GetName(), 'points': prefix + 'Points',
+                                   'offsets': prefix + 'Offsets', 'connectivity': prefix + 'Connectivity'})
+
+    writeAssetBundle(path, arrays, metadata)
+
+  def exportAllAssetBundles(self):
+    for patient in self.manifest.patientIds():
+      if self.manifest.assetPath(patient, 'scene') is not None:
+        self.exportAssetBundle(patient)
+
+  def createZoneSurfaces(self, segmentationNode, sourcePath, contentHash):
+    """Create the closed surface representation, reusing surfaces generated earlier from the same labelmap"""
+    segmentation = segmentationNode.GetSegmentation()
+    closedSurfaceName = slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName()
+    cacheKey = self.surfaceCache.cacheKey(contentHash, segmentation.SerializeAllConversionParameters())
+
+    if self.setClosedSurfaces(segmentationNode, self.surfaceCache.load(sourcePath, cacheKey)):
+      return
+
+    with self.timing.stage('createClosedSurfaceRepresentation'):
+      segmentationNode.CreateClosedSurfaceRepresentation()
+    surfaces = [segmentation.GetNthSegment(index).GetRepresentation(closedSurfaceName)
+                for index in range(segmentation.GetNumberOfSegments())]
+    try:
+      self.surfaceCache.store(sourcePath, cacheKey, surfaces)
+    except (IOError, OSError) as e:
+      logging.warning('Could not cache zone surfaces of {0}: {1}'.format(sourcePath, e))
+
+  def sceneNodeIDs(self):
+    nodes = slicer.mrmlScene.GetNodes()
+    return [nodes.GetItemAsObject(i).GetID() for i in range(nodes.GetNumberOfItems())]
+
+  def nodeMemorySize(self, node):
+    """Approximate size of the bulk data of a node in bytes"""
+    if node.IsA('vtkMRMLVolumeNode') and node.GetImageData() is not None:
+      return node.GetImageData().GetActualMemorySize() * 1024
+    if node.IsA('vtkMRMLSegmentationNode'):
+      size = 0
+      segmentation = node.GetSegmentation()
+      for index in range(segmentation.GetNumberOfSegments()):
+        segment = segmentation.GetNthSegment(index)
+        names = []
+        segment.GetContainedRepresentationNames(names)
+        for name in names:
+          size += segment.GetRepresentation(name).GetActualMemorySize() * 1024
+      return size
+    return 0
+
+  def removePatientNodes(self, entry):
+    if entry is None:
+      return
+    for nodeID in entry.nodeIDs.values():
+      node = slicer.mrmlScene.GetNodeByID(nodeID)
+      if node is not None:
+        slicer.mrmlScene.RemoveNode(node)
+    self.distanceMapCache.clear(entry.patient)
+
+  def getOrCreateSharedNodes(self):
+    nodes = {}
+    for name in self.SHARED_TRANSFORMS:
+      node = slicer.mrmlScene.GetNodeByID(self.sharedNodeIDs[name]) if name in self.sharedNodeIDs else None
+      if node is None:
+        node = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", name)
+      nodes[name] = node
+    probeModel = slicer.mrmlScene.GetNodeByID(self.sharedNodeIDs["probe_v01"]) if "probe_v01" in self.sharedNodeIDs else None
+    if probeModel is None:
+      probeModel = slicer.util.loadModel(self.manifest.sharedAssetPath('probeModel') or self.resourcePath('probe_v01.stl'))
+    nodes["probe_v01"] = probeModel
+    referenceModel = slicer.mrmlScene.GetNodeByID(self.sharedNodeIDs["PZ_Intersection"]) if "PZ_Intersection" in self.sharedNodeIDs else None
+    referencePath = self.manifest.sharedAssetPath('pzIntersection')
+    if referenceModel is None and referencePath is not None:
+      # shown in the 3D view together with the zones
+      referenceModel = slicer.util.loadModel(referencePath)
+      referenceModel.SetName("PZ_Intersection")
+      referenceModel.GetDisplayNode().SetVisibility(False)
+      referenceModel.GetDisplayNode().SetVisibility2D(False)
+    if referenceModel is not None:
+      nodes["PZ_Intersection"] = referenceModel
+    for name, asset in (("probe_v01", 'probeModel'), ("PZ_Intersection", 'pzIntersection')):
+      if name in nodes and nodes[name].GetID() not in self.sharedMeshLevels:
+        with self.timing.stage('createMeshLevels'):
+          self.sharedMeshLevels[nodes[name].GetID()] = self.createMeshLevels(nodes[name].GetPolyData(),
+                                                                            self.manifest.sharedContentHash(asset))
+    self.sharedNodeIDs = dict((name, node.GetID()) for name, node in nodes.items())
+    return nodes
+
+  def activatePatientNodes(self, entry):
+    # hide the patients that stay cached in the background
+    for other in self.sceneCache.entries():
+      segmentation = slicer.mrmlScene.GetNodeByID(other.nodeIDs.get("Segmentation", ""))
+      if other is not entry and segmentation is not None and segmentation.GetDisplayNode():
+        segmentation.GetDisplayNode().SetVisibility(False)
+
+    shared = self.getOrCreateSharedNodes()
+
+    def patientNode(name):
+      return slicer.mrmlScene.GetNodeByID(entry.nodeIDs[name])
+
+    # Create hierarchy
+    shared["probe_v01"].SetAndObserveTransformNodeID(shared[self.ROTATED_TO_PROBEMODEL].GetID())
+    patientNode(self.PROBEMODEL_TO_PROBE).SetAndObserveTransformNodeID(shared[self.PROBE_TO_REFERENCE].GetID())
+    patientNode("SliceToImage").SetAndObserveTransformNodeID(shared[self.IMAGE_TO_PROBE].GetID())
+    shared[self.PROBE_TO_REFERENCE].SetAndObserveTransformNodeID(patientNode("ReferenceToRAS").GetID())
+    shared[self.ROTATED_TO_PROBEMODEL].SetAndObserveTransformNodeID(patientNode(self.PROBEMODEL_TO_PROBE).GetID())
+    shared[self.IMAGE_TO_PROBE].SetAndObserveTransformNodeID(shared[self.PROBE_TO_REFERENCE].GetID())
+
+    # every patient starts from the initial probe pose, as after a fresh load
+    shared[self.PROBE_TO_REFERENCE].SetMatrixTransformToParent(vtk.vtkMatrix4x4())
+    self.transformScheduler.cancel()
+    self.probePose.reset()
+    self.applyProbePose()
+
+    if "TRUS" in entry.nodeIDs:
+      slicer.util.setSliceViewerLayers(background=patientNode("TRUS"))
+    self.refinementTimer.stop()
+    self.pyramidStatus['activeFactor'] = 1
+    self.activePatient = entry.patient
+
+  def applyProbePose(self):
+    """Copy the pose engine matrices into the RotatedToProbeModel and ImageToProbe nodes"""
+    RotatedToProbeModel = self.getNode(self.ROTATED_TO_PROBEMODEL)
+    ImageToProbe = self.getNode(self.IMAGE_TO_PROBE)
+    if RotatedToProbeModel is None or ImageToProbe is None:
+      return
+    self.rotatedToProbeModelMatrix.DeepCopy(self.probePose.rotatedToProbeModel.ravel())
+    self.imageToProbeMatrix.DeepCopy(self.probePose.imageToProbe.ravel())
+    RotatedToProbeModel.SetMatrixTransformToParent(self.rotatedToProbeModelMatrix)
+    ImageToProbe.SetMatrixTransformToParent(self.imageToProbeMatrix)
+
+  def scheduleProbePose(self):
+    """Apply the pose engine matrices on the next display frame, coalescing fast repeated input"""
+    RotatedToProbeModel = self.getNode(self.ROTATED_TO_PROBEMODEL)
+    ImageToProbe = self.getNode(self.IMAGE_TO_PROBE)
+    if RotatedToProbeModel is None or ImageToProbe is None:
+      return
+    # the engine updates these arrays in place, so the newest pose is read when the frame is flushed
+    self.transformScheduler.requestUpdate(RotatedToProbeModel, self.probePose.rotatedToProbeModel)
+    self.transformScheduler.requestUpdate(ImageToProbe, self.probePose.imageToProbe)
+
+  def stepProbe(self, pitch=0, yaw=0):
+    """Move the probe by arrow key steps. Returns False if a limit would be passed or the probe would push into
+    the gland."""
+    with self.timing.stage('probeStep'):
+      if not self.probePose.step(pitch=pitch, yaw=yaw):
+        return False
+      self.scheduleProbePose()
+      self.recordSessionEvent(SESSION_PROBE_STEP)
+    return True
+
+  def setMaximumFrameRate(self, maximumFrameRate):
+    self.transformScheduler.setMaximumFrameRate(maximumFrameRate)
+
+  def startTrackedProbe(self, host='localhost', port=DEFAULT_PORT, deviceName='Marker0ToTracker',
+                        probeToMarker=None, maximumAge=0.2):
+    """Drive ProbeToReference from OpenIGTLink TRANSFORM messages of deviceName (PlusServer by default).
+    The newest sample is taken at most once per display frame, older ones are dropped.
+    """
+    import numpy as np
+    self.stopTrackedProbe()
+    self.trackerClient = IgtlTransformClient(host, port, maximumAge)
+    self.trackerClient.start()
+    self.trackerDeviceName = deviceName
+    self.probeToMarker = np.eye(4) if probeToMarker is None else np.asarray(probeToMarker, dtype=float)
+    self.trackerMatrix = np.eye(4)
+    self.trackerTimer = qt.QTimer()
+    self.trackerTimer.setInterval(max(1, int(self.transformScheduler.framePeriod() * 1000)))
+    self.trackerTimer.connect('timeout()', self.onTrackerTimer)
+    self.trackerTimer.start()
+
+  def stopTrackedProbe(self):
+    if self.trackerTimer is not None:
+      self.trackerTimer.stop()
+      self.trackerTimer = None
+    if self.trackerClient is not None:
+      self.trackerClient.stop()
+      self.trackerClient = None
+    self.trackerSampleInFlight = None
+
+  def onTrackerTimer(self):
+    import numpy as np
+    sample = self.trackerClient.takeLatest(self.trackerDeviceName)
+    ProbeToReference = self.getNode(self.PROBE_TO_REFERENCE)
+    if sample is None or ProbeToReference is None:
+      return
+    if self.trackerSampleInFlight is not None:
+      # replaced before it reached the screen
+      self.trackerClient.statistics.droppedFrames += 1
+    np.matmul(sample.matrix, self.probeToMarker, out=self.trackerMatrix)
+    self.trackerSampleInFlight = sample
+    self.transformScheduler.requestUpdate(ProbeToReference, self.trackerMatrix)
+
+  def onTransformsFlushed(self):
+    self.onProbeMoved()
+    self.onMeshMotion()
+    if self.syntheticEnabled:
+      self.renderSyntheticImage()
+    sample = self.trackerSampleInFlight
+    if sample is None or self.trackerClient is None:
+      return
+    self.trackerSampleInFlight = None
+    statistics = self.trackerClient.statistics
+    statistics.appliedFrames += 1
+    statistics.addLatency(time.time() - sample.timestamp)
+
+  def setPyramidLevelVolume(self, factor):
+    """Show TRUS (factor 1) or one of its downsampled levels in the Yellow slice view"""
+    name = "TRUS" if factor == 1 else "TRUS_{0}x".format(factor)
+    volume = self.getNode(name)
+    compositeNode = slicer.mrmlScene.GetNodeByID("vtkMRMLSliceCompositeNodeYellow")
+    if volume is None or compositeNode is None:
+      return False
+    compositeNode.SetBackgroundVolumeID(volume.GetID())
+    self.pyramidStatus['activeFactor'] = factor
+    return True
+
+  def onProbeMoved(self):
+    # the synthetic image replaces the TRUS levels in the Yellow view
+    if not self.pyramidEnabled or not self.activePatient or self.syntheticEnabled:
+      return
+    self.pyramidStatus['lastMotionTime'] = time.perf_counter()
+    if self.pyramidStatus['activeFactor'] != self.pyramidMotionFactor:
+      if self.setPyramidLevelVolume(self.pyramidMotionFactor):
+        self.pyramidStatus['coarseSwitches'] += 1
+    self.refinementTimer.start(int(self.pyramidStatus['refinementDelay'] * 1000))
+
+  def onRefinementTimer(self):
+    if self.setPyramidLevelVolume(1):
+      self.pyramidStatus['refinements'] += 1
+      self.pyramidStatus['lastRefinementTime'] = time.perf_counter() - self.pyramidStatus['lastMotionTime']
+
+  def setPyramidOptions(self, enabled=None, motionFactor=None, refinementDelay=None):
+    """Configure the pyramid: motionFactor is the level (2 or 4) shown while moving, refinementDelay the idle
+    time in seconds before switching back to full resolution.
+    """
+    if enabled is not None:
+      self.pyramidEnabled = enabled
+      if not enabled:
+        self.refinementTimer.stop()
+        self.setPyramidLevelVolume(1)
+    if motionFactor is not None:
+      self.pyramidMotionFactor = motionFactor
+    if refinementDelay is not None:
+      self.pyramidStatus['refinementDelay'] = refinementDelay
+
+  def getPyramidStatus(self):
+    """Active level and refinement timing: lastRefinementTime is the time from the last motion to the switch
+    back to full resolution, in seconds
+    """
+    return dict(self.pyramidStatus)
+
+  def createMeshLevels(self, polyData, contentHash):
+    """Decimated levels of a mesh (see decimateLevels), loaded from the cache if the same source was decimated
+    before. Level 0 is always polyData itself.
+    """
+    key = self.meshLevelCache.cacheKey(contentHash) if contentHash else None
+    levels = self.meshLevelCache.load(key, len(LOD_REDUCTIONS)) if key else None
+    if levels is not None:
+      levels[0] = polyData
+      return levels
+    with self.timing.stage('decimateMesh'):
+      levels = decimateLevels(polyData)
+    if key:
+      try:
+        self.meshLevelCache.store(key, levels)
+      except (IOError, OSError) as e:
+        logging.warning('Could not cache mesh levels: {0}'.format(e))
+    return levels
+
+  def createZoneMeshLevels(self, segmentationNode, contentHash):
+    segmentation = segmentationNode.GetSegmentation()
+    closedSurfaceName = slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName()
+    conversionParameters = segmentation.SerializeAllConversionParameters()
+    meshLevels = []
+    for index in range(segmentation.GetNumberOfSegments()):
+      surface = segmentation.GetNthSegment(index).GetRepresentation(closedSurfaceName)
+      if surface is None or surface.GetNumberOfPoints() == 0:
+        meshLevels.append(None)
+        continue
+      segmentHash = '{0}:{1}:{2}'.format(contentHash, conversionParameters, index) if contentHash else None
+      meshLevels.append(self.createMeshLevels(surface, segmentHash))
+    return meshLevels
+
+  def applyMeshLevel(self, level, force=False):
+    """Show a level of detail of the probe, the PZ intersection and the active patient's zone surfaces"""
+    if level == self.meshLevel and not force:
+      return
+    self.meshLevel = level
+    with slicer.util.RenderBlocker():
+      for nodeID, levels in self.sharedMeshLevels.items():
+        node = slicer.mrmlScene.GetNodeByID(nodeID)
+        if node is not None:
+          node.SetAndObservePolyData(levels[min(level, len(levels) - 1)])
+      for entry in self.sceneCache.entries():
+        self.showZoneMeshLevel(entry, level if entry.patient == self.activePatient else 0)
+
+  def showZoneMeshLevel(self, entry, level):
+    """Coarse zone levels are shown by display-only model nodes in place of the segmentation's 3D display, so
+    the segmentation itself, which is saved with the scene, is never modified
+    """
+    segmentationNode = slicer.mrmlScene.GetNodeByID(entry.nodeIDs.get("Segmentation", ""))
+    if segmentationNode is None or not entry.meshLevels:
+      return
+    segmentation = segmentationNode.GetSegmentation()
+    segmentationDisplay = segmentationNode.GetDisplayNode()
+    coarse = level > 0 and segmentationDisplay is not None and segmentationDisplay.GetVisibility()
+    if segmentationDisplay is not None:
+      segmentationDisplay.SetVisibility3D(not coarse)
+    for index, levels in enumerate(entry.meshLevels):
+      name = 'ZoneLevel_{0}'.format(index)
+      if levels is None or index >= segmentation.GetNumberOfSegments() or (not coarse and name not in entry.nodeIDs):
+        continue
+      modelNode = self.getOrCreateZoneLevelNode(entry, name, segmentationNode, index)
+      if coarse:
+        modelNode.SetAndObservePolyData(levels[min(level, len(levels) - 1)])
+      modelNode.GetDisplayNode().SetVisibility(coarse)
+
+  def getOrCreateZoneLevelNode(self, entry, name, segmentationNode, index):
+    modelNode = slicer.mrmlScene.GetNodeByID(entry.nodeIDs.get(name, ""))
+    if modelNode is not None:
+      return modelNode
+    modelNode = self.getOrCreatePatientNode(entry, "vtkMRMLModelNode", name)
+    modelNode.SetHideFromEditors(True)
+    modelNode.SetSaveWithScene(False)
+    modelNode.SetAndObserveTransformNodeID(segmentationNode.GetTransformNodeID())
+    modelNode.CreateDefaultDisplayNodes()
+    displayNode = modelNode.GetDisplayNode()
+    displayNode.SetSaveWithScene(False)
+    displayNode.SetVisibility2D(False)
+    segmentation = segmentationNode.GetSegmentation()
+    displayNode.SetColor(segmentation.GetNthSegment(index).GetColor())
+    segmentationDisplay = segmentationNode.GetDisplayNode()
+    if segmentationDisplay is not None:
+      displayNode.SetOpacity(segmentationDisplay.GetOpacity3D()
+                             * segmentationDisplay.GetSegmentOpacity3D(segmentation.GetNthSegmentID(index)))
+    return modelNode
+
+  def onMeshMotion(self):
+    if not self.lodEnabled or not self.activePatient:
+      return
+    self.applyMeshLevel(self.levelOfDetail.setMoving(True))
+    self.lodStillTimer.start(int(self.pyramidStatus['refinementDelay'] * 1000))
+
+  def onLodStillTimer(self):
+    self.applyMeshLevel(self.levelOfDetail.setMoving(False))
+
+  def observeThreeDFrameTimes(self, enabled):
+    """Measure every 3D view render for the level of detail controller"""
+    for renderWindow, tags in self.lodRenderObservations:
+      for tag in tags:
+        renderWindow.RemoveObserver(tag)
+    self.lodRenderObservations = []
+    layoutManager = slicer.app.layoutManager()
+    if not enabled or layoutManager is None:
+      return
+    for index in range(layoutManager.threeDViewCount):
+      renderWindow = layoutManager.threeDWidget(index).threeDView().renderWindow()
+      tags = [renderWindow.AddObserver(vtk.vtkCommand.StartEvent, self.onThreeDRenderStart),
+              renderWindow.AddObserver(vtk.vtkCommand.EndEvent, self.onThreeDRenderEnd)]
+      self.lodRenderObservations.append((renderWindow, tags))
+
+  def onThreeDRenderStart(self, caller, event):
+    self.lodRenderStartTime = time.perf_counter()
+
+  def onThreeDRenderEnd(self, caller, event):
+    if self.lodRenderStartTime is None:
+      return
+    level = self.levelOfDetail.addFrameTime(time.perf_counter() - self.lodRenderStartTime)
+    self.lodRenderStartTime = None
+    if level != self.meshLevel:
+      # meshes must not change inside a render
+      qt.QTimer.singleShot(0, lambda: self.applyMeshLevel(self.levelOfDetail.level))
+
+  def setLevelOfDetailOptions(self, enabled=None, targetFrameRate=None, maximumStillFrameTime=None):
+    """Configure mesh switching: targetFrameRate is the 3D frame rate to hold while the probe moves,
+    maximumStillFrameTime the longest acceptable render of a still probe in seconds.
+    """
+    if enabled is not None:
+      self.lodEnabled = enabled
+      self.observeThreeDFrameTimes(enabled)
+      if not enabled:
+        self.lodStillTimer.stop()
+        self.levelOfDetail.setMoving(False)
+        self.applyMeshLevel(0)
+    if targetFrameRate is not None:
+      self.levelOfDetail.targetFrameTime = 1.0 / targetFrameRate
+    if maximumStillFrameTime is not None:
+      self.levelOfDetail.maximumStillFrameTime = maximumStillFrameTime
+
+  def getLevelOfDetailStatus(self):
+    """Shown level, level used while moving, smoothed 3D frame time per level in seconds and motion switches"""
+    return {'level': self.meshLevel, 'movingLevel': self.levelOfDetail.movingLevel,
+            'frameTimes': dict(self.levelOfDetail.frameTimes), 'switches': self.levelOfDetail.switches}
+
+  def setSyntheticEnabled(self, enabled, **options):
+    """Show the synthetic TRUS image instead of the plain reslice in the Yellow view. options update
+    syntheticOptions: outputSize (columns, rows), blend and speckleContrast, see SyntheticUltrasound.
+    """
+    if options:
+      self.syntheticOptions.update(options)
+      self.syntheticRenderer = None
+    self.syntheticEnabled = enabled
+    if not self.activePatient:
+      return
+    if enabled:
+      self.setupSyntheticImage()
+    else:
+      self.setPyramidLevelVolume(1)
+
+  def setPoseConstraintsEnabled(self, enabled, clearance=None):
+    """Check probe steps against the anatomy of the active patient (clearance in mm between the probe and the
+    gland) instead of the fixed step limits"""
+    if clearance is not None:
+      self.probeClearance = clearance
+    self.poseConstraintsEnabled = enabled
+    self.updateProbeConstraint()
+
+  def sharedModelPoints(self, name):
+    """Full resolution points of a shared model, whichever mesh level it currently shows"""
+    from vtk.util import numpy_support
+    node = slicer.mrmlScene.GetNodeByID(self.sharedNodeIDs.get(name, ""))
+    if node is None:
+      return None
+    levels = self.sharedMeshLevels.get(node.GetID())
+    polyData = levels[0] if levels else node.GetPolyData()
+    if polyData is None or polyData.GetNumberOfPoints() == 0:
+      return None
+    return numpy_support.vtk_to_numpy(polyData.GetPoints().GetData()).astype(float)
+
+  def getSignedDistanceField(self, entry):
+    """Signed distance to the gland and the PZ intersection surface of a cached patient, computed the first time
+    and then loaded from the cache directory"""
+    if entry.signedDistanceField is None and entry.zoneIndex is not None:
+      contentHash = '{0}:{1}'.format(entry.zonesHash, self.manifest.sharedContentHash('pzIntersection'))
+      arrays = self.distanceMapCache.load(entry.patient, entry.zonesPath, 'sdf', contentHash)
+      if arrays is not None and 'distances' in arrays and 'ijkToRas' in arrays:
+        entry.signedDistanceField = SignedDistanceField(arrays['distances'], arrays['ijkToRas'])
+      else:
+        self.ensureDistanceMapSupport()
+        field = SignedDistanceField.fromZoneIndex(entry.zoneIndex, self.sharedModelPoints("PZ_Intersection"))
+        self.distanceMapCache.save(entry.patient, entry.zonesPath, 'sdf', contentHash,
+                                   {'distances': field.distances, 'ijkToRas': field.ijkToRas})
+        entry.signedDistanceField = field
+    return entry.signedDistanceField
+
+  def updateProbeConstraint(self):
+    """Validate the probe steps of the active patient against its anatomy, or fall back to the fixed step limits
+    if constraints are off or the patient has no zone segmentation"""
+    self.probeConstraint = None
+    self.probePose.poseValidator = None
+    entry = self.sceneCache.getEntry(self.activePatient) if self.activePatient else None
+    if not self.poseConstraintsEnabled or entry is None:
+      return None
+    vertices = self.sharedModelPoints("probe_v01")
+    with self.timing.stage('signedDistanceField'):
+      field = self.getSignedDistanceField(entry)
+    if field is None or vertices is None:
+      return None
+
+    def probeModelToRas():
+      # everything above the pitch/yaw rotation, including the tracked ProbeToReference
+      return slicer.util.arrayFromTransformMatrix(self.getNode(self.PROBEMODEL_TO_PROBE), toWorld=True)
+
+    self.probeConstraint = ProbeConstraint(field, vertices, probeModelToRas, self.probePose, self.probeClearance)
+    self.probePose.poseValidator = self.validateProbeStep
+    return self.probeConstraint
+
+  def validateProbeStep(self, pitchSteps, yawSteps, newPitchSteps, newYawSteps):
+    with self.timing.stage('poseValidation'):
+      return self.probeConstraint(pitchSteps, yawSteps, newPitchSteps, newYawSteps)
+
+  def getTissueMap(self, entry):
+    """Tissue classes of a cached patient, built the first time the synthetic image is shown"""
+    if entry.tissueMap is None and entry.zoneIndex is not None and "TRUS" in entry.nodeIDs:
+      TRUSVolume = slicer.mrmlScene.GetNodeByID(entry.nodeIDs["TRUS"])
+      entry.tissueMap = TissueMap.fromZoneIndex(entry.zoneIndex, slicer.util.arrayFromVolume(TRUSVolume))
+    return entry.tissueMap
+
+  def setupSyntheticImage(self):
+    """Create the renderer and the SyntheticTRUS volume of the active patient and show it in the Yellow view.
+    The volume sits in the SliceToImage frame, so only its voxels change when the probe moves.
+    """
+    import numpy as np
+    entry = self.sceneCache.getEntry(self.activePatient)
+    TRUSVolume = self.getNode("TRUS")
+    SliceToImage = self.getNode("SliceToImage")
+    if entry is None or TRUSVolume is None or SliceToImage is None:
+      return False
+    if self.syntheticRenderer is None:
+      spacing = min(TRUSVolume.GetSpacing())
+      tiles = self.speckleCache.tiles(len(TISSUE_PROPERTIES))
+      self.syntheticRenderer = SyntheticUltrasound(self.syntheticOptions['outputSize'], (spacing, spacing), tiles,
+                                                   blend=self.syntheticOptions['blend'],
+                                                   speckleContrast=self.syntheticOptions['speckleContrast'])
+    voxels, rasToIjk = self.volumeSamplingArrays(TRUSVolume)
+    self.syntheticRenderer.setPatient(voxels, rasToIjk, self.getTissueMap(entry))
+
+    columns, rows = self.syntheticRenderer.outputSize
+    spacingX, spacingY = self.syntheticRenderer.outputSpacing
+    syntheticVolume = self.getOrCreatePatientNode(entry, "vtkMRMLScalarVolumeNode", "SyntheticTRUS")
+    if syntheticVolume.GetImageData() is None or slicer.util.arrayFromVolume(syntheticVolume).shape != (1, rows, columns):
+      slicer.util.updateVolumeFromArray(syntheticVolume, np.zeros((1, rows, columns), dtype=np.float32))
+      # same pixel centres as the reslice grid of the slice plane
+      ijkToSlice = np.diag([spacingX, spacingY, 1.0, 1.0])
+      ijkToSlice[:2, 3] = [-0.5 * (columns - 1) * spacingX, -0.5 * (rows - 1) * spacingY]
+      syntheticVolume.SetIJKToRASMatrix(slicer.util.vtkMatrixFromArray(ijkToSlice))
+      syntheticVolume.SetHideFromEditors(True)
+      syntheticVolume.CreateDefaultDisplayNodes()
+      displayNode, TRUSDisplayNode = syntheticVolume.GetDisplayNode(), TRUSVolume.GetDisplayNode()
+      if displayNode is not None and TRUSDisplayNode is not None:
+        displayNode.SetAutoWindowLevel(False)
+        displayNode.SetWindowLevel(TRUSDisplayNode.GetWindow(), TRUSDisplayNode.GetLevel())
+        displayNode.SetAndObserveColorNodeID(TRUSDisplayNode.GetColorNodeID())
+    syntheticVolume.SetAndObserveTransformNodeID(SliceToImage.GetID())
+
+    self.refinementTimer.stop()
+    compositeNode = slicer.mrmlScene.GetNodeByID("vtkMRMLSliceCompositeNodeYellow")
+    if compositeNode is not None:
+      compositeNode.SetBackgroundVolumeID(syntheticVolume.GetID())
+    self.renderSyntheticImage()
+    return True
+
+  def renderSyntheticImage(self):
+    """Render the synthetic frame of the current pose into the SyntheticTRUS voxels"""
+    entry = self.sceneCache.getEntry(self.activePatient) if self.activePatient else None
+    syntheticVolume = slicer.mrmlScene.GetNodeByID(entry.nodeIDs.get("SyntheticTRUS", "")) if entry else None
+    if self.syntheticRenderer is None or syntheticVolume is None:
+      return
+    with self.timing.stage('syntheticFrame'):
+      self.syntheticRenderer.render(self.sliceToRasMatrices()[0], out=slicer.util.arrayFromVolume(syntheticVolume)[0])
+      slicer.util.arrayFromVolumeModified(syntheticVolume)
+
+  def sessionDirectory(self):
+    return os.path.join(slicer.app.defaultScenePath, 'UltrasoundSimSessions')
+
+  def startSessionRecording(self, path=None):
+    """Record probe steps, zone selections, fiducials and needles of this session. Returns the file path."""
+    self.stopSessionRecording()
+    if path is None:
+      path = os.path.join(self.sessionDirectory(),
+                          time.strftime('Session_%Y%m%d_%H%M%S') + SESSION_EXTENSION)
+    self.sessionRecorder = SessionRecorder(path, self.probePose.rotatedToProbeModel, self.probePose.imageToProbe,
+                                           metadata={'patient': self.activePatient})
+    # the starting state, so that a replay does not depend on what was loaded before
+    self.recordSessionEvent(SESSION_PATIENT, self.activePatient)
+    self.recordSessionEvent(SESSION_PROBE_STEP)
+    self.sessionFlushTimer.start()
+    return path
+
+  def stopSessionRecording(self):
+    self.sessionFlushTimer.stop()
+    if self.sessionRecorder is not None:
+      self.sessionRecorder.close()
+      self.sessionRecorder = None
+
+  def flushSessionRecording(self):
+    if self.sessionRecorder is not None:
+      self.sessionRecorder.flush()
+
+  def recordSessionEvent(self, eventType, value=0, point=None, vector=None):
+    # replayed events are not recorded again
+    if self.sessionRecorder is None or self.sessionReplay is not None:
+      return
+    self.sessionRecorder.record(eventType, value, self.probePose.pitchSteps, self.probePose.yawSteps, point, vector)
+
+  def applySessionEvent(self, event):
+    """Feed one recorded event back through the logic"""
+    eventType = event['type']
+    if eventType == SESSION_PATIENT:
+      if event['value'] == 0:
+        self.deactivatePatientScene()
+      elif event['value'] != self.activePatient:
+        self.setupPatientScene(int(event['value']))
+    elif eventType == SESSION_PROBE_STEP:
+      self.probePose.setSteps(int(event['pitchSteps']), int(event['yawSteps']))
+      self.scheduleProbePose()
+    elif eventType == SESSION_FIDUCIAL:
+      zones = list(ZONE_SEGMENT_NAMES)
+      zone = zones[event['value']] if 0 <= event['value'] < len(zones) else None
+      entry = self.sceneCache.getEntry(self.activePatient)
+      if entry is not None:
+        fiducialNode = self.getOrCreatePatientNode(entry, "vtkMRMLMarkupsFiducialNode", "Replayed fiducials")
+        if fiducialNode.GetDisplayNode() is None:
+          fiducialNode.CreateDefaultDisplayNodes()
+        fiducialNode.AddControlPointWorld(vtk.vtkVector3d(*event['point']), zone or "")
+      if zone is not None:
+        self.scorePlacement(event['point'].tolist(), zone)
+    elif eventType == SESSION_NEEDLE:
+      self.probePose.setSteps(int(event['pitchSteps']), int(event['yawSteps']))
+      self.applyProbePose()
+      self.fireNeedle()
+    # zone selections only start placement mode in the widget, they are kept for review
+
+  def replaySession(self, path, realTime=True, speed=1.0, finishedCallback=None):
+    """Replay a recorded session. In real time events are applied from a timer with their recorded spacing
+    (divided by speed); otherwise they are applied back to back and every probe step is flushed and rendered
+    immediately, which makes a repeatable load for performance runs. Returns the statistics of a fast replay,
+    None for a real time one (finishedCallback gets them when it ends).
+    """
+    self.stopSessionReplay()
+    header, events = loadSession(path)
+    self.sessionReplay = {'path': path, 'header': header, 'events': events, 'index': 0, 'speed': speed,
+                          'realTime': realTime, 'startTime': time.perf_counter(),
+                          'finishedCallback': finishedCallback}
+    if realTime:
+      self.onReplayTimer()
+      return None
+    try:
+      for event in events:
+        self.applySessionEvent(event)
+        self.transformScheduler.flush()
+        self.sessionReplay['index'] += 1
+    finally:
+      statistics = self.stopSessionReplay()
+    return statistics
+
+  def onReplayTimer(self):
+    replay = self.sessionReplay
+    if replay is None:
+      return
+    events = replay['events']
+    elapsed = (time.perf_counter() - replay['startTime']) * replay['speed']
+    # apply everything that is due, then wait for the next event
+    while replay['index'] < len(events) and events[replay['index']]['time'] <= elapsed:
+      self.applySessionEvent(events[replay['index']])
+      replay['index'] += 1
+    if replay['index'] >= len(events):
+      self.stopSessionReplay()
+      return
+    delay = (events[replay['index']]['time'] - elapsed) / replay['speed']
+    self.replayTimer.start(max(0, int(delay * 1000.0)))
+
+  def stopSessionReplay(self):
+    """Stop a running replay. Returns {'events', 'seconds', 'eventsPerSecond'} for the replayed part."""
+    self.replayTimer.stop()
+    replay, self.sessionReplay = self.sessionReplay, None
+    if replay is None:
+      return None
+    seconds = time.perf_counter() - replay['startTime']
+    statistics = {'path': replay['path'], 'events': replay['index'], 'seconds': seconds,
+                  'eventsPerSecond': replay['index'] / seconds if seconds > 0 else None}
+    if replay['finishedCallback'] is not None:
+      replay['finishedCallback'](statistics)
+    return statistics
+
+  def setSaveDirectory(self, directory):
+    """Keep saved deltas in another directory (remembered in the application settings)"""
+    if directory == self.saveDirectory:
+      return
+    self.sceneDeltas.shutdown()
+    self.saveDirectory = directory
+    self.sceneDeltas = SceneDeltaStore(directory)
+    qt.QSettings().setValue('UltrasoundSim/SaveDirectory', directory)
+
+  def patientFiducialNodes(self, patient):
+    return [node for node in slicer.util.getNodesByClass('vtkMRMLMarkupsFiducialNode')
+            if node.GetAttribute(self.PATIENT_ATTRIBUTE) == str(patient)]
+
+  def snapshotItems(self, patient=None):
+    """Editable state of a cached patient as named arrays: patient transforms, fiducial points grouped by node
+    name, fired needles and the session state.
+    """
+    import json
+    import numpy as np
+    patient = patient or self.activePatient
+    entry = self.sceneCache.getEntry(patient)
+    items = {}
+    for name in self.PATIENT_TRANSFORMS:
+      node = slicer.mrmlScene.GetNodeByID(entry.nodeIDs.get(name, ""))
+      if node is not None:
+        items['transform/' + name] = slicer.util.arrayFromTransformMatrix(node)
+    fiducials = {}
+    for node in self.patientFiducialNodes(patient):
+      if node.GetNumberOfControlPoints():
+        fiducials.setdefault(node.GetName(), []).append(slicer.util.arrayFromMarkupsControlPoints(node))
+    for name, points in fiducials.items():
+      items['fiducials/' + name] = np.concatenate(points)
+    needles = [(pitchSteps, yawSteps) + tuple(start) + tuple(end)
+               for shotPatient, pitchSteps, yawSteps, start, end, summary in self.needleShots if shotPatient == patient]
+    if needles:
+      items['needles'] = np.array(needles, dtype=float)
+    state = {'needleGuide': self.needleGuide}
+    if patient == self.activePatient:
+      state.update({'pitchSteps': self.probePose.pitchSteps, 'yawSteps': self.probePose.yawSteps})
+    items['state'] = np.array(json.dumps(state, sort_keys=True))
+    return items
+
+  def saveSnapshot(self, patient=None):
+    """Save what changed for a cached patient (the active one by default) since the last save. Reading the nodes
+    and the comparison run here, since MRML is not thread safe; the delta file is encoded and written in the
+    background. Returns the future of the write, or None if nothing changed.
+    """
+    patient = patient or self.activePatient
+    if self.sceneCache.getEntry(patient) is None:
+      return None
+    future = self.sceneDeltas.save(patient, self.snapshotItems(patient))
+    if future is not None:
+      future.add_done_callback(self.onSnapshotWritten)
+    return future
+
+  def onSnapshotWritten(self, future):
+    # runs on the writer thread, so only log
+    if future.exception() is not None:
+      logging.error('Saving changes failed: {0}'.format(future.exception()))
+    else:
+      logging.info('Changes saved to: {0}'.format(future.result()))
+
+  def restoreSnapshot(self, patient, items=None):
+    """Apply the saved state to a freshly loaded patient. Fiducials and needles are only restored if the
+    patient has none in the scene, so live work is never duplicated.
+    """
+    import json
+    patient = patient or self.activePatient
+    entry = self.sceneCache.getEntry(patient)
+    if items is None:
+      items = self.sceneDeltas.load(patient)
+    for name in self.PATIENT_TRANSFORMS:
+      node = slicer.mrmlScene.GetNodeByID(entry.nodeIDs.get(name, ""))
+      if node is not None and 'transform/' + name in items:
+        node.SetMatrixTransformToParent(slicer.util.vtkMatrixFromArray(items['transform/' + name]))
+    if not self.patientFiducialNodes(patient):
+      for key, points in items.items():
+        if not key.startswith('fiducials/'):
+          continue
+        fiducialNode = slicer.mrmlScene.AddNewNodeByClass('vtkMRMLMarkupsFiducialNode', key[len('fiducials/'):])
+        fiducialNode.CreateDefaultDisplayNodes()
+        fiducialNode.SetAttribute(self.PATIENT_ATTRIBUTE, str(patient))
+        slicer.util.updateMarkupsControlPointsFromArray(fiducialNode, points)
+    if 'needles' in items and not any(shot[0] == patient for shot in self.needleShots):
+      for needle in items['needles']:
+        self.needleShots.append((patient, int(needle[0]), int(needle[1]), needle[2:5], needle[5:8], None))
+    state = json.loads(str(items['state'])) if 'state' in items else {}
+    if 'needleGuide' in state:
+      self.setNeedleGuide(**state['needleGuide'])
+    if patient == self.activePatient and 'pitchSteps' in state:
+      self.probePose.setSteps(state['pitchSteps'], state['yawSteps'])
+      self.applyProbePose()
+
+  def compactSavedScene(self, path=None):
+    """Save the active patient, fold its deltas into one base file and write the patient as a full scene
+    (.mrb). Nodes of other cached patients and the shared probe nodes are left out of the file without
+    removing them from the scene. Returns the scene path, or None if saving failed.
+    """
+    patient = self.activePatient
+    entry = self.sceneCache.getEntry(patient)
+    if entry is None:
+      return None
+    self.saveSnapshot(patient)
+    self.sceneDeltas.compact(patient)
+    if path is None:
+      path = os.path.join(self.saveDirectory, 'scene{0}.mrb'.format(patient))
+
+    # same content as the Resources scenes: the patient transforms, the TRUS volume and the fiducials
+    keepIDs = set(entry.nodeIDs[name] for name in self.PATIENT_TRANSFORMS + ["TRUS"] if name in entry.nodeIDs)
+    excludedIDs = [nodeID for other in self.sceneCache.entries() for nodeID in other.nodeIDs.values()
+                   if nodeID not in keepIDs] + list(self.sharedNodeIDs.values())
+    excluded = [slicer.mrmlScene.GetNodeByID(nodeID) for nodeID in excludedIDs]
+    excluded += [node for node in slicer.util.getNodesByClass('vtkMRMLMarkupsFiducialNode')
+                 if node.GetAttribute(self.PATIENT_ATTRIBUTE) != str(patient)]
+    hidden = []
+    for node in excluded:
+      if node is None:
+        continue
+      related = [node]
+      if node.IsA('vtkMRMLDisplayableNode'):
+        related += [node.GetNthDisplayNode(index) for index in range(node.GetNumberOfDisplayNodes())]
+      if node.IsA('vtkMRMLStorableNode'):
+        related.append(node.GetStorageNode())
+      for relatedNode in related:
+        if relatedNode is not None and relatedNode.GetSaveWithScene():
+          relatedNode.SetSaveWithScene(False)
+          hidden.append(relatedNode)
+    try:
+      if not slicer.util.saveScene(path):
+        logging.error('Scene saving failed')
+        return None
+    finally:
+      for node in hidden:
+        node.SetSaveWithScene(True)
+    logging.info('Scene saved to: {0}'.format(path))
+    return path
+
+  def gradeCohort(self, sessionPaths, outputPath=None, numberOfProcesses=None, protocol='12-core', patients=None):
+    """Grade recorded sessions without the GUI. Zones and distance maps of each patient are loaded once and
+    shared with a pool of worker processes. Writes one .npz file with a column per metric (next to the first
+    session by default) and returns the columns.
+    """
+    self.ensureDistanceMapSupport()
+    sessionPaths = list(sessionPaths)
+    if outputPath is None and sessionPaths:
+      outputPath = os.path.join(os.path.dirname(sessionPaths[0]), time.strftime('Grades_%Y%m%d_%H%M%S.npz'))
+    if numberOfProcesses is None:
+      numberOfProcesses = min(defaultNumberOfProcesses(), len(sessionPaths))
+
+    scorers = {}
+    for patient in (patients or self.manifest.patientIds()):
+      zones, zonesPath = self.sceneCache.decodeZones(patient)
+      if zones is None:
+        logging.warning('Patient {0} has no zone segmentation, its sessions are not graded'.format(patient))
+        continue
+      scorers[patient] = self.distanceMapCache.scorer(ZoneIndex.fromNrrdVolume(zones), patient, zonesPath,
+                                                      zones.contentHash, protocol)
+    startTime = time.time()
+    columns = gradeCohort(sessionPaths, scorers, outputPath, numberOfProcesses)
+    logging.info('Graded {0} sessions with {1} processes in {2:.1f} s'.format(
+      len(sessionPaths), numberOfProcesses, time.time() - startTime))
+    return columns
+
+  def setTimingEnabled(self, enabled):
+    self.timing.setEnabled(enabled)
+    self.observeRenderTimes(enabled)
+
+  def observeRenderTimes(self, enabled):
+    """Time every render of the 3D and slice views as the 'render' stage"""
+    for renderWindow, tags in self.renderObservations:
+      for tag in tags:
+        renderWindow.RemoveObserver(tag)
+    self.renderObservations = []
+    layoutManager = slicer.app.layoutManager()
+    if not enabled or layoutManager is None:
+      return
+    views = [layoutManager.threeDWidget(index).threeDView() for index in range(layoutManager.threeDViewCount)]
+    views += [layoutManager.sliceWidget(name).sliceView() for name in layoutManager.sliceViewNames()]
+    for view in views:
+      renderWindow = view.renderWindow()
+      tags = [renderWindow.AddObserver(vtk.vtkCommand.StartEvent, self.onRenderStart),
+              renderWindow.AddObserver(vtk.vtkCommand.EndEvent, self.onRenderEnd)]
+      self.renderObservations.append((renderWindow, tags))
+
+  def onRenderStart(self, caller, event):
+    self.renderStartTime = time.perf_counter()
+
+  def onRenderEnd(self, caller, event):
+    if self.renderStartTime is not None:
+      self.timing.record('render', time.perf_counter() - self.renderStartTime)
+      self.renderStartTime = None
+
+  def getTimingSummary(self):
+    return self.timing.summary()
+
+  def exportTiming(self, path):
+    """Write the stage histograms to a .csv or .json file, depending on the extension"""
+    if path.lower().endswith('.csv'):
+      self.timing.exportCsv(path)
+    else:
+      self.timing.exportJson(path)
+
+  def getTrackerStatistics(self):
+    """Received, applied, dropped and stale frame counts and end-to-end latency of the tracked probe"""
+    if self.trackerClient is None:
+      return None
+    return self.trackerClient.statistics.summary()
+
+  def deactivatePatientScene(self):
+    for entry in self.sceneCache.entries():
+      segmentation = slicer.mrmlScene.GetNodeByID(entry.nodeIDs.get("Segmentation", ""))
+      if segmentation is not None and segmentation.GetDisplayNode():
+        segmentation.GetDisplayNode().SetVisibility(False)
+    for compositeNode in slicer.util.getNodesByClass('vtkMRMLSliceCompositeNode'):
+      compositeNode.SetBackgroundVolumeID(None)
+    self.activePatient = 0
+    self.applyMeshLevel(0, force=True)
+    self.updateProbeConstraint()
+    self.recordSessionEvent(SESSION_PATIENT, 0)
+
+  def clearPatientSceneCache(self, keepPatient=None):
+    """Forget cached patients. Nodes of patients other than keepPatient are removed from the scene."""
+    for entry in self.sceneCache.entries():
+      if entry.patient != keepPatient:
+        self.removePatientNodes(entry)
+      self.sceneCache.removeEntry(entry.patient)
+    if keepPatient is None:
+      self.activePatient = 0
+
+  def cleanup(self):
+    self.refinementTimer.stop()
+    self.lodStillTimer.stop()
+    self.observeRenderTimes(False)
+    self.observeThreeDFrameTimes(False)
+    self.stopSessionReplay()
+    self.stopSessionRecording()
+    self.stopTrackedProbe()
+    self.transformScheduler.cancel()
+    self.sceneCache.shutdown()
+    self.sceneDeltas.shutdown()
+
+  def setZonesVariant(self, variant, patient=None):
+    """Use the Zones_<variant>.seg.nrrd segmentation (0 for Zones.seg.nrrd) of a patient, the active one by
+    default. A resident patient loaded with other zones is reloaded from its files.
+    """
+    patient = patient or self.activePatient
+    if variant not in self.manifest.zonesVariants(patient):
+      raise ValueError('Patient {0} has no zones variant {1}'.format(patient, variant))
+    self.sceneCache.setZonesVariant(patient, variant)
+    entry = self.sceneCache.getEntry(patient)
+    if entry is None or entry.zonesPath == self.sceneCache.assetPath(patient, 'zones'):
+      return
+    self.removePatientNodes(self.sceneCache.removeEntry(patient))
+    if patient == self.activePatient:
+      self.setupPatientScene(patient)
+
+  def getZoneIndex(self, patient=None):
+    """Point to zone lookup of a cached patient, the active one by default"""
+    entry = self.sceneCache.getEntry(patient or self.activePatient)
+    return entry.zoneIndex if entry is not None else None
+
+  def ensureDistanceMapSupport(self):
+    try:
+      import scipy.ndimage
+    except ImportError:
+      slicer.util.pip_install('scipy')
+
+  def scorePlacement(self, position, zone):
+    """Check one RAS point against a zone of the active patient. Returns (inZone, distance in mm) or None
+    if the patient has no zone segmentation.
+    """
+    zones = list(ZONE_SEGMENT_NAMES)
+    self.recordSessionEvent(SESSION_FIDUCIAL, zones.index(zone) if zone in zones else -1, position)
+    zoneIndex = self.getZoneIndex()
+    if zoneIndex is None:
+      return None
+    self.ensureDistanceMapSupport()
+    entry = self.sceneCache.getEntry(self.activePatient)
+    self.distanceMapCache.zoneDistanceMaps(zoneIndex, entry.patient, entry.zonesPath, entry.zonesHash)
+    inZone, distances = zoneIndex.scorePlacements([position], [zone])
+    self.placementScores.append((self.activePatient, zone, tuple(position), bool(inZone[0]), float(distances[0])))
+    return bool(inZone[0]), float(distances[0])
+
+  def getProtocolScorer(self, protocol='12-core', patient=None):
+    """Protocol scorer of a cached patient (the active one by default). Distance maps are computed the first
+    time and then loaded from the cache directory.
+    """
+    entry = self.sceneCache.getEntry(patient or self.activePatient)
+    if entry is None or entry.zoneIndex is None:
+      return None
+    self.ensureDistanceMapSupport()
+    return self.distanceMapCache.scorer(entry.zoneIndex, entry.patient, entry.zonesPath, entry.zonesHash, protocol)
+
+  def scoreProtocol(self, protocol='12-core', includeFiducials=True):
+    """Grade the needles fired (and optionally the fiducials placed) on the active patient against a biopsy
+    protocol, see ProtocolScorer.score. Returns None if the patient has no zone segmentation.
+    """
+    import numpy as np
+    scorer = self.getProtocolScorer(protocol)
+    if scorer is None:
+      return None
+    cores = [(start, end) for patient, pitchSteps, yawSteps, start, end, summary in self.needleShots
+             if patient == self.activePatient]
+    if includeFiducials:
+      cores += [(position, position) for patient, zone, position, inZone, distance in self.placementScores
+                if patient == self.activePatient]
+    return scorer.score(np.array(cores, dtype=float).reshape(-1, 2, 3))
+
+  def getOrCreatePatientNode(self, entry, className, name):
+    """Node of the patient with the given name, created and registered with the patient entry if needed"""
+    node = slicer.mrmlScene.GetNodeByID(entry.nodeIDs[name]) if name in entry.nodeIDs else None
+    if node is None:
+      node = slicer.mrmlScene.AddNewNodeByClass(className, name)
+      node.SetAttribute(self.PATIENT_ATTRIBUTE, str(entry.patient))
+      entry.nodeIDs[name] = node.GetID()
+    return node
+
+  def bindSegments(self):
+    """Draw an ROI around each zone segment of the active patient. Boxes come from the bounding box cache and
+    existing ROI and transform nodes are updated in place.
+    """
+    entry = self.sceneCache.getEntry(self.activePatient) if self.activePatient else None
+    if entry is None or entry.zoneIndex is None:
+      return {}
+    boxes = self.boundingBoxCache.compute(entry.zoneIndex, entry.patient, entry.zonesPath, entry.zonesHash)
+
+    for label, box in boxes.items():
+      roi = self.getOrCreatePatientNode(entry, "vtkMRMLAnnotationROINode", box['name'] + ' bounding box')
+      transformNode = self.getOrCreatePatientNode(entry, "vtkMRMLTransformNode",
+                                                  box['name'] + ' bounding box transform')
+      roi.SetXYZ(0.0, 0.0, 0.0)
+      roi.SetRadiusXYZ(*[0.5 * diameter for diameter in box['diameter']])
+      # Position and orient ROI using a transform
+      transformNode.SetAndObserveMatrixTransformToParent(slicer.util.vtkMatrixFromArray(boundingBoxToRas(box)))
+      roi.SetAndObserveTransformNodeID(transformNode.GetID())
+      if roi.GetDisplayNode() is not None:
+        roi.GetDisplayNode().SetVisibility(False)
+    return boxes
+
+  def resliceTRUS(self, volumeNode, imageToProbe, probeToReference=None, outputSize=(256, 256), outputSpacing=None,
+                  numberOfProcesses=1, chunkSize=32):
+    """Resample TRUS slices for a stack of probe poses without rendering anything.
+    imageToProbe and probeToReference are (N,4,4) or (4,4) arrays. If probeToReference is not given the current
+    ProbeToReference transform is used for all poses. ReferenceToRAS and SliceToImage are taken from the active
+    patient scene. Returns an (N, rows, columns) float32 array.
+    """
+    voxels, rasToIjk = self.volumeSamplingArrays(volumeNode)
+    if outputSpacing is None:
+      spacing = min(volumeNode.GetSpacing())
+      outputSpacing = (spacing, spacing)
+    sliceToRas = self.sliceToRasMatrices(imageToProbe, probeToReference)
+    return resliceStack(voxels, rasToIjk, sliceToRas, outputSize, outputSpacing,
+                        numberOfProcesses=numberOfProcesses, chunkSize=chunkSize)
+
+  def volumeSamplingArrays(self, volumeNode):
+    """Voxel array of a volume and the world RAS to IJK matrix to sample it with"""
+    rasToIjk = vtk.vtkMatrix4x4()
+    volumeNode.GetRASToIJKMatrix(rasToIjk)
+    if volumeNode.GetParentTransformNode() is not None:
+      # sample in the volume's own frame if it has been transformed
+      worldToVolume = vtk.vtkMatrix4x4()
+      volumeNode.GetParentTransformNode().GetMatrixTransformFromWorld(worldToVolume)
+      vtk.vtkMatrix4x4.Multiply4x4(rasToIjk, worldToVolume, rasToIjk)
+    return slicer.util.arrayFromVolume(volumeNode), slicer.util.arrayFromVTKMatrix(rasToIjk)
+
+  def sliceToRasMatrices(self, imageToProbe=None, probeToReference=None):
+    """SliceToRAS of the active patient for (N,4,4) or (4,4) ImageToProbe poses, the current pose by default.
+    If probeToReference is not given the current ProbeToReference transform is used for all poses.
+    """
+    import numpy as np
+    if imageToProbe is None:
+      imageToProbe = self.probePose.imageToProbe
+    if probeToReference is None:
+      probeToReference = slicer.util.arrayFromTransformMatrix(self.getNode(self.PROBE_TO_REFERENCE))
+    referenceToRas = np.eye(4)
+    ReferenceToRAS = self.getNode("ReferenceToRAS")
+    if ReferenceToRAS is not None:
+      referenceToRas = slicer.util.arrayFromTransformMatrix(ReferenceToRAS, toWorld=True)
+    sliceToImage = np.eye(4)
+    SliceToImage = self.getNode("SliceToImage")
+    if SliceToImage is not None:
+      sliceToImage = slicer.util.arrayFromTransformMatrix(SliceToImage)
+    return sliceToRasMatrices(imageToProbe, probeToReference, referenceToRas, sliceToImage)
+
+  def setNeedleGuide(self, entry=None, angle=None, depth=None, throw=None):
+    """Needle guide geometry in the slice plane: entry (x, y) in mm, angle in degrees from the slice y axis,
+    insertion depth before firing and throw (core length) in mm
+    """
+    if entry is not None:
+      self.needleGuide['entry'] = tuple(entry)
+    if angle is not None:
+      self.needleGuide['angle'] = float(angle)
+    if depth is not None:
+      self.needleGuide['depth'] = float(depth)
+    if throw is not None:
+      self.needleGuide['throw'] = float(throw)
+
+  def simulateNeedleTrajectories(self, sliceToRas, angles=None, sampleSpacing=0.25):
+    """Fire the needle guide from every slice pose at every angle. Returns NeedleResults, or None if the active
+    patient has no zone segmentation.
+    """
+    zoneIndex = self.getZoneIndex()
+    if zoneIndex is None:
+      return None
+    if angles is None:
+      angles = [self.needleGuide['angle']]
+    starts, ends = trajectoriesInSlicePlanes(sliceToRas, self.needleGuide['entry'], angles,
+                                             self.needleGuide['depth'], self.needleGuide['throw'])
+    trusNode = self.getNode("TRUS")
+    voxels, rasToIjk = self.volumeSamplingArrays(trusNode) if trusNode is not None else (None, None)
+    return simulateNeedles(zoneIndex, starts, ends, voxels, rasToIjk, sampleSpacing)
+
+  def fireNeedle(self):
+    """Simulate the needle along the current ImageToProbe frame and show its path. Returns the summary of the
+    zones it cut (see NeedleResults.summary), or None without a zone segmentation.
+    """
+    results = self.simulateNeedleTrajectories(self.sliceToRasMatrices())
+    if results is None:
+      return None
+    entry = self.sceneCache.getEntry(self.activePatient)
+    needleNode = self.getOrCreatePatientNode(entry, "vtkMRMLMarkupsLineNode", "Needle")
+    if needleNode.GetNumberOfControlPoints() == 0:
+      needleNode.CreateDefaultDisplayNodes()
+      needleNode.AddControlPointWorld(vtk.vtkVector3d(*results.starts[0]))
+      needleNode.AddControlPointWorld(vtk.vtkVector3d(*results.ends[0]))
+    else:
+      needleNode.SetNthControlPointPositionWorld(0, *results.starts[0])
+      needleNode.SetNthControlPointPositionWorld(1, *results.ends[0])
+    summary = results.summary(0)
+    self.needleShots.append((self.activePatient, self.probePose.pitchSteps, self.probePose.yawSteps,
+                             results.starts[0], results.ends[0], summary))
+    self.recordSessionEvent(SESSION_NEEDLE, 0, results.starts[0], results.ends[0] - results.starts[0])
+    return summary
+
+  def computeIdealNeedleFan(self, angles=None, sampleSpacing=0.5):
+    """Evaluate the needle guide over every reachable pitch/yaw step and a fan of guide angles (-15 to 15 degrees
+    by default) for the active patient. Returns the NeedleResults and, per zone name, the pose with the longest
+    core as {'pitchSteps', 'yawSteps', 'angle', 'coreLength'}.
+    """
+    import numpy as np
+    if angles is None:
+      angles = np.arange(-15.0, 15.5, 1.0)
+    angles = np.asarray(angles, dtype=float)
+    maximumPitchSteps, maximumYawSteps = self.probePose.stepRange()
+    if self.probeConstraint is not None:
+      # only the poses that can be stepped to without pushing into the gland
+      pitchSteps, yawSteps = self.probeConstraint.reachableSteps(maximumPitchSteps, maximumYawSteps)
+    else:
+      pitchSteps, yawSteps = np.meshgrid(np.arange(-maximumPitchSteps, maximumPitchSteps + 1),
+                                         np.arange(-maximumYawSteps, maximumYawSteps + 1), indexing='ij')
+      pitchSteps, yawSteps = pitchSteps.ravel(), yawSteps.ravel()
+    _, imageToProbe = self.probePose.batchMatrices(pitchSteps, yawSteps)
+    # steps are relative to the current ProbeToReference, like the arrow keys
+    results = self.simulateNeedleTrajectories(self.sliceToRasMatrices(imageToProbe), angles, sampleSpacing)
+    if results is None:
+      return None, {}
+
+    ideal = {}
+    for label, name in results.labelNames.items():
+      best = results.bestTrajectory(label)
+      if results.coreLengths[label][best] <= 0:
+        continue
+      pose, angle = divmod(best, len(angles))
+      ideal[name] = {'pitchSteps': int(pitchSteps[pose]), 'yawSteps': int(yawSteps[pose]),
+                     'angle': float(angles[angle]), 'coreLength': float(results.coreLengths[label][best])}
+    return results, ideal
+
   def hasImageData(self,volumeNode):
     """This is an example logic method that
     returns true if the passed in volume
@@ -491,33 +1928,960 @@ class UltrasoundSimModuleTest(ScriptedLoadableModuleTest):
     """Run as few or as many tests as needed here.
     """
     self.setUp()
-    self.test_UltrasoundSimModule1()
-
-  def test_UltrasoundSimModule1(self):
-    """ Ideally you should have several levels of tests.  At the lowest level
-    tests should exercise the functionality of the logic with different inputs
-    (both valid and invalid).  At higher levels your tests should emulate the
-    way the user would interact with your code and confirm that it still works
-    the way you intended.
-    One of the most important features of the tests is that it should alert other
-    developers when their changes will have an impact on the behavior of your
-    module.  For example, if a developer removes a feature that you depend on,
-    your test should break so they know that the feature is needed.
-    """
-
-    self.delayDisplay("Starting the test")
-    #
-    # first, get some data
-    #
-    import SampleData
-    SampleData.downloadFromURL(
-      nodeNames='FA',
-      fileNames='FA.nrrd',
-      uris='http://slicer.kitware.com/midas3/download?items=5767',
-      checksums='SHA256:12d17fba4f2e1f1a843f0757366f28c3f3e1a8bb38836f0de2a32bb1cd476560')
-    self.delayDisplay('Finished with download and loading')
-
-    volumeNode = slicer.util.getNode(pattern="FA")
+    self.test_Benchmark()
+    self.setUp()
+    self.test_TrackedProbeReplay()
+    self.setUp()
+    self.test_PatientSceneCache()
+    self.setUp()
+    self.test_ProbePoseEngine()
+    self.setUp()
+    self.test_Reslice()
+    self.setUp()
+    self.test_ZoneIndex()
+    self.setUp()
+    self.test_SegmentBoundingBoxes()
+    self.setUp()
+    self.test_NeedleSimulation()
+    self.setUp()
+    self.test_ProtocolScoring()
+    self.setUp()
+    self.test_SessionRecording()
+    self.setUp()
+    self.test_CohortGrading()
+    self.setUp()
+    self.test_PatientManifest()
+    self.setUp()
+    self.test_SceneDeltas()
+    self.setUp()
+    self.test_SyntheticUltrasound()
+    self.setUp()
+    self.test_LevelOfDetailController()
+    self.setUp()
+    self.test_ProbeConstraint()
+    self.setUp()
+    self.test_AssetBundle()
+    self.setUp()
+    self.test_Pyramid()
+    self.setUp()
+    self.test_TransformUpdateScheduler()
+    self.setUp()
+    self.test_ZoneSurfaceCache()
+
+  def test_Benchmark(self):
+    """Time loading each bundled patient, arrow key steps with their renders and a needle shot, plus the same
+    steps with the synthetic image for patients that have a TRUS volume. Fails if the synthetic image drops below
+    20 fps, if a pose check does not fit a 60 fps frame or, when a baseline is given, if a stage got slower than
+    the baseline by more than the tolerance. Works in no-main-window mode (renders are then not timed), for
+    example:
+
+      Slicer --no-main-window --python-code "import UltrasoundSimModule as m; m.UltrasoundSimModuleTest().runTest()"
+
+    Environment variables:
+      ULTRASOUNDSIM_BENCHMARK_BASELINE        baseline JSON to compare with, the test fails if it does not exist
+      ULTRASOUNDSIM_BENCHMARK_WRITE_BASELINE  set to 1 to write this run to the baseline JSON instead
+      ULTRASOUNDSIM_BENCHMARK_TOLERANCE       allowed slowdown factor of a stage mean (default 1.5)
+      ULTRASOUNDSIM_BENCHMARK_OUTPUT          directory for the JSON and CSV results of this run
+    """
+    import json
+    self.delayDisplay("Starting the benchmark")
+    baselinePath = os.environ.get('ULTRASOUNDSIM_BENCHMARK_BASELINE')
+    writeBaseline = os.environ.get('ULTRASOUNDSIM_BENCHMARK_WRITE_BASELINE', '') not in ('', '0')
+    tolerance = float(os.environ.get('ULTRASOUNDSIM_BENCHMARK_TOLERANCE', '1.5'))
+    outputDirectory = os.environ.get('ULTRASOUNDSIM_BENCHMARK_OUTPUT', slicer.app.temporaryPath)
+    if writeBaseline and not baselinePath:
+      self.fail('ULTRASOUNDSIM_BENCHMARK_WRITE_BASELINE needs ULTRASOUNDSIM_BENCHMARK_BASELINE')
+    if baselinePath and not writeBaseline and not os.path.exists(baselinePath):
+      self.fail('Benchmark baseline {0} does not exist, write it with ULTRASOUNDSIM_BENCHMARK_WRITE_BASELINE=1'.format(
+        baselinePath))
+
+    # yaw to both limits, then pitch to both limits
+    steps = [(0, 1)] * 7 + [(0, -1)] * 14 + [(-1, 0)] * 2 + [(1, 0)] * 4
     logic = UltrasoundSimModuleLogic()
-    self.assertIsNotNone( logic.hasImageData(volumeNode) )
+    logic.setTimingEnabled(True)
+    patients = logic.manifest.patientIds()
+    self.assertTrue(patients, 'No bundled patients found')
+    patientsWithTRUS = 0
+    try:
+      for patient in patients:
+        logic.clearPatientSceneCache()
+        with logic.timing.stage('setupPatientScene'):
+          entry = logic.setupPatientScene(patient)
+        for pitch, yaw in steps:
+          logic.stepProbe(pitch=pitch, yaw=yaw)
+          logic.transformScheduler.flush()
+          with logic.timing.stage('renderViews'):
+            self.renderViews()
+        with logic.timing.stage('fireNeedle'):
+          logic.fireNeedle()
+        # the reslice and the synthetic image need the TRUS volume
+        if "TRUS" not in entry.nodeIDs:
+          logging.info('Patient {0} has no TRUS volume, the synthetic image is not timed'.format(patient))
+          continue
+        logic.setSyntheticEnabled(True)
+        for pitch, yaw in steps:
+          logic.stepProbe(pitch=-pitch, yaw=-yaw)
+          logic.transformScheduler.flush()
+          with logic.timing.stage('renderViewsSynthetic'):
+            self.renderViews()
+        logic.setSyntheticEnabled(False)
+        patientsWithTRUS += 1
+      summary = logic.getTimingSummary()
+      logic.exportTiming(os.path.join(outputDirectory, 'UltrasoundSimBenchmark.json'))
+      logic.exportTiming(os.path.join(outputDirectory, 'UltrasoundSimBenchmark.csv'))
+    finally:
+      logic.clearPatientSceneCache()
+      logic.cleanup()
+    self.assertEqual(summary['setupPatientScene']['count'], len(patients))
+    self.assertEqual(summary['probeStep']['count'], (len(patients) + patientsWithTRUS) * len(steps))
+    # the synthetic image has to keep up with 20 frames per second
+    if 'syntheticFrame' in summary:
+      self.assertLess(summary['syntheticFrame']['p95Ms'], 50.0)
+    # checking a step against the anatomy has to fit in a 60 fps frame
+    if 'poseValidation' in summary:
+      self.assertLess(summary['poseValidation']['p95Ms'], 1000.0 / 60.0)
+
+    if writeBaseline:
+      if os.path.dirname(baselinePath) and not os.path.exists(os.path.dirname(baselinePath)):
+        os.makedirs(os.path.dirname(baselinePath))
+      with open(baselinePath, 'w') as f:
+        json.dump({'stages': summary}, f, indent=1)
+      self.delayDisplay('Benchmark baseline written to ' + baselinePath)
+    elif baselinePath:
+      with open(baselinePath) as f:
+        baseline = json.load(f)['stages']
+      regressions = compareToBaseline(summary, baseline, tolerance)
+      for stage, value, reference in regressions:
+        logging.error('{0}: {1:.1f} ms, baseline {2:.1f} ms'.format(stage, value, reference))
+      self.assertEqual(regressions, [], 'Stages slower than {0}x the baseline'.format(tolerance))
+    else:
+      logging.info('No ULTRASOUNDSIM_BENCHMARK_BASELINE given, stage times are not compared with a baseline')
+    self.delayDisplay('Test passed!')
+
+  def renderViews(self):
+    layoutManager = slicer.app.layoutManager()
+    if layoutManager is None:
+      return
+    for index in range(layoutManager.threeDViewCount):
+      layoutManager.threeDWidget(index).threeDView().forceRender()
+    for name in layoutManager.sliceViewNames():
+      layoutManager.sliceWidget(name).sliceView().forceRender()
+
+  def test_TrackedProbeReplay(self):
+    """Replay a recorded marker stream through a local stand-in for PlusServer, no camera needed"""
+    import numpy as np
+    self.delayDisplay("Starting tracked probe replay test")
+
+    # a probe translating 1 mm per frame at 100 Hz
+    times = np.arange(100) * 0.01
+    matrices = np.tile(np.eye(4), (100, 1, 1))
+    matrices[:, 0, 3] = np.arange(100)
+    server = IgtlReplayServer(times, ['Marker0ToTracker'] * 100, matrices)
+    server.start()
+
+    logic = UltrasoundSimModuleLogic()
+    logic.getOrCreateSharedNodes()
+    try:
+      logic.startTrackedProbe(port=server.port)
+      self.assertTrue(server.finished.wait(5.0))
+      self.delayDisplay("Waiting for the last frame", 200)
+      logic.transformScheduler.flush()
+      summary = logic.getTrackerStatistics()
+    finally:
+      logic.stopTrackedProbe()
+      server.stop()
+      logic.cleanup()
+
+    probeToReference = slicer.util.arrayFromTransformMatrix(logic.getNode(logic.PROBE_TO_REFERENCE))
+    self.assertEqual(summary['receivedFrames'], 100)
+    self.assertGreater(summary['appliedFrames'], 0)
+    self.assertAlmostEqual(probeToReference[0, 3], 99.0)
+    self.assertIsNotNone(summary['meanLatencyMs'])
+    self.delayDisplay('Test passed!')
+
+  def test_PatientSceneCache(self):
+    """Decode a small NRRD file and check the least recently used patients are evicted first"""
+    import gzip
+    import numpy as np
+    self.delayDisplay("Starting patient scene cache test")
+
+    voxels = np.arange(24, dtype=np.int16).reshape(4, 3, 2)
+    header = ('NRRD0004\ntype: short\ndimension: 3\nspace: left-posterior-superior\nsizes: 2 3 4\n'
+              'space directions: (0.5, 0, 0) (0, 0.5, 0) (0, 0, 2)\nendian: little\nencoding: gzip\n'
+              'space origin: (10, 20, 30)\n\n')
+    volume = decodeNrrd(header.encode('latin-1') + gzip.compress(voxels.tobytes()))
+    np.testing.assert_array_equal(volume.voxels, voxels)
+    np.testing.assert_allclose(volume.ijkToRas[:3, :3], np.diag([-0.5, -0.5, 2.0]))
+    np.testing.assert_allclose(volume.ijkToRas[:3, 3], [-10, -20, 30])
+    np.testing.assert_allclose(volume.spacing, [0.5, 0.5, 2.0])
+
+    cache = PatientSceneCache(lambda path: path, slicer.app.temporaryPath, maximumEntries=2)
+    try:
+      for patient in (1, 2, 3):
+        cache.addEntry(PatientSceneEntry(patient))
+      cache.getEntry(1)
+      # the oldest entry is kept while it is in use
+      self.assertEqual([entry.patient for entry in cache.evict(keepPatients=(2,))], [3])
+      self.assertEqual([entry.patient for entry in cache.entries()], [2, 1])
+      cache.addEntry(PatientSceneEntry(4))
+      self.assertEqual([entry.patient for entry in cache.evict()], [2])
+    finally:
+      cache.shutdown()
+    self.delayDisplay('Test passed!')
+
+  def test_ProbePoseEngine(self):
+    """Compare the closed form pose matrices with T(-c) * Rx(pitch) * Ry(yaw) * T(c) and check the step limits"""
+    import numpy as np
+    from UltrasoundSimModuleLib.ProbePose import PROBE_CENTER_OF_ROTATION, IMAGE_CENTER_OF_ROTATION
+    self.delayDisplay("Starting probe pose engine test")
+
+    def translation(offset):
+      matrix = np.eye(4)
+      matrix[:3, 3] = offset
+      return matrix
+
+    def rotation(pitchDegrees, yawDegrees, center):
+      pitch, yaw = np.radians(pitchDegrees), np.radians(yawDegrees)
+      rx = np.eye(4)
+      rx[1:3, 1:3] = [[np.cos(pitch), -np.sin(pitch)], [np.sin(pitch), np.cos(pitch)]]
+      ry = np.eye(4)
+      ry[0, 0], ry[0, 2], ry[2, 0], ry[2, 2] = np.cos(yaw), np.sin(yaw), -np.sin(yaw), np.cos(yaw)
+      center = np.asarray(center)
+      return translation(-center).dot(rx).dot(ry).dot(translation(center))
+
+    engine = ProbePoseEngine()
+    pitchSteps, yawSteps = np.array([0, 1, -2, 2]), np.array([0, -7, 3, 5])
+    rotatedToProbeModel, imageToProbe = engine.batchMatrices(pitchSteps, yawSteps)
+    for index, (pitch, yaw) in enumerate(zip(pitchSteps, yawSteps)):
+      engine.setSteps(pitch, yaw)
+      expected = rotation(pitch * engine.PITCH_STEP_DEGREES, yaw * engine.YAW_STEP_DEGREES, PROBE_CENTER_OF_ROTATION)
+      np.testing.assert_allclose(rotatedToProbeModel[index], expected, atol=1e-9)
+      np.testing.assert_allclose(engine.rotatedToProbeModel, expected, atol=1e-9)
+      expected = rotation(pitch * engine.PITCH_STEP_DEGREES, yaw * engine.IMAGE_YAW_STEP_DEGREES,
+                          IMAGE_CENTER_OF_ROTATION)
+      np.testing.assert_allclose(imageToProbe[index], expected, atol=1e-9)
+      np.testing.assert_allclose(engine.imageToProbe, expected, atol=1e-9)
+
+    engine.reset()
+    for step in range(engine.MAXIMUM_PITCH_STEPS):
+      self.assertTrue(engine.step(pitch=1))
+    self.assertFalse(engine.step(pitch=1))
+    self.assertEqual(engine.pitchSteps, engine.MAXIMUM_PITCH_STEPS)
+    self.delayDisplay('Test passed!')
+
+  def test_Reslice(self):
+    """Compare vectorized sampling and reslicing with scipy.ndimage.map_coordinates"""
+    import numpy as np
+    from scipy import ndimage
+    self.delayDisplay("Starting reslice test")
+
+    randomState = np.random.RandomState(5)
+    voxels = randomState.rand(12, 10, 8).astype(np.float32)
+    points = randomState.uniform(0, 1, (500, 3)) * (np.array(voxels.shape[::-1]) - 1)
+    expected = ndimage.map_coordinates(voxels, points[:, ::-1].T, order=1)
+    np.testing.assert_allclose(trilinearSample(voxels, points), expected, atol=1e-5)
+    expected = ndimage.map_coordinates(voxels, points[:, ::-1].T, order=0)
+    np.testing.assert_array_equal(nearestSample(voxels, points), expected)
+    self.assertEqual(trilinearSample(voxels, [[-1.0, 2.0, 2.0]], fillValue=-5.0)[0], -5.0)
+
+    # axial slices through the middle of the volume, 0.5 mm voxels shifted by 10 mm
+    ijkToRas = np.diag([0.5, 0.5, 0.5, 1.0])
+    ijkToRas[:3, 3] = 10.0
+    rasToIjk = np.linalg.inv(ijkToRas)
+    sliceToRas = np.tile(np.eye(4), (40, 1, 1))
+    sliceToRas[:, :3, 3] = ijkToRas[:3, :3].dot([3.5, 4.5, 0.0]) + ijkToRas[:3, 3]
+    sliceToRas[:, 2, 3] += np.linspace(0, 5.5, 40)
+    outputSize, outputSpacing = (6, 5), (0.5, 0.5)
+    images = resliceStack(voxels, rasToIjk, sliceToRas, outputSize, outputSpacing)
+    self.assertEqual(images.shape, (40, 5, 6))
+    k, j, i = np.meshgrid(np.linspace(0, 11, 40), np.arange(5) + 2.5, np.arange(6) + 1.0, indexing='ij')
+    expected = ndimage.map_coordinates(voxels, [k, j, i], order=1)
+    np.testing.assert_allclose(images, expected, atol=1e-5)
+    parallelImages = resliceStack(voxels, rasToIjk, sliceToRas, outputSize, outputSpacing,
+                                  numberOfProcesses=2, chunkSize=8)
+    np.testing.assert_array_equal(parallelImages, images)
+    self.delayDisplay('Test passed!')
+
+  def test_ZoneIndex(self):
+    """Look up zones by point and by name in the zone segmentations of all bundled patients"""
+    import numpy as np
+    self.delayDisplay("Starting zone index test")
+
+    zonesDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Resources', 'registered_zones')
+    for patient in range(1, 8):
+      zoneIndex = ZoneIndex.fromNrrdVolume(readNrrd(os.path.join(zonesDirectory, 'Patient_{0}'.format(patient),
+                                                                 'Zones.seg.nrrd')))
+      # long segment names and selector names both map to the short names
+      self.assertEqual(set(zoneIndex.labelNames.values()), {'PZ', 'CZ', 'TZ', 'AFS', 'U'})
+      for zone, segmentName in ZONE_SEGMENT_NAMES.items():
+        self.assertEqual(zoneIndex.labelValue(zone), zoneIndex.labelValue(segmentName))
+
+      for label, name in zoneIndex.labelNames.items():
+        k, j, i = np.argwhere(zoneIndex.labels == label)[0]
+        point = zoneIndex.ijkToRas[:3, :3].dot([i, j, k]) + zoneIndex.ijkToRas[:3, 3]
+        self.assertEqual(zoneIndex.zoneAt(point), name)
+        self.assertEqual(zoneIndex.zoneAt(point[np.newaxis]), [name])
+        self.assertTrue(zoneIndex.isInZone(point, name))
+        self.assertAlmostEqual(float(zoneIndex.distanceToZone(point[np.newaxis], name)[0]), 0.0, places=5)
+
+      outside = zoneIndex.ijkToRas[:3, 3] - 1000.0
+      self.assertIsNone(zoneIndex.zoneAt(outside))
+      self.assertEqual(zoneIndex.distanceToZone(outside[np.newaxis], 'PZ')[0], np.inf)
+    self.delayDisplay('Test passed!')
+
+  def test_SegmentBoundingBoxes(self):
+    """Check that an OBB covers whole voxels and that boxes of zones without a file are cached by content hash"""
+    import shutil
+    import tempfile
+    import numpy as np
+    self.delayDisplay("Starting segment bounding box test")
+
+    labels = np.zeros((4, 6, 14), dtype=np.int16)
+    labels[1, 2:4, 2:12] = 1
+    labels[3, 0, 0] = 2
+    ijkToRas = np.diag([1.0, 2.0, 3.0, 1.0])
+    ijkToRas[:3, 3] = [5.0, 0.0, -5.0]
+    zoneIndex = ZoneIndex(labels, ijkToRas, {1: 'PZ', 2: 'TZ'})
+
+    cacheDirectory = tempfile.mkdtemp(dir=slicer.app.temporaryPath)
+    try:
+      cache = SegmentBoundingBoxCache(cacheDirectory)
+      boxes = cache.compute(zoneIndex, 1, None, contentHash='0123456789abcdef0123')
+      # 10 x 2 x 1 voxels of 1 x 2 x 3 mm
+      np.testing.assert_allclose(boxes['1']['diameter'], [10.0, 4.0, 3.0], atol=1e-6)
+      center = boundingBoxToRas(boxes['1'])[:3, 3]
+      np.testing.assert_allclose(center, ijkToRas[:3, :3].dot([6.5, 2.5, 1.0]) + ijkToRas[:3, 3], atol=1e-6)
+      np.testing.assert_allclose(sorted(boxes['2']['diameter']), [1.0, 2.0, 3.0], atol=1e-6)
+      self.assertEqual(boxes['1']['name'], 'PZ')
+
+      self.assertTrue(os.path.exists(cache.cachePath(1, None, '0123456789abcdef0123')))
+      self.assertEqual(cache.load(1, None, '0123456789abcdef0123')['segments'], boxes)
+      # without a file or a hash there is nothing to key the cache by
+      self.assertIsNone(cache.cachePath(1, None))
+      self.assertEqual(cache.compute(zoneIndex, 1, None), boxes)
+      self.assertEqual(os.listdir(cacheDirectory), ['Patient_1_zones_0123456789abcdef.json'])
+    finally:
+      shutil.rmtree(cacheDirectory)
+    self.delayDisplay('Test passed!')
+
+  def test_NeedleSimulation(self):
+    """Check the core lengths and entry points of needles fired through two blocks of zone voxels"""
+    import numpy as np
+    self.delayDisplay("Starting needle simulation test")
+
+    starts, ends = trajectoriesInSlicePlanes(np.eye(4), (0.0, 0.0), [0.0, 90.0], depth=5.0)
+    np.testing.assert_allclose(starts, [[0, 5, 0], [5, 0, 0]], atol=1e-9)
+    np.testing.assert_allclose(ends, [[0, 5 + DEFAULT_THROW, 0], [5 + DEFAULT_THROW, 0, 0]], atol=1e-9)
+
+    # 1 mm voxels, PZ covers x from 9.5 to 19.5 mm and TZ from 19.5 to 29.5 mm
+    labels = np.zeros((5, 5, 40), dtype=np.int16)
+    labels[:, :, 10:20] = 1
+    labels[:, :, 20:30] = 2
+    zoneIndex = ZoneIndex(labels, np.eye(4), {1: 'peripheral', 2: 'TZ'})
+    starts = np.array([[0.0, 2.0, 2.0], [0.0, 2.0, 2.0], [0.0, 20.0, 2.0]])
+    ends = np.array([[40.0, 2.0, 2.0], [20.0, 2.0, 2.0], [40.0, 20.0, 2.0]])
+    results = simulateNeedles(zoneIndex, starts, ends, intensityVoxels=labels.astype(np.float32),
+                              rasToIjk=np.eye(4))
+    self.assertEqual(len(results), 3)
+    np.testing.assert_allclose(results.coreLengths[1], [10.0, 10.0, 0.0], atol=1e-6)
+    np.testing.assert_allclose(results.coreLengths[2], [10.0, 0.5, 0.0], atol=1e-6)
+    np.testing.assert_allclose(results.entryPoints[1][0], [9.5, 2.0, 2.0], atol=1e-6)
+    np.testing.assert_allclose(results.exitPoints[2][0], [29.5, 2.0, 2.0], atol=1e-6)
+    self.assertTrue(np.isnan(results.entryPoints[1][2]).all())
+    self.assertEqual(results.zonesTraversed(0), ['PZ', 'TZ'])
+    self.assertEqual(results.zonesTraversed(2), [])
+    self.assertEqual(results.bestTrajectory(1), 0)
+    summary = results.summary(1)
+    self.assertEqual(sorted(summary['zones']), ['PZ', 'TZ'])
+    self.assertGreater(summary['meanIntensity'], 0.0)
+    self.delayDisplay('Test passed!')
+
+  def test_ProtocolScoring(self):
+    """Score no cores, and a single core in one sextant region, with distance maps cached by content hash"""
+    import shutil
+    import tempfile
+    import numpy as np
+    self.delayDisplay("Starting protocol scoring test")
+
+    # a 10 x 4 x 9 mm block of peripheral zone, the base is at the top (z from 6 to 8 mm)
+    labels = np.full((9, 4, 10), 2, dtype=np.int16)
+    zoneIndex = ZoneIndex(labels, np.eye(4), {2: 'PZ'})
+    regions = protocolRegions(zoneIndex, 'sextant')
+    self.assertEqual([name for name, mask, target in regions][:3], ['Right base', 'Right mid', 'Right apex'])
+    self.assertEqual(sum(mask.sum() for name, mask, target in regions), labels.size)
+
+    cacheDirectory = tempfile.mkdtemp(dir=slicer.app.temporaryPath)
+    try:
+      scorer = DistanceMapCache(cacheDirectory).scorer(zoneIndex, 1, None, 'abcdef0123456789abcdef', 'sextant')
+      result = scorer.score(np.zeros((0, 2, 3)))
+      self.assertEqual(result['coverage'], 0.0)
+      self.assertEqual(len(result['gaps']), 6)
+      self.assertIsNone(result['meanTargetingError'])
+
+      core = np.array([[[7.0, 0.0, 7.0], [7.0, 3.0, 7.0]]])
+      result = scorer.score(core)
+      self.assertAlmostEqual(result['coverage'], 1.0 / 6)
+      self.assertNotIn('Right base', result['gaps'])
+      covered = [region for region in result['regions'] if region['covered']]
+      self.assertEqual([region['name'] for region in covered], ['Right base'])
+      self.assertLess(covered[0]['targetingError'], 2.0)
+      self.assertEqual(result['zones']['PZ']['numberOfCores'], 1)
+      self.assertAlmostEqual(result['zones']['PZ']['coreLength'], 3.0, places=5)
+
+      # a new cache reads the maps of the zones without a file back from disk
+      self.assertEqual(len(os.listdir(cacheDirectory)), 2)
+      cachedScorer = DistanceMapCache(cacheDirectory).scorer(ZoneIndex(labels, np.eye(4), {2: 'PZ'}), 1, None,
+                                                             'abcdef0123456789abcdef', 'sextant')
+      self.assertEqual(cachedScorer.score(core), result)
+    finally:
+      shutil.rmtree(cacheDirectory)
+    self.delayDisplay('Test passed!')
+
+  def test_SessionRecording(self):
+    """Record more events than the ring buffer holds and read them back, also from a file that was cut short"""
+    import shutil
+    import tempfile
+    import numpy as np
+    self.delayDisplay("Starting session recording test")
+
+    directory = tempfile.mkdtemp(dir=slicer.app.temporaryPath)
+    try:
+      path = os.path.join(directory, 'session' + SESSION_EXTENSION)
+      engine = ProbePoseEngine()
+      recorder = SessionRecorder(path, engine.rotatedToProbeModel, engine.imageToProbe, capacity=4,
+                                 metadata={'patient': 3})
+      recorder.record(SESSION_PATIENT, 3)
+      steps = [(1, 0), (1, 1), (2, 1), (2, 2), (1, 2), (0, 2), (0, 1), (0, 0), (-1, 0)]
+      for pitchSteps, yawSteps in steps:
+        engine.setSteps(pitchSteps, yawSteps)
+        recorder.record(SESSION_PROBE_STEP, 0, pitchSteps, yawSteps)
+        if pitchSteps == 2 and yawSteps == 1:
+          recorder.flush()
+      recorder.record(SESSION_NEEDLE, 2, point=(1.0, 2.0, 3.0), vector=(0.0, 0.0, 22.0))
+      recorder.close()
+      self.assertTrue(recorder.closed)
+
+      header, events = loadSession(path)
+      self.assertEqual(header['patient'], 3)
+      self.assertEqual(len(events), 11)
+      self.assertEqual(list(events['type']), [SESSION_PATIENT] + [SESSION_PROBE_STEP] * 9 + [SESSION_NEEDLE])
+      self.assertEqual(list(zip(events['pitchSteps'][1:10], events['yawSteps'][1:10])), steps)
+      self.assertTrue((np.diff(events['time']) >= 0).all())
+      rotatedToProbeModel, imageToProbe = engine.batchMatrices(events['pitchSteps'][1:10], events['yawSteps'][1:10])
+      for index in range(9):
+        np.testing.assert_allclose(poseMatrix(events['rotatedToProbeModel'][index + 1]), rotatedToProbeModel[index])
+        np.testing.assert_allclose(poseMatrix(events['imageToProbe'][index + 1]), imageToProbe[index])
+      np.testing.assert_array_equal(events['point'][10], [1.0, 2.0, 3.0])
+      np.testing.assert_array_equal(events['vector'][10], [0.0, 0.0, 22.0])
+
+      with open(path, 'rb') as f:
+        data = f.read()
+      with open(path, 'wb') as f:
+        f.write(data[:-10])
+      header, events = loadSession(path)
+      self.assertEqual(len(events), 10)
+    finally:
+      shutil.rmtree(directory)
+    self.delayDisplay('Test passed!')
+
+  def test_CohortGrading(self):
+    """Grade recorded sessions in a process pool, including a missing file and a patient without zones"""
+    import shutil
+    import tempfile
+    import numpy as np
+    self.delayDisplay("Starting cohort grading test")
+
+    directory = tempfile.mkdtemp(dir=slicer.app.temporaryPath)
+    try:
+      labels = np.full((9, 4, 10), 2, dtype=np.int16)
+      scorer = DistanceMapCache(directory).scorer(ZoneIndex(labels, np.eye(4), {2: 'PZ'}), 1, None,
+                                                  'abcdef0123456789abcdef', 'sextant')
+
+      def recordSession(name, patientSteps):
+        engine = ProbePoseEngine()
+        path = os.path.join(directory, name + SESSION_EXTENSION)
+        recorder = SessionRecorder(path, engine.rotatedToProbeModel, engine.imageToProbe)
+        for patient, steps in patientSteps:
+          recorder.record(SESSION_PATIENT, patient)
+          for step in range(steps):
+            engine.step(yaw=1)
+            recorder.record(SESSION_PROBE_STEP, 0, engine.pitchSteps, engine.yawSteps)
+          recorder.record(SESSION_NEEDLE, 0, point=(7.0, 0.0, 7.0), vector=(0.0, 3.0, 0.0))
+          recorder.record(SESSION_FIDUCIAL, list(ZONE_SEGMENT_NAMES).index('Peripheral'), point=(2.0, 2.0, 2.0))
+        recorder.close()
+        return path
+
+      # the steps taken on patient 2 do not count for patient 1
+      sessionPaths = [recordSession('first', [(1, 3), (2, 2), (1, 1)]), recordSession('second', [(2, 4)]),
+                      os.path.join(directory, 'missing' + SESSION_EXTENSION)]
+      grades = gradeCohort(sessionPaths, {1: scorer}, outputPath=os.path.join(directory, 'grades.npz'),
+                           numberOfProcesses=2)
+      self.assertEqual(list(grades['patient']), [1, 2, 0])
+      self.assertEqual(list(grades['probeSteps']), [4, 4, 0])
+      self.assertEqual(grades['error'][0], '')
+      self.assertEqual(grades['error'][1], 'No zones for patient 2')
+      self.assertNotEqual(grades['error'][2], '')
+      self.assertEqual(grades['numberOfNeedles'][0], 2)
+      self.assertEqual(grades['fiducialsInZone'][0], 2)
+      # the needles cover the right base and the fiducials the left apex
+      self.assertAlmostEqual(grades['coverage'][0], 2.0 / 6)
+      self.assertAlmostEqual(grades['coreLength_PZ'][0], 6.0, places=5)
+
+      serialGrades = gradeCohort(sessionPaths, {1: scorer})
+      for name, column in grades.items():
+        np.testing.assert_array_equal(serialGrades[name], column)
+      with np.load(os.path.join(directory, 'grades.npz')) as saved:
+        np.testing.assert_array_equal(saved['probeSteps'], grades['probeSteps'])
+    finally:
+      shutil.rmtree(directory)
+    self.delayDisplay('Test passed!')
+
+  def test_PatientManifest(self):
+    """Discover patients and zone variants in a folder and refresh only what changed"""
+    import shutil
+    import tempfile
+    self.delayDisplay("Starting patient manifest test")
+
+    directory = tempfile.mkdtemp(dir=slicer.app.temporaryPath)
+    try:
+      resourceDirectory = os.path.join(directory, 'Resources')
+      zonesNrrd = b'NRRD0004\ntype: uchar\ndimension: 3\nsizes: 2 1 1\nencoding: raw\n\n\x00\x01'
+      files = {'scene1.mrb': b'1', 'scene3.mrb': b'3', 'notes.txt': b'',
+               'registered_zones/Patient_1/Zones.seg.nrrd': zonesNrrd,
+               'registered_zones/Patient_1/Zones_2.seg.nrrd': zonesNrrd + b'\x02',
+               'registered_zones/Patient_3/TRUS.nrrd': b''}
+      for filename, data in files.items():
+        path = os.path.join(resourceDirectory, filename)
+        if not os.path.exists(os.path.dirname(path)):
+          os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+          f.write(data)
+
+      manifestPath = os.path.join(directory, 'manifest.json')
+      manifest = PatientManifest(resourceDirectory, manifestPath)
+      self.assertEqual(manifest.refresh(), [1, 3])
+      self.assertEqual(manifest.patientIds(), [1, 3])
+      self.assertEqual(manifest.zonesVariants(1), [0, 2])
+      self.assertEqual(manifest.zonesVariants(3), [])
+      self.assertTrue(manifest.zonesPath(1, 2).endswith('Zones_2.seg.nrrd'))
+      self.assertIsNone(manifest.zonesPath(1, 1))
+      self.assertIsNone(manifest.assetPath(3, 'zones'))
+
+      # the scene cache honours the selected variant and records the hash of the zones it decodes
+      cache = PatientSceneCache(lambda path: os.path.join(resourceDirectory, path), directory, manifest=manifest)
+      try:
+        cache.setZonesVariant(1, 2)
+        zones, zonesPath = cache.decodeZones(1)
+        self.assertEqual(zonesPath, manifest.zonesPath(1, 2))
+      finally:
+        cache.shutdown()
+      self.assertEqual(PatientManifest(resourceDirectory, manifestPath).patients[1]['zonesVariants'][0]['sha256'],
+                       zones.contentHash)
+
+      # unchanged files keep their hashes, a changed file is forgotten
+      manifest = PatientManifest(resourceDirectory, manifestPath)
+      self.assertEqual(manifest.refresh(), [])
+      self.assertEqual(manifest.contentHash(1, 'scene'), hashFile(os.path.join(resourceDirectory, 'scene1.mrb')))
+      with open(os.path.join(resourceDirectory, 'scene3.mrb'), 'wb') as f:
+        f.write(b'changed')
+      os.remove(os.path.join(resourceDirectory, 'scene1.mrb'))
+      self.assertEqual(manifest.refresh(), [1, 3])
+      self.assertIsNone(manifest.patients[3]['scene']['sha256'])
+      self.assertEqual(manifest.patientIds(), [3])
+    finally:
+      shutil.rmtree(directory)
+    self.delayDisplay('Test passed!')
+
+  def test_SceneDeltas(self):
+    """Save, restore and compact scene deltas, and recover from a delta that failed to write"""
+    import shutil
+    import tempfile
+    import numpy as np
+    self.delayDisplay("Starting scene delta test")
+
+    directory = tempfile.mkdtemp(dir=slicer.app.temporaryPath)
+    store = SceneDeltaStore(directory)
+    try:
+      items = {'ProbeToReference': np.eye(4), 'fiducials': np.zeros((2, 3)), 'zone': np.array('PZ')}
+      self.assertTrue(store.save(1, items).result().endswith('delta_000001.npz'))
+      self.assertIsNone(store.save(1, items))
+      items['fiducials'][1] = [1.0, 2.0, 3.0]
+      del items['zone']
+      store.save(1, items)
+      store.wait()
+      self.assertEqual([sequence for sequence, path in store.deltaPaths(1)], [1, 2])
+      loaded = store.load(1)
+      self.assertEqual(sorted(loaded), ['ProbeToReference', 'fiducials'])
+      np.testing.assert_array_equal(loaded['fiducials'], items['fiducials'])
+
+      # a directory in the way of the temporary file makes the next write fail
+      blocked = os.path.join(store.patientDirectory(1), 'delta_000003.npz.tmp')
+      os.makedirs(blocked)
+      items['ProbeToReference'][0, 3] = 10.0
+      future = store.save(1, items)
+      self.assertIsNotNone(future.exception())
+      with self.assertRaises(OSError):
+        store.wait()
+      os.rmdir(blocked)
+      # the failed change is written again with the next save
+      items['fiducials'][0] = [4.0, 5.0, 6.0]
+      self.assertTrue(store.save(1, items).result().endswith('delta_000003.npz'))
+      for name, value in store.load(1).items():
+        np.testing.assert_array_equal(value, items[name])
+
+      merged = store.compact(1)
+      self.assertEqual(store.deltaPaths(1), [])
+      self.assertTrue(store.hasSavedState(1))
+      self.assertIsNone(store.save(1, items))
+      reloaded = SceneDeltaStore(directory)
+      try:
+        loaded = reloaded.load(1)
+      finally:
+        reloaded.shutdown()
+      self.assertEqual(sorted(loaded), sorted(merged))
+      np.testing.assert_array_equal(loaded['ProbeToReference'], items['ProbeToReference'])
+      store.clear(1)
+      self.assertFalse(store.hasSavedState(1))
+    finally:
+      store.shutdown()
+      shutil.rmtree(directory)
+    self.delayDisplay('Test passed!')
+
+  def test_SyntheticUltrasound(self):
+    """Render synthetic frames of a block of tissue and check that the urethra casts a shadow"""
+    import shutil
+    import tempfile
+    import numpy as np
+    self.delayDisplay("Starting synthetic ultrasound test")
+
+    directory = tempfile.mkdtemp(dir=slicer.app.temporaryPath)
+    try:
+      cache = SpeckleTileCache(directory)
+      tiles = cache.tiles(len(TISSUE_PROPERTIES), tileSize=(32, 32))
+      self.assertEqual(tiles.shape, (len(TISSUE_PROPERTIES), 32, 32))
+      np.testing.assert_allclose(tiles.mean(axis=(1, 2)), 1.0, rtol=1e-5)
+      self.assertEqual(len(os.listdir(directory)), 1)
+      np.testing.assert_array_equal(SpeckleTileCache(directory).tiles(len(TISSUE_PROPERTIES), tileSize=(32, 32)),
+                                    tiles)
+    finally:
+      shutil.rmtree(directory)
+
+    # 1 mm voxels of peripheral zone with the urethra under the left half
+    labels = np.full((3, 40, 40), 2, dtype=np.int16)
+    labels[:, 10:16, :20] = 4
+    zoneIndex = ZoneIndex(labels, np.eye(4), {2: 'peripheral', 4: 'urethra'})
+    trusVoxels = np.full(labels.shape, 100.0, dtype=np.float32)
+    tissueMap = TissueMap.fromZoneIndex(zoneIndex, trusVoxels)
+    tissueNames = [name for name, echogenicity, attenuation in TISSUE_PROPERTIES]
+    self.assertEqual(tissueMap.tissue[0, 0, 0], tissueNames.index('PZ'))
+    self.assertEqual(tissueMap.tissue[0, 12, 0], tissueNames.index('U'))
+    self.assertEqual(tissueMap.referenceLevel, 100.0)
+
+    # the slice plane is the middle voxel layer, pixel x and y are voxel i and j
+    sliceToRas = np.eye(4)
+    sliceToRas[:3, 3] = [19.5, 19.5, 1.0]
+    synthetic = SyntheticUltrasound((40, 40), (1.0, 1.0), tiles, blend=1.0, speckleContrast=0.0)
+    synthetic.setPatient(None, None, tissueMap)
+    frame = synthetic.render(sliceToRas)
+    self.assertEqual(frame.shape, (40, 40))
+    self.assertTrue(np.isfinite(frame).all())
+    self.assertAlmostEqual(float(frame[5, 5]), float(frame[5, 30]), places=3)
+    self.assertLess(frame[30, 5], 0.5 * frame[30, 30])
+
+    synthetic = SyntheticUltrasound((40, 30), (0.5, 1.0), tiles)
+    synthetic.setPatient(trusVoxels, zoneIndex.rasToIjk, tissueMap)
+    frame = synthetic.render(sliceToRas)
+    self.assertEqual(frame.shape, (30, 40))
+    self.assertTrue(np.isfinite(frame).all())
+    self.assertGreater(frame.min(), 0.0)
+    self.delayDisplay('Test passed!')
+
+  def test_LevelOfDetailController(self):
+    """Feed frame times to the level of detail controller while the probe moves and when it stops"""
+    self.delayDisplay("Starting level of detail controller test")
+
+    controller = LevelOfDetailController(len(LOD_REDUCTIONS), targetFrameTime=1.0 / 30.0, smoothing=1.0)
+    self.assertEqual(controller.setMoving(True), 0)
+    # coarser while the frames are too slow, then held while they fit the budget
+    self.assertEqual(controller.addFrameTime(0.05), 1)
+    self.assertEqual(controller.addFrameTime(0.04), 2)
+    self.assertEqual(controller.addFrameTime(0.02), 2)
+    self.assertEqual(controller.addFrameTime(0.01), 2)
+    # finer again once the finer level was last measured well within the budget
+    controller.frameTimes[1] = 0.02
+    self.assertEqual(controller.addFrameTime(0.01), 1)
+    self.assertEqual(controller.addFrameTime(0.05), 2)
+    self.assertEqual(controller.level, 2)
+
+    # full meshes when still, unless even those are too slow
+    self.assertEqual(controller.setMoving(False), 0)
+    self.assertEqual(controller.switches, 2)
+    self.assertEqual(controller.addFrameTime(0.3), 1)
+    self.assertEqual(controller.setMoving(True), 2)
+    controller.frameTimes = dict((level, 1.0) for level in range(len(LOD_REDUCTIONS)))
+    self.assertEqual(controller.setMoving(False), len(LOD_REDUCTIONS) - 1)
+
+    controller.reset()
+    self.assertEqual(controller.level, 0)
+    self.assertEqual(controller.frameTimes, {})
+    self.delayDisplay('Test passed!')
+
+  def test_ProbeConstraint(self):
+    """Check the signed distance field of a block of gland and the probe steps it allows"""
+    import numpy as np
+    self.delayDisplay("Starting probe constraint test")
+
+    # 1 mm voxels, the gland fills y from 12 mm up
+    labels = np.zeros((21, 40, 41), dtype=np.int16)
+    labels[:, 17:, :] = 2
+    ijkToRas = np.eye(4)
+    ijkToRas[:3, 3] = [-20.0, -5.0, -10.0]
+    zoneIndex = ZoneIndex(labels, ijkToRas, {2: 'PZ'})
+    field = SignedDistanceField.fromZoneIndex(zoneIndex, margin=20.0)
+    distances = field.distanceAt([[0.0, 0.0, 0.0], [0.0, 6.0, 0.0], [0.0, 25.0, 0.0], [0.0, -200.0, 0.0]])
+    np.testing.assert_allclose(distances[:2], [12.0, 6.0], atol=1e-4)
+    self.assertLess(distances[2], 0.0)
+    self.assertGreaterEqual(distances[3], 20.0)
+    withSurface = SignedDistanceField.fromZoneIndex(zoneIndex, surfacePoints=[[0.0, -10.0, 0.0]], margin=20.0)
+    self.assertLess(withSurface.distanceAt([0.0, -10.0, 0.0]), 0.0)
+    self.assertAlmostEqual(float(withSurface.distanceAt([0.0, -4.0, 0.0])), 6.0, places=4)
+
+    # pitching up moves the probe tip about 5.2 mm towards the gland per step
+    engine = ProbePoseEngine()
+    constraint = ProbeConstraint(field, [[0.0, 0.0, 0.0], [0.0, -1.0, 0.0]], lambda: np.eye(4), engine,
+                                 clearance=2.0)
+    clearances = constraint.clearances([0, 1, 2], [0, 0, 0])
+    np.testing.assert_allclose(clearances, field.distanceAt(engine.batchMatrices([0, 1, 2], [0, 0, 0])[0][:, :3, 3]),
+                               atol=1e-4)
+    self.assertLess(clearances[2], 2.0)
+    engine.poseValidator = constraint
+    self.assertEqual(engine.stepRange(), (engine.RANGE_PITCH_STEPS, engine.RANGE_YAW_STEPS))
+    self.assertTrue(engine.step(pitch=1))
+    self.assertFalse(engine.step(pitch=1))
+    self.assertEqual((engine.pitchSteps, constraint.rejectedSteps), (1, 1))
+    self.assertTrue(engine.step(yaw=-3))
+    self.assertTrue(engine.step(pitch=-3))
+    # a pose that is already too close may still move away
+    self.assertTrue(constraint.allows(1.0, 1.5))
+    self.assertFalse(constraint.allows(1.0, 0.5))
+
+    pitchSteps, yawSteps = constraint.reachableSteps(3, 2)
+    self.assertEqual(len(pitchSteps), 5 * 5)
+    self.assertEqual(pitchSteps.max(), 1)
+    self.assertIn((0, 0), list(zip(pitchSteps, yawSteps)))
+    self.delayDisplay('Test passed!')
+
+  def test_AssetBundle(self):
+    """Write arrays, a volume and a mesh to an asset bundle and map them back"""
+    import shutil
+    import struct
+    import tempfile
+    import numpy as np
+    from UltrasoundSimModuleLib.AssetBundle import ALIGNMENT, BUNDLE_EXTENSION, FORMAT_VERSION, MAGIC, PREAMBLE
+    self.delayDisplay("Starting asset bundle test")
+
+    directory = tempfile.mkdtemp(dir=slicer.app.temporaryPath)
+    try:
+      path = os.path.join(directory, 'Patient_1' + BUNDLE_EXTENSION)
+      # odd sizes so that the arrays after the first one need padding
+      zones = np.arange(3 * 5 * 7, dtype='>i2').reshape(3, 5, 7)
+      ijkToRas = np.diag([-0.5, -0.5, 2.0, 1.0])
+      ijkToRas[:3, 3] = [1.0, 2.0, 3.0]
+      volume = NrrdVolume(zones, ijkToRas, {'Segment0_LabelValue': '1', 'Segment0_Name': 'PZ', 'type': 'short'},
+                          'abc123')
+      points = np.random.RandomState(0).rand(11, 3).astype(np.float32)
+      offsets = np.array([0, 3], dtype=np.int64)
+      connectivity = np.array([0, 1, 2], dtype=np.int64)
+      writeAssetBundle(path, {'zones': zones, 'points': points, 'offsets': offsets, 'connectivity': connectivity},
+                       {'volumes': {'Zones': volumeDescription('zones', volume)},
+                        'transforms': {'ProbeToReference': np.eye(4).tolist()},
+                        'meshes': [{'name': 'PZ', 'points': 'points', 'offsets': 'offsets',
+                                    'connectivity': 'connectivity'}]})
+
+      bundle = AssetBundle(path)
+      for name, entry in bundle.layout.items():
+        self.assertEqual(entry['offset'] % ALIGNMENT, 0)
+      mapped = bundle.array('zones')
+      self.assertEqual(mapped.dtype, np.dtype('=i2'))
+      self.assertEqual(mapped.shape, (3, 5, 7))
+      np.testing.assert_array_equal(mapped, zones)
+      zonesVolume = bundle.volume('Zones')
+      np.testing.assert_array_equal(zonesVolume.ijkToRas, ijkToRas)
+      self.assertEqual(zonesVolume.segmentNames(), {1: 'PZ'})
+      self.assertNotIn('type', zonesVolume.header)
+      self.assertEqual(zonesVolume.contentHash, 'abc123')
+      np.testing.assert_array_equal(bundle.transforms()['ProbeToReference'], np.eye(4))
+      [(meshName, meshPoints, meshOffsets, meshConnectivity)] = bundle.meshes()
+      self.assertEqual(meshName, 'PZ')
+      np.testing.assert_array_equal(meshPoints, points)
+      np.testing.assert_array_equal(meshConnectivity, connectivity)
+
+      # arrays are copy-on-write views, the file keeps its contents
+      mapped[0, 0, 0] = 1000
+      np.testing.assert_array_equal(AssetBundle(path).array('zones'), zones)
+
+      # copies, since the mapped file cannot be rewritten on all platforms
+      with open(path, 'rb') as f:
+        data = f.read()
+      badPath = os.path.join(directory, 'bad' + BUNDLE_EXTENSION)
+      with open(badPath, 'wb') as f:
+        f.write(b'NOTABNDL' + data[8:])
+      with self.assertRaisesRegex(ValueError, 'is not an asset bundle'):
+        AssetBundle(badPath)
+      headerSize = struct.unpack('<I', data[12:16])[0]
+      with open(badPath, 'wb') as f:
+        f.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION + 1, headerSize) + data[PREAMBLE.size:])
+      with self.assertRaisesRegex(ValueError, 'Unsupported asset bundle version'):
+        AssetBundle(badPath)
+    finally:
+      shutil.rmtree(directory)
+    self.delayDisplay('Test passed!')
+
+  def test_Pyramid(self):
+    """Compare pyramid levels with block means of the edge-padded volume and check where the coarse voxels sit"""
+    import numpy as np
+    self.delayDisplay("Starting pyramid test")
+
+    randomState = np.random.RandomState(3)
+    ijkToRas = np.array([[0.0, -0.4, 0.0, 10.0], [0.5, 0.0, 0.0, -20.0], [0.0, 0.0, 2.0, 5.0], [0.0, 0.0, 0.0, 1.0]])
+    # no axis divides by 2
+    voxels = randomState.rand(5, 7, 9).astype(np.float32)
+    coarse, coarseIjkToRas = downsampleVolume(voxels, ijkToRas, 2)
+    self.assertEqual(coarse.shape, (3, 4, 5))
+    self.assertEqual(coarse.dtype, np.float32)
+    padded = np.pad(voxels, ((0, 1), (0, 1), (0, 1)), mode='edge')
+    for k, j, i in [(0, 0, 0), (2, 3, 4), (1, 2, 3)]:
+      block = padded[2 * k:2 * k + 2, 2 * j:2 * j + 2, 2 * i:2 * i + 2]
+      self.assertAlmostEqual(float(coarse[k, j, i]), float(block.mean()), places=5)
+    # a coarse voxel centre is the centre of its block of fine voxels
+    for ijk in [(0, 0, 0), (4, 3, 2)]:
+      fineCenter = ijkToRas.dot(np.append(2 * np.array(ijk) + 0.5, 1.0))
+      np.testing.assert_allclose(coarseIjkToRas.dot(np.append(ijk, 1.0)), fineCenter, atol=1e-9)
+
+    # integer volumes are rounded, and axes shorter than the factor are kept
+    labels = randomState.randint(0, 200, (1, 6, 8)).astype(np.uint8)
+    coarseLabels, coarseLabelsIjkToRas = downsampleVolume(labels, ijkToRas, 2)
+    self.assertEqual(coarseLabels.shape, (1, 3, 4))
+    self.assertEqual(coarseLabels.dtype, np.uint8)
+    expected = np.rint(labels.reshape(1, 3, 2, 4, 2).astype(float).mean(axis=(2, 4)))
+    np.testing.assert_array_equal(coarseLabels, expected)
+    np.testing.assert_allclose(coarseLabelsIjkToRas[:3, 2], ijkToRas[:3, 2])
+
+    # the 4x level is computed from the 2x level and matches a direct downsample
+    voxels = randomState.rand(8, 12, 16).astype(np.float32)
+    levels = buildPyramid(voxels, ijkToRas)
+    self.assertEqual([factor for factor, levelVoxels, levelIjkToRas in levels], list(PYRAMID_FACTORS))
+    direct, directIjkToRas = downsampleVolume(voxels, ijkToRas, 4)
+    factor, levelVoxels, levelIjkToRas = levels[1]
+    self.assertEqual(levelVoxels.shape, (2, 3, 4))
+    np.testing.assert_allclose(levelVoxels, direct, atol=1e-6)
+    np.testing.assert_allclose(levelIjkToRas, directIjkToRas, atol=1e-9)
+    self.delayDisplay('Test passed!')
+
+  def test_TransformUpdateScheduler(self):
+    """Coalesce repeated transform requests into one flush and hold back requests that come within a frame"""
+    import numpy as np
+    self.delayDisplay("Starting transform update scheduler test")
+
+    nodes = [slicer.mrmlScene.AddNewNodeByClass("vtkMRMLLinearTransformNode", name)
+             for name in ("SchedulerTestFirst", "SchedulerTestSecond")]
+    transformEvents = []
+    observations = [(node, node.AddObserver(slicer.vtkMRMLTransformNode.TransformModifiedEvent,
+                                            lambda caller, event: transformEvents.append(caller.GetName())))
+                    for node in nodes]
+    scheduler = TransformUpdateScheduler(maximumFrameRate=10.0)
+    flushes = []
+    scheduler.flushCallbacks.append(lambda: flushes.append(scheduler.flushCount))
+    try:
+      # the same buffer updated in place, as the pose engine does
+      first = np.eye(4)
+      for offset in range(5):
+        first[0, 3] = offset
+        scheduler.requestUpdate(nodes[0], first)
+      second = np.eye(4)
+      second[1, 3] = 7.0
+      scheduler.requestUpdate(nodes[1], second)
+      scheduler.requestUpdate(nodes[1], second)
+      self.assertEqual(scheduler.coalescedCount, 5)
+      self.assertEqual(scheduler.flushCount, 0)
+      scheduler.flush()
+      self.assertEqual(scheduler.flushCount, 1)
+      self.assertEqual(flushes, [1])
+      self.assertFalse(scheduler.hasPendingUpdates())
+      self.assertEqual(slicer.util.arrayFromTransformMatrix(nodes[0])[0, 3], 4.0)
+      self.assertEqual(slicer.util.arrayFromTransformMatrix(nodes[1])[1, 3], 7.0)
+      self.assertEqual(sorted(transformEvents), ["SchedulerTestFirst", "SchedulerTestSecond"])
+
+      # a request right after a flush waits for the rest of the frame period
+      first[0, 3] = 10.0
+      scheduler.requestUpdate(nodes[0], first)
+      self.assertTrue(scheduler.hasPendingUpdates())
+      self.assertTrue(scheduler._timer.isActive())
+      self.assertGreater(scheduler._timer.interval, 0)
+      self.assertEqual(scheduler.flushCount, 1)
+      self.delayDisplay("Waiting for the next frame", int(2000 * scheduler.framePeriod()))
+      self.assertEqual(scheduler.flushCount, 2)
+      self.assertEqual(flushes, [1, 2])
+      self.assertEqual(slicer.util.arrayFromTransformMatrix(nodes[0])[0, 3], 10.0)
+    finally:
+      scheduler.cancel()
+      for node, tag in observations:
+        node.RemoveObserver(tag)
+        slicer.mrmlScene.RemoveNode(node)
+    self.delayDisplay('Test passed!')
+
+  def test_ZoneSurfaceCache(self):
+    """Reuse cached zone surfaces for the same labelmap and conversion parameters, and rebuild them on a change"""
+    import json
+    import shutil
+    import tempfile
+    import numpy as np
+    self.delayDisplay("Starting zone surface cache test")
+
+    labels = np.zeros((10, 12, 14), dtype=np.int16)
+    labels[2:8, 2:6, 2:12] = 1
+    labels[2:8, 6:10, 2:12] = 2
+    labelmapNode = slicer.util.addVolumeFromArray(labels, name="SurfaceCacheTestZones",
+                                                  nodeClassName="vtkMRMLLabelMapVolumeNode")
+    segmentationNode = slicer.mrmlScene.AddNewNodeByClass("vtkMRMLSegmentationNode", "SurfaceCacheTestSegmentation")
+    directory = tempfile.mkdtemp(dir=slicer.app.temporaryPath)
+    try:
+      slicer.modules.segmentations.logic().ImportLabelmapToSegmentationNode(labelmapNode, segmentationNode)
+      segmentationNode.CreateClosedSurfaceRepresentation()
+      segmentation = segmentationNode.GetSegmentation()
+      closedSurfaceName = slicer.vtkSegmentationConverter.GetSegmentationClosedSurfaceRepresentationName()
+      surfaces = [segmentation.GetNthSegment(index).GetRepresentation(closedSurfaceName)
+                  for index in range(segmentation.GetNumberOfSegments())]
+      self.assertEqual(len(surfaces), 2)
+
+      cache = ZoneSurfaceCache(directory)
+      sourcePath = os.path.join(directory, 'Patient_1', 'Zones.seg.nrrd')
+      key = cache.cacheKey('a' * 64, segmentation.SerializeAllConversionParameters())
+      self.assertIsNone(cache.load(sourcePath, key))
+      cache.store(sourcePath, key, surfaces)
+      cached = cache.load(sourcePath, key)
+      self.assertEqual(len(cached), len(surfaces))
+      for polyData, surface in zip(cached, surfaces):
+        self.assertEqual(polyData.GetNumberOfPoints(), surface.GetNumberOfPoints())
+        self.assertEqual(polyData.GetNumberOfPolys(), surface.GetNumberOfPolys())
+
+      # a changed file or changed conversion parameters give a different key
+      changedKey = cache.cacheKey('b' * 64, segmentation.SerializeAllConversionParameters())
+      self.assertIsNone(cache.load(sourcePath, changedKey))
+      segmentation.SetConversionParameter("Smoothing factor", "0.1")
+      parametersKey = cache.cacheKey('a' * 64, segmentation.SerializeAllConversionParameters())
+      self.assertNotEqual(parametersKey, key)
+      self.assertIsNone(cache.load(sourcePath, parametersKey))
+
+      # rebuilding the same file replaces its entry
+      cache.store(sourcePath, changedKey, surfaces)
+      with open(os.path.join(directory, ZoneSurfaceCache.INDEX_FILENAME)) as f:
+        self.assertEqual(json.load(f), {sourcePath: changedKey})
+      self.assertFalse(os.path.exists(os.path.join(directory, key)))
+      self.assertIsNone(cache.load(sourcePath, key))
+      self.assertEqual(len(cache.load(sourcePath, changedKey)), 2)
+    finally:
+      slicer.mrmlScene.RemoveNode(segmentationNode)
+      slicer.mrmlScene.RemoveNode(labelmapNode)
+      shutil.rmtree(directory)
     self.delayDisplay('Test passed!')
@@ -0,0 +1,99 @@
+import os
+import json
+import struct
+import numpy as np
+
+from .NrrdIO import NrrdVolume
+
+#
+# Uncompressed per-patient asset bundle. Layout:
+#
+#   magic (8 bytes) | format version (uint32) | header size (uint32) | JSON header | padding | array data ...
+#
+# Every array starts on an ALIGNMENT byte boundary, so the file can be memory-mapped and the arrays used in
+# place without decoding or copying. The JSON header lists the arrays (offset, dtype, shape) and describes how
+# they make up volumes, transforms and surface meshes.
+#
+
+MAGIC = b'USIMBNDL'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+PREAMBLE = struct.Struct('<8sII')
+BUNDLE_EXTENSION = '.usbundle'
+
+
+def _aligned(offset):
+  return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def writeAssetBundle(path, arrays, metadata):
+  """Write named numpy arrays and a JSON-serializable metadata dictionary to a bundle file"""
+  # native byte order, so that readers can hand the mapped buffers to VTK as they are
+  arrays = dict((name, np.ascontiguousarray(array, dtype=array.dtype.newbyteorder('=')))
+                for name, array in arrays.items())
+  layout = {}
+  header = {'metadata': metadata, 'arrays': layout}
+
+  # the header size depends on the offsets it contains, so lay out against a generous estimate
+  headerSize = len(json.dumps(header)) + 128 * (len(arrays) + 1)
+  offset = _aligned(PREAMBLE.size + headerSize)
+  for name, array in arrays.items():
+    layout[name] = {'offset': offset, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+    offset = _aligned(offset + array.nbytes)
+  headerBytes = json.dumps(header).encode()
+  if PREAMBLE.size + len(headerBytes) > _aligned(PREAMBLE.size + headerSize):
+    raise ValueError('Asset bundle header does not fit the reserved space')
+
+  temporaryPath = path + '.tmp'
+  with open(temporaryPath, 'wb') as f:
+    f.write(PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(headerBytes)))
+    f.write(headerBytes)
+    for name, array in arrays.items():
+      f.seek(layout[name]['offset'])
+      f.write(array.tobytes())
+    f.truncate(offset)
+  os.replace(temporaryPath, path)
+
+
+class AssetBundle(object):
+  """Memory-mapped asset bundle. Arrays are views into the mapping (copy-on-write, the file is never modified)."""
+
+  def __init__(self, path):
+    self.path = path
+    with open(path, 'rb') as f:
+      magic, version, headerSize = PREAMBLE.unpack(f.read(PREAMBLE.size))
+      if magic != MAGIC:
+        raise ValueError(path + ' is not an asset bundle')
+      if version != FORMAT_VERSION:
+        raise ValueError('Unsupported asset bundle version {0} in {1}'.format(version, path))
+      header = json.loads(f.read(headerSize).decode())
+    self.metadata = header['metadata']
+    self.layout = header['arrays']
+    self._mapping = np.memmap(path, dtype=np.uint8, mode='c')
+
+  def array(self, name):
+    entry = self.layout[name]
+    dtype = np.dtype(entry['dtype'])
+    size = int(np.prod(entry['shape'])) * dtype.itemsize
+    data = self._mapping[entry['offset']:entry['offset'] + size]
+    return np.ndarray(entry['shape'], dtype=dtype, buffer=data)
+
+  def volume(self, name):
+    """Volume as an NrrdVolume, so that it can be used wherever a decoded .nrrd file is expected"""
+    description = self.metadata['volumes'][name]
+    return NrrdVolume(self.array(description['array']), np.array(description['ijkToRas']),
+                      description.get('header', {}), description.get('contentHash'))
+
+  def transforms(self):
+    return dict((name, np.array(matrix)) for name, matrix in self.metadata.get('transforms', {}).items())
+
+  def meshes(self):
+    """Return [(name, points (N,3) float32, cell offsets int64, cell connectivity int64)] in segment order"""
+    return [(mesh['name'], self.array(mesh['points']), self.array(mesh['offsets']), self.array(mesh['connectivity']))
+            for mesh in self.metadata.get('meshes', [])]
+
+
+def volumeDescription(arrayName, volume):
+  header = dict((key, value) for key, value in volume.header.items() if key.startswith('Segment'))
+  return {'array': arrayName, 'ijkToRas': np.asarray(volume.ijkToRas).tolist(), 'header': header,
+          'contentHash': volume.contentHash}
@@ -0,0 +1,122 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+#
+# Oriented bounding boxes of zone segments, computed with PCA directly from the labelmap voxels and cached per
+# patient and zone file. Only segments whose voxels changed are recomputed.
+#
+
+def orientedBoundingBox(points, voxelAxes=None):
+  """OBB of (N,3) points. Returns the same quantities as the SegmentStatistics labelmap plugin:
+  origin (corner with the smallest coordinates along each direction), diameter and direction columns.
+
+  If the points are voxel centres, voxelAxes (3x3, the IJK to RAS direction columns scaled by the spacing) grows
+  the box by half a voxel on each side so that it covers the voxels, as SegmentStatistics does.
+  """
+  points = np.asarray(points, dtype=float)
+  center = points.mean(axis=0)
+  centered = points - center
+  covariance = centered.T.dot(centered) / max(len(points), 1)
+  eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+  directions = eigenvectors[:, ::-1]
+  if np.linalg.det(directions) < 0:
+    directions[:, 2] *= -1
+  projected = centered.dot(directions)
+  minimum = projected.min(axis=0)
+  maximum = projected.max(axis=0)
+  if voxelAxes is not None:
+    halfVoxel = 0.5 * np.abs(directions.T.dot(np.asarray(voxelAxes, dtype=float))).sum(axis=1)
+    minimum -= halfVoxel
+    maximum += halfVoxel
+  return {
+    'origin': (center + directions.dot(minimum)).tolist(),
+    'diameter': (maximum - minimum).tolist(),
+    'directions': directions.tolist(),
+  }
+
+
+def boundingBoxToRas(box):
+  """4x4 matrix that places a box centred at the origin along the OBB directions"""
+  directions = np.asarray(box['directions'])
+  center = np.asarray(box['origin']) + 0.5 * directions.dot(box['diameter'])
+  matrix = np.eye(4)
+  matrix[:3, :3] = directions
+  matrix[:3, 3] = center
+  return matrix
+
+
+def segmentVoxelIndices(labels):
+  """Flat voxel indices of every non-zero label, from a single sort of the labelmap"""
+  flat = labels.ravel()
+  order = np.argsort(flat, kind='stable')
+  values, starts = np.unique(flat[order], return_index=True)
+  ends = np.append(starts[1:], len(order))
+  return dict((int(value), order[start:end]) for value, start, end in zip(values, starts, ends) if value != 0)
+
+
+class SegmentBoundingBoxCache(object):
+  """Persists per-segment OBBs as JSON, one file per patient and zone file. Zones without a file (from an asset
+  bundle) are keyed by their content hash instead.
+  """
+
+  def __init__(self, cacheDirectory):
+    self.cacheDirectory = cacheDirectory
+
+  def cachePath(self, patient, zonesPath, contentHash=None):
+    """None if there is neither a zone file nor a content hash to key the cache by"""
+    if zonesPath is not None:
+      name = os.path.basename(zonesPath).split('.')[0]
+    elif contentHash is not None:
+      name = 'zones_' + contentHash[:16]
+    else:
+      return None
+    return os.path.join(self.cacheDirectory, 'Patient_{0}_{1}.json'.format(patient, name))
+
+  def load(self, patient, zonesPath, contentHash=None):
+    path = self.cachePath(patient, zonesPath, contentHash)
+    if path is None:
+      return {}
+    try:
+      with open(path) as f:
+        return json.load(f)
+    except (IOError, OSError, ValueError):
+      return {}
+
+  def save(self, patient, zonesPath, boxes, contentHash=None):
+    path = self.cachePath(patient, zonesPath, contentHash)
+    if path is None:
+      return
+    if not os.path.exists(self.cacheDirectory):
+      os.makedirs(self.cacheDirectory)
+    with open(path + '.tmp', 'w') as f:
+      json.dump(boxes, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+  def compute(self, zoneIndex, patient, zonesPath, contentHash=None):
+    """Return {label: box} for all segments. Nothing is recomputed if the zone file contents are unchanged,
+    otherwise only segments whose voxels changed get a new PCA.
+    """
+    cached = self.load(patient, zonesPath, contentHash)
+    if contentHash is not None and cached.get('contentHash') == contentHash:
+      return cached['segments']
+    cachedBoxes = cached.get('segments', {})
+
+    # the prefix keeps boxes cached before they covered whole voxels from being reused
+    geometry = b'voxel extent' + zoneIndex.ijkToRas.tobytes()
+    shape = zoneIndex.labels.shape
+    boxes = {}
+    for label, indices in segmentVoxelIndices(zoneIndex.labels).items():
+      segmentHash = hashlib.sha256(geometry + indices.astype(np.int64).tobytes()).hexdigest()
+      box = cachedBoxes.get(str(label))
+      if box is None or box.get('hash') != segmentHash:
+        k, j, i = np.unravel_index(indices, shape)
+        ijk = np.column_stack((i, j, k)).astype(float)
+        box = orientedBoundingBox(ijk.dot(zoneIndex.ijkToRas[:3, :3].T) + zoneIndex.ijkToRas[:3, 3],
+                                  zoneIndex.ijkToRas[:3, :3])
+        box['hash'] = segmentHash
+      box['name'] = zoneIndex.labelNames.get(label, str(label))
+      boxes[str(label)] = box
+    self.save(patient, zonesPath, {'contentHash': contentHash, 'segments': boxes}, contentHash)
+    return boxes
@@ -0,0 +1,127 @@
+import collections
+import numpy as np
+
+from .Sampling import trilinearSample
+from .ZoneIndex import distanceTransform
+
+#
+# Anatomical probe pose constraints. A signed distance field (mm, negative inside) of the gland, that is all zone
+# labels, and of the PZ intersection surface is computed once per patient on the zone label grid. The grid is
+# padded so that it covers the space around the gland the probe moves through. A pose is checked by moving the
+# probe model vertices and sampling the field at all of them at once, and a whole stack of poses can be checked
+# in one batch.
+#
+
+def signedDistance(occupancy, spacing):
+  """Distance in mm to the boundary of occupancy, positive outside and negative inside"""
+  return distanceTransform(occupancy, spacing) - distanceTransform(~occupancy, spacing)
+
+
+class SignedDistanceField(object):
+  """Signed distance volume with its IJK to RAS matrix. Outside of the volume the distance is the largest value in
+  the field, which is at least the padding margin.
+  """
+
+  def __init__(self, distances, ijkToRas):
+    self.distances = np.ascontiguousarray(distances, dtype=np.float32)
+    self.ijkToRas = np.asarray(ijkToRas, dtype=float)
+    self.rasToIjk = np.linalg.inv(self.ijkToRas)
+    self.outsideDistance = float(self.distances.max())
+
+  @classmethod
+  def fromZoneIndex(cls, zoneIndex, surfacePoints=None, margin=20.0):
+    """Field of the gland and of the surface points (RAS, for example the vertices of PZ_Intersection.vtk) on the
+    label grid padded by margin mm. Surface points further than margin from the labelmap are ignored.
+    """
+    spacing = zoneIndex.spacing
+    padding = np.ceil(margin / spacing).astype(int)
+    occupancy = np.pad(zoneIndex.labels > 0, [(padding[2], padding[2]), (padding[1], padding[1]),
+                                              (padding[0], padding[0])])
+    ijkToRas = zoneIndex.ijkToRas.copy()
+    ijkToRas[:3, 3] -= ijkToRas[:3, :3].dot(padding)
+    if surfacePoints is not None and len(surfacePoints):
+      rasToIjk = np.linalg.inv(ijkToRas)
+      ijk = np.rint(np.asarray(surfacePoints, dtype=float).dot(rasToIjk[:3, :3].T) + rasToIjk[:3, 3]).astype(int)
+      inside = np.all((ijk >= 0) & (ijk < np.array(occupancy.shape[::-1])), axis=1)
+      occupancy[ijk[inside, 2], ijk[inside, 1], ijk[inside, 0]] = True
+    return cls(signedDistance(occupancy, spacing), ijkToRas)
+
+  def distanceAt(self, points):
+    """Signed distance at (..., 3) RAS points, linearly interpolated"""
+    points = np.asarray(points, dtype=float)
+    ijk = points.dot(self.rasToIjk[:3, :3].T) + self.rasToIjk[:3, 3]
+    return trilinearSample(self.distances, ijk, self.outsideDistance)
+
+  def minimumDistances(self, modelToRas, vertices, maximumSamples=1 << 20):
+    """Smallest signed distance over the model vertices for each (N,4,4) model to RAS pose. Poses are processed
+    in chunks of at most maximumSamples vertex samples.
+    """
+    modelToRas = np.asarray(modelToRas, dtype=float).reshape(-1, 4, 4)
+    vertices = np.asarray(vertices, dtype=float)
+    # going straight from model to field voxels saves a transform per vertex
+    modelToIjk = np.matmul(self.rasToIjk, modelToRas)
+    chunkSize = max(1, maximumSamples // max(len(vertices), 1))
+    minimum = np.empty(len(modelToRas), dtype=np.float32)
+    for start in range(0, len(modelToRas), chunkSize):
+      chunk = modelToIjk[start:start + chunkSize]
+      ijk = np.einsum('nij,vj->nvi', chunk[:, :3, :3], vertices) + chunk[:, np.newaxis, :3, 3]
+      minimum[start:start + chunkSize] = trilinearSample(self.distances, ijk, self.outsideDistance).min(axis=1)
+    return minimum
+
+
+class ProbeConstraint(object):
+  """Pose validator for ProbePoseEngine. A step is allowed if the probe keeps at least clearance mm from the
+  gland (the rectal wall lies in between) or, if it is already closer, does not get any closer, so that a
+  starting pose that touches the gland after registration can still be moved away.
+
+  vertices are the probe model points and probeModelToRas is a callable returning the current 4x4 transform of
+  the probe model frame (before the pitch/yaw rotation) to RAS.
+  """
+
+  def __init__(self, field, vertices, probeModelToRas, poseEngine, clearance=2.0):
+    self.field = field
+    self.vertices = np.asarray(vertices, dtype=float)
+    self.probeModelToRas = probeModelToRas
+    self.poseEngine = poseEngine
+    self.clearance = clearance
+    self.rejectedSteps = 0
+
+  def clearances(self, pitchSteps, yawSteps, probeModelToRas=None):
+    """Smallest distance of the probe to the gland for arrays of step counts"""
+    if probeModelToRas is None:
+      probeModelToRas = self.probeModelToRas()
+    rotatedToProbeModel, imageToProbe = self.poseEngine.batchMatrices(np.atleast_1d(pitchSteps),
+                                                                      np.atleast_1d(yawSteps))
+    return self.field.minimumDistances(np.matmul(probeModelToRas, rotatedToProbeModel), self.vertices)
+
+  def allows(self, fromClearance, toClearance):
+    return toClearance >= self.clearance or toClearance >= fromClearance
+
+  def __call__(self, pitchSteps, yawSteps, newPitchSteps, newYawSteps):
+    """Check a step of the pose engine; both poses are evaluated in one batch"""
+    fromClearance, toClearance = self.clearances([pitchSteps, newPitchSteps], [yawSteps, newYawSteps])
+    allowed = self.allows(fromClearance, toClearance)
+    if not allowed:
+      self.rejectedSteps += 1
+    return allowed
+
+  def reachableSteps(self, maximumPitchSteps, maximumYawSteps):
+    """(pitchSteps, yawSteps) arrays of the poses that can be reached from the initial pose one step at a time.
+    All poses in the range are evaluated in one batch, then searched breadth first.
+    """
+    pitchGrid, yawGrid = np.meshgrid(np.arange(-maximumPitchSteps, maximumPitchSteps + 1),
+                                     np.arange(-maximumYawSteps, maximumYawSteps + 1), indexing='ij')
+    clearances = self.clearances(pitchGrid.ravel(), yawGrid.ravel()).reshape(pitchGrid.shape)
+    origin = (maximumPitchSteps, maximumYawSteps)
+    reachable = np.zeros(pitchGrid.shape, dtype=bool)
+    reachable[origin] = True
+    queue = collections.deque([origin])
+    while queue:
+      row, column = queue.popleft()
+      for nextRow, nextColumn in ((row - 1, column), (row + 1, column), (row, column - 1), (row, column + 1)):
+        if (0 <= nextRow < reachable.shape[0] and 0 <= nextColumn < reachable.shape[1]
+            and not reachable[nextRow, nextColumn]
+            and self.allows(clearances[row, column], clearances[nextRow, nextColumn])):
+          reachable[nextRow, nextColumn] = True
+          queue.append((nextRow, nextColumn))
+    return pitchGrid[reachable], yawGrid[reachable]
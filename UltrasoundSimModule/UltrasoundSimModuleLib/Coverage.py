@@ -0,0 +1,219 @@
+import os
+import numpy as np
+
+from .Sampling import nearestSample, trilinearSample
+from .ZoneIndex import distanceTransform
+
+#
+# Systematic biopsy protocol scoring. The gland is split into protocol regions (left/right, base/mid/apex and for
+# the 12-core protocol lateral/medial), each restricted to the target zone. Every region and every zone gets a
+# Euclidean distance map once per patient, so scoring a set of cores only samples those maps.
+#
+
+PROTOCOLS = {
+  'sextant': [(side, level, None) for side in ('Right', 'Left') for level in ('base', 'mid', 'apex')],
+  '12-core': [(side, level, part) for side in ('Right', 'Left') for level in ('base', 'mid', 'apex')
+              for part in ('lateral', 'medial')],
+}
+
+
+def regionName(side, level, part):
+  return ' '.join(word for word in (side, level, part) if word)
+
+
+def protocolRegions(zoneIndex, protocol, targetZone='PZ'):
+  """Return [(name, mask, target point)] for the regions of a protocol. Masks are over zoneIndex.labels and
+  the target point is the RAS centroid of the region (nan if the region is empty).
+  """
+  labels = zoneIndex.labels
+  k, j, i = np.indices(labels.shape)
+  ras = np.stack((i, j, k), axis=-1).dot(zoneIndex.ijkToRas[:3, :3].T) + zoneIndex.ijkToRas[:3, 3]
+  gland = labels > 0
+  target = labels == zoneIndex.labelValue(targetZone)
+  if not gland.any():
+    return [(regionName(*region), np.zeros(labels.shape, dtype=bool), np.full(3, np.nan))
+            for region in PROTOCOLS[protocol]]
+
+  # apex is inferior, base superior
+  centerR = ras[..., 0][gland].mean()
+  inferior, superior = ras[..., 2][gland].min(), ras[..., 2][gland].max()
+  level = np.clip(((ras[..., 2] - inferior) / max(superior - inferior, 1e-6) * 3).astype(int), 0, 2)
+  sides = {'Right': ras[..., 0] >= centerR, 'Left': ras[..., 0] < centerR}
+  levels = {'apex': level == 0, 'mid': level == 1, 'base': level == 2}
+  offset = np.abs(ras[..., 0] - centerR)
+
+  regions = []
+  for side, levelName, part in PROTOCOLS[protocol]:
+    mask = target & sides[side] & levels[levelName]
+    if part is not None and mask.any():
+      # lateral and medial halves of the target zone on this side
+      split = np.median(offset[target & sides[side]])
+      mask &= (offset >= split) if part == 'lateral' else (offset < split)
+    centroid = ras[mask].mean(axis=0) if mask.any() else np.full(3, np.nan)
+    regions.append((regionName(side, levelName, part), mask, centroid))
+  return regions
+
+
+def sampleCores(cores, sampleSpacing=0.5):
+  """Sample points along (N,2,3) core start and end points, or (N,3) points such as fiducials.
+  Returns (N,S,3) points and the (N,) length each sample stands for.
+  """
+  cores = np.asarray(cores, dtype=float)
+  if cores.ndim == 2:
+    cores = np.stack((cores, cores), axis=1)
+  starts, ends = cores[:, 0], cores[:, 1]
+  lengths = np.linalg.norm(ends - starts, axis=1)
+  numberOfSamples = max(1, int(np.ceil(lengths.max() / sampleSpacing))) if len(cores) else 1
+  fractions = (np.arange(numberOfSamples) + 0.5) / numberOfSamples
+  points = starts[:, np.newaxis] + fractions[np.newaxis, :, np.newaxis] * (ends - starts)[:, np.newaxis]
+  return points, lengths / numberOfSamples
+
+
+def distanceToSegments(point, starts, ends):
+  """Distance from one point to each of N segments"""
+  direction = ends - starts
+  lengthSquared = np.maximum((direction * direction).sum(axis=1), 1e-12)
+  t = np.clip(((point - starts) * direction).sum(axis=1) / lengthSquared, 0.0, 1.0)
+  return np.linalg.norm(starts + t[:, np.newaxis] * direction - point, axis=1)
+
+
+class ProtocolScorer(object):
+  """Scores cores against the regions of one protocol for one patient.
+
+  regionMaps are the distance maps of the region masks, in the order of the regions. The zone distance maps
+  come from zoneIndex.distanceMaps.
+  """
+
+  def __init__(self, zoneIndex, protocol, regions, regionMaps, targetZone='PZ'):
+    self.zoneIndex = zoneIndex
+    self.protocol = protocol
+    self.targetZone = targetZone
+    self.regionNames = [name for name, mask, target in regions]
+    self.regionTargets = np.array([target for name, mask, target in regions])
+    self.regionMaps = regionMaps
+
+  def _sampleDistances(self, distanceMap, ijk):
+    distances = trilinearSample(distanceMap, ijk, np.inf)
+    return np.nan_to_num(distances, nan=np.inf, posinf=np.inf)
+
+  def score(self, cores, sampleSpacing=0.5):
+    """Grade (N,2,3) cores or (N,3) points. Returns a dictionary with per-region coverage, the uncovered regions
+    (gaps), the targeting error (distance from each region centroid to the nearest core that hit it, or to the
+    nearest core if none did) and per-zone core counts, lengths and distances.
+    """
+    cores = np.asarray(cores, dtype=float)
+    if len(cores) == 0:
+      return {'protocol': self.protocol, 'numberOfCores': 0, 'regions': [], 'zones': {},
+              'coverage': 0.0, 'gaps': list(self.regionNames), 'meanTargetingError': None}
+    points, sampleLengths = sampleCores(cores, sampleSpacing)
+    ijk = self.zoneIndex.toIjk(points)
+    starts, ends = points[:, 0], points[:, -1]
+
+    regions = []
+    for name, target, distanceMap in zip(self.regionNames, self.regionTargets, self.regionMaps):
+      hits = (nearestSample(distanceMap, ijk, np.inf) == 0).any(axis=1)
+      distances = self._sampleDistances(distanceMap, ijk).min(axis=1)
+      candidates = hits if hits.any() else np.ones(len(cores), dtype=bool)
+      targetingError = None
+      if np.isfinite(target).all():
+        targetingError = float(distanceToSegments(target, starts[candidates], ends[candidates]).min())
+      regions.append({'name': name, 'covered': bool(hits.any()), 'numberOfCores': int(hits.sum()),
+                      'distance': float(distances.min()), 'targetingError': targetingError})
+
+    labels = nearestSample(self.zoneIndex.labels, ijk, 0)
+    zones = {}
+    for label, name in self.zoneIndex.labelNames.items():
+      inZone = labels == label
+      self.zoneIndex.computeDistanceMaps([label])
+      zones[name] = {'numberOfCores': int(inZone.any(axis=1).sum()),
+                     'coreLength': float((inZone.sum(axis=1) * sampleLengths).sum()),
+                     'distance': float(self._sampleDistances(self.zoneIndex.distanceMaps[label], ijk).min())}
+
+    errors = [region['targetingError'] for region in regions if region['covered']]
+    return {
+      'protocol': self.protocol,
+      'numberOfCores': len(cores),
+      'regions': regions,
+      'zones': zones,
+      'coverage': sum(region['covered'] for region in regions) / float(len(regions)),
+      'gaps': [region['name'] for region in regions if not region['covered']],
+      'meanTargetingError': float(np.mean(errors)) if errors else None,
+    }
+
+
+class DistanceMapCache(object):
+  """Persists the zone and protocol region distance maps as .npz, one file per patient, zone file and protocol.
+  Zones without a file (from an asset bundle) are keyed by their content hash instead.
+  """
+
+  def __init__(self, cacheDirectory):
+    self.cacheDirectory = cacheDirectory
+    self.scorers = {}
+
+  def cachePath(self, patient, zonesPath, name, contentHash=None):
+    """None if there is neither a zone file nor a content hash to key the cache by"""
+    if zonesPath is not None:
+      zonesName = os.path.basename(zonesPath).split('.')[0]
+    elif contentHash:
+      zonesName = 'zones_' + contentHash[:16]
+    else:
+      return None
+    return os.path.join(self.cacheDirectory, 'Patient_{0}_{1}_{2}.npz'.format(patient, zonesName, name))
+
+  def load(self, patient, zonesPath, name, contentHash):
+    path = self.cachePath(patient, zonesPath, name, contentHash)
+    if path is None:
+      return None
+    try:
+      with np.load(path) as data:
+        if contentHash is None or str(data['contentHash']) != contentHash:
+          return None
+        return dict((key, data[key]) for key in data.files if key != 'contentHash')
+    except (IOError, OSError, ValueError, KeyError):
+      return None
+
+  def save(self, patient, zonesPath, name, contentHash, maps):
+    path = self.cachePath(patient, zonesPath, name, contentHash)
+    if path is None:
+      return
+    if not os.path.exists(self.cacheDirectory):
+      os.makedirs(self.cacheDirectory)
+    with open(path + '.tmp', 'wb') as f:
+      np.savez(f, contentHash=np.array(contentHash or ''), **maps)
+    os.replace(path + '.tmp', path)
+
+  def zoneDistanceMaps(self, zoneIndex, patient, zonesPath, contentHash=None):
+    """Fill zoneIndex.distanceMaps from the cache, computing and storing them if needed"""
+    maps = self.load(patient, zonesPath, 'zones', contentHash)
+    if maps is not None and all('zone_{0}'.format(label) in maps for label in zoneIndex.labelNames):
+      for label in zoneIndex.labelNames:
+        zoneIndex.distanceMaps.setdefault(label, maps['zone_{0}'.format(label)])
+      return
+    zoneIndex.computeDistanceMaps()
+    self.save(patient, zonesPath, 'zones', contentHash,
+              dict(('zone_{0}'.format(label), zoneIndex.distanceMaps[label]) for label in zoneIndex.labelNames))
+
+  def scorer(self, zoneIndex, patient, zonesPath, contentHash=None, protocol='12-core', targetZone='PZ'):
+    """ProtocolScorer of a patient, from memory, from disk or computed"""
+    key = (patient, zonesPath, contentHash, protocol, targetZone)
+    if key in self.scorers:
+      return self.scorers[key]
+    self.zoneDistanceMaps(zoneIndex, patient, zonesPath, contentHash)
+
+    regions = protocolRegions(zoneIndex, protocol, targetZone)
+    name = '{0}_{1}'.format(protocol, targetZone)
+    maps = self.load(patient, zonesPath, name, contentHash)
+    if maps is None or len(maps) != len(regions):
+      spacing = zoneIndex.spacing
+      maps = dict(('region_{0}'.format(index), distanceTransform(mask, spacing))
+                  for index, (regionName, mask, target) in enumerate(regions))
+      self.save(patient, zonesPath, name, contentHash, maps)
+    regionMaps = [maps['region_{0}'.format(index)] for index in range(len(regions))]
+    scorer = self.scorers[key] = ProtocolScorer(zoneIndex, protocol, regions, regionMaps, targetZone)
+    return scorer
+
+  def clear(self, patient=None):
+    """Forget in-memory scorers, of one patient or all. Files on disk stay valid."""
+    for key in list(self.scorers):
+      if patient is None or key[0] == patient:
+        del self.scorers[key]
@@ -0,0 +1,195 @@
+import numpy as np
+
+from .Parallel import SharedArray, createProcessPool
+from .ZoneIndex import ZONE_SEGMENT_NAMES, ZoneIndex
+from .Coverage import ProtocolScorer
+from .ProbePose import ProbePoseEngine
+from .Session import SESSION_PATIENT, SESSION_PROBE_STEP, SESSION_FIDUCIAL, SESSION_NEEDLE, loadSession
+
+#
+# Headless grading of recorded sessions. The zone labels and distance maps of every patient are put in shared
+# memory once; worker processes attach to them and each grades whole session files, so the only data sent per
+# session is its path and a row of numbers.
+#
+
+GRADED_ZONES = ('PZ', 'CZ', 'TZ', 'AFS', 'U')
+
+
+def emptyGradeRow():
+  row = {
+    'patient': 0, 'duration': 0.0, 'numberOfEvents': 0, 'probeSteps': 0, 'uniquePoses': 0,
+    'angularPath': 0.0, 'imagePathLength': 0.0, 'timeToFirstNeedle': np.nan,
+    'numberOfFiducials': 0, 'fiducialsInZone': 0, 'fiducialMeanDistance': np.nan,
+    'numberOfNeedles': 0, 'coverage': 0.0, 'numberOfGaps': 0, 'meanTargetingError': np.nan,
+    'error': '',
+  }
+  for zone in GRADED_ZONES:
+    row['coreLength_' + zone] = 0.0
+  return row
+
+
+def eventPatients(header, events):
+  """Patient that was active at each event"""
+  isPatientEvent = events['type'] == SESSION_PATIENT
+  lastPatientEvent = np.maximum.accumulate(np.where(isPatientEvent, np.arange(len(events)), -1))
+  return np.where(lastPatientEvent >= 0, events['value'][np.maximum(lastPatientEvent, 0)],
+                  header.get('patient', 0))
+
+
+def gradeSession(header, events, scorers):
+  """Pose path and zone targeting metrics of one session. scorers maps patient to ProtocolScorer."""
+  row = emptyGradeRow()
+  if len(events) == 0:
+    return row
+  types = events['type']
+  times = events['time']
+  patients = eventPatients(header, events)
+  row['numberOfEvents'] = len(events)
+  row['duration'] = float(times[-1] - times[0])
+
+  # the session is graded on the patient most of the work was done on
+  working = patients[(types != SESSION_PATIENT) & (patients > 0)]
+  patient = int(np.bincount(working).argmax()) if len(working) else 0
+  row['patient'] = patient
+
+  poses = events[np.isin(types, (SESSION_PROBE_STEP, SESSION_NEEDLE)) & (patients == patient)]
+  # only the steps taken while the graded patient was loaded, like the poses and fiducials
+  row['probeSteps'] = int(((types == SESSION_PROBE_STEP) & (patients == patient)).sum())
+  if len(poses):
+    steps = np.column_stack((poses['pitchSteps'], poses['yawSteps'])).astype(float)
+    row['uniquePoses'] = len(np.unique(steps, axis=0))
+    stepDegrees = np.array([ProbePoseEngine.PITCH_STEP_DEGREES, ProbePoseEngine.YAW_STEP_DEGREES])
+    row['angularPath'] = float((np.abs(np.diff(steps, axis=0)) * stepDegrees).sum())
+    row['imagePathLength'] = float(np.linalg.norm(np.diff(poses['imageToProbe'][:, :, 3], axis=0), axis=1).sum())
+
+  isNeedle = (types == SESSION_NEEDLE) & (patients == patient)
+  if isNeedle.any():
+    row['timeToFirstNeedle'] = float(times[isNeedle][0] - times[0])
+
+  scorer = scorers.get(patient)
+  if scorer is None:
+    row['error'] = 'No zones for patient {0}'.format(patient)
+    return row
+
+  zoneNames = list(ZONE_SEGMENT_NAMES)
+  fiducials = events[(types == SESSION_FIDUCIAL) & (patients == patient)]
+  fiducials = fiducials[(fiducials['value'] >= 0) & (fiducials['value'] < len(zoneNames))]
+  row['numberOfFiducials'] = len(fiducials)
+  if len(fiducials):
+    inZone, distances = scorer.zoneIndex.scorePlacements(fiducials['point'], [zoneNames[value] for value in
+                                                                               fiducials['value']])
+    row['fiducialsInZone'] = int(inZone.sum())
+    row['fiducialMeanDistance'] = float(np.mean(distances))
+
+  needles = events[isNeedle]
+  row['numberOfNeedles'] = len(needles)
+  cores = np.concatenate((np.stack((needles['point'], needles['point'] + needles['vector']), axis=1),
+                          np.stack((fiducials['point'], fiducials['point']), axis=1)))
+  score = scorer.score(cores)
+  if score['regions']:
+    row['coverage'] = score['coverage']
+    row['numberOfGaps'] = len(score['gaps'])
+    if score['meanTargetingError'] is not None:
+      row['meanTargetingError'] = score['meanTargetingError']
+  for zone in GRADED_ZONES:
+    if zone in score['zones']:
+      row['coreLength_' + zone] = score['zones'][zone]['coreLength']
+  return row
+
+
+def gradeSessionFile(path, scorers):
+  try:
+    header, events = loadSession(path)
+  except (IOError, OSError, ValueError) as e:
+    row = emptyGradeRow()
+    row['error'] = str(e)
+    return row
+  return gradeSession(header, events, scorers)
+
+
+class SharedPatientData(object):
+  """Zone labels and distance maps of a set of patients, copied once into shared memory"""
+
+  def __init__(self, scorers):
+    self.sharedArrays = []
+    self.descriptors = {}
+    for patient, scorer in scorers.items():
+      zoneIndex = scorer.zoneIndex
+      zoneIndex.computeDistanceMaps()
+      zoneLabels = sorted(zoneIndex.labelNames)
+      self.descriptors[patient] = {
+        'labels': self._share(zoneIndex.labels),
+        'zoneMaps': self._share(np.stack([zoneIndex.distanceMaps[label] for label in zoneLabels])),
+        'regionMaps': self._share(np.stack(scorer.regionMaps)),
+        'zoneLabels': zoneLabels,
+        'labelNames': zoneIndex.labelNames,
+        'ijkToRas': zoneIndex.ijkToRas,
+        'protocol': scorer.protocol,
+        'targetZone': scorer.targetZone,
+        'regionNames': scorer.regionNames,
+        'regionTargets': scorer.regionTargets,
+      }
+
+  def _share(self, array):
+    shared = SharedArray.fromArray(array)
+    self.sharedArrays.append(shared)
+    return shared.descriptor()
+
+  def release(self):
+    for shared in self.sharedArrays:
+      shared.release()
+    self.sharedArrays = []
+
+
+def attachPatientData(descriptors):
+  """Rebuild the scorers from shared memory. Returns the scorers and the SharedArrays that back them."""
+  scorers = {}
+  attached = []
+  for patient, description in descriptors.items():
+    labels, zoneMaps, regionMaps = [SharedArray.attach(description[key]) for key in ('labels', 'zoneMaps',
+                                                                                     'regionMaps')]
+    attached += [labels, zoneMaps, regionMaps]
+    zoneIndex = ZoneIndex(labels.array, description['ijkToRas'], description['labelNames'])
+    zoneIndex.distanceMaps = dict(zip(description['zoneLabels'], zoneMaps.array))
+    regions = [(name, None, target) for name, target in zip(description['regionNames'],
+                                                             description['regionTargets'])]
+    scorers[patient] = ProtocolScorer(zoneIndex, description['protocol'], regions, list(regionMaps.array),
+                                      description['targetZone'])
+  return scorers, attached
+
+
+_workerScorers = None
+_workerSharedArrays = None
+
+
+def _attachWorker(descriptors):
+  global _workerScorers, _workerSharedArrays
+  _workerScorers, _workerSharedArrays = attachPatientData(descriptors)
+
+
+def _gradeSharedSessionFile(path):
+  return gradeSessionFile(path, _workerScorers)
+
+
+def gradeCohort(sessionPaths, scorers, outputPath=None, numberOfProcesses=1):
+  """Grade session files against the patients' protocol scorers. Returns a dictionary of columns (one value
+  per session, in the order of sessionPaths) and writes it to outputPath as .npz if given.
+  """
+  sessionPaths = list(sessionPaths)
+  if numberOfProcesses <= 1 or len(sessionPaths) <= 1:
+    rows = [gradeSessionFile(path, scorers) for path in sessionPaths]
+  else:
+    sharedData = SharedPatientData(scorers)
+    try:
+      with createProcessPool(numberOfProcesses, _attachWorker, (sharedData.descriptors,)) as pool:
+        chunkSize = max(1, len(sessionPaths) // (4 * numberOfProcesses))
+        rows = list(pool.map(_gradeSharedSessionFile, sessionPaths, chunksize=chunkSize))
+    finally:
+      sharedData.release()
+
+  columns = {'session': np.array(sessionPaths, dtype=str)}
+  for name, value in emptyGradeRow().items():
+    columns[name] = np.array([row[name] for row in rows], dtype=str if isinstance(value, str) else None)
+  if outputPath is not None:
+    np.savez(outputPath, **columns)
+  return columns
@@ -0,0 +1,149 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import vtk
+
+#
+# Mesh level of detail. Every mesh shown in the 3D view gets a few decimated copies (level 0 is the original),
+# made once at load time and cached as .vtp files. While the probe moves the controller picks the finest level
+# whose measured 3D frame time fits the frame budget; once the probe is still the full meshes are shown again.
+#
+
+# fraction of the triangles removed at each level
+LOD_REDUCTIONS = (0.0, 0.5, 0.8, 0.95)
+# meshes smaller than this are not decimated any further
+LOD_MINIMUM_TRIANGLES = 500
+
+
+def decimateLevels(polyData, reductions=LOD_REDUCTIONS, minimumTriangles=LOD_MINIMUM_TRIANGLES):
+  """List of vtkPolyData, one per reduction. Level 0 is the input; coarser levels are quadric decimations of
+  the triangulated input with recomputed normals, or the previous level if the mesh is already small.
+  """
+  triangles = vtk.vtkTriangleFilter()
+  triangles.SetInputData(polyData)
+  triangles.Update()
+  triangulated = triangles.GetOutput()
+  levels = [polyData]
+  for reduction in reductions[1:]:
+    if reduction <= 0.0 or triangulated.GetNumberOfPolys() * (1.0 - reduction) < minimumTriangles:
+      levels.append(levels[-1])
+      continue
+    decimation = vtk.vtkQuadricDecimation()
+    decimation.SetInputData(triangulated)
+    decimation.SetTargetReduction(reduction)
+    decimation.VolumePreservationOn()
+    normals = vtk.vtkPolyDataNormals()
+    normals.SetInputConnection(decimation.GetOutputPort())
+    normals.SplittingOff()
+    normals.Update()
+    level = vtk.vtkPolyData()
+    level.DeepCopy(normals.GetOutput())
+    levels.append(level)
+  return levels
+
+
+class MeshLevelCache(object):
+  """Stores the levels of one mesh as <cacheDirectory>/<key>/level<i>.vtp, keyed by the mesh source contents and
+  the reductions
+  """
+
+  def __init__(self, cacheDirectory):
+    self.cacheDirectory = cacheDirectory
+
+  def cacheKey(self, contentHash, reductions=LOD_REDUCTIONS):
+    key = hashlib.sha256()
+    key.update(contentHash.encode())
+    key.update(json.dumps(list(reductions)).encode())
+    return key.hexdigest()
+
+  def load(self, key, numberOfLevels):
+    """Cached levels as a list of vtkPolyData, or None on a cache miss"""
+    entryDirectory = os.path.join(self.cacheDirectory, key)
+    paths = [os.path.join(entryDirectory, 'level{0}.vtp'.format(index)) for index in range(numberOfLevels)]
+    if not all(os.path.exists(path) for path in paths):
+      return None
+    levels = []
+    for path in paths:
+      reader = vtk.vtkXMLPolyDataReader()
+      reader.SetFileName(path)
+      reader.Update()
+      if reader.GetErrorCode() != 0 or reader.GetOutput().GetNumberOfPoints() == 0:
+        logging.warning('Discarding unreadable mesh level cache entry ' + key)
+        shutil.rmtree(entryDirectory, ignore_errors=True)
+        return None
+      polyData = vtk.vtkPolyData()
+      polyData.DeepCopy(reader.GetOutput())
+      levels.append(polyData)
+    return levels
+
+  def store(self, key, levels):
+    entryDirectory = os.path.join(self.cacheDirectory, key)
+    temporaryDirectory = entryDirectory + '.tmp'
+    shutil.rmtree(temporaryDirectory, ignore_errors=True)
+    os.makedirs(temporaryDirectory)
+    for index, polyData in enumerate(levels):
+      writer = vtk.vtkXMLPolyDataWriter()
+      writer.SetFileName(os.path.join(temporaryDirectory, 'level{0}.vtp'.format(index)))
+      writer.SetInputData(polyData)
+      writer.SetDataModeToAppended()
+      writer.Write()
+    shutil.rmtree(entryDirectory, ignore_errors=True)
+    os.replace(temporaryDirectory, entryDirectory)
+
+
+class LevelOfDetailController(object):
+  """Chooses the mesh level from 3D frame times and probe motion.
+
+  While moving, the moving level is made coarser when the smoothed frame time exceeds the target and finer again
+  when the finer level was last measured well within it. When still, the finest level whose frame time stays
+  below maximumStillFrameTime is used, normally level 0.
+  """
+
+  def __init__(self, numberOfLevels, targetFrameTime=1.0 / 30.0, maximumStillFrameTime=0.25, smoothing=0.3):
+    self.numberOfLevels = numberOfLevels
+    self.targetFrameTime = targetFrameTime
+    self.maximumStillFrameTime = maximumStillFrameTime
+    self.smoothing = smoothing
+    self.reset()
+
+  def reset(self):
+    """Forget the measured frame times, for example when the meshes in the scene change"""
+    self.moving = False
+    self.movingLevel = 0
+    self.frameTimes = {}
+    self.switches = 0
+
+  @property
+  def level(self):
+    return self.movingLevel if self.moving else self.stillLevel()
+
+  def stillLevel(self):
+    for level in range(self.numberOfLevels):
+      frameTime = self.frameTimes.get(level)
+      if frameTime is None or frameTime <= self.maximumStillFrameTime:
+        return level
+    return self.numberOfLevels - 1
+
+  def setMoving(self, moving):
+    """Returns the level to show"""
+    if moving != self.moving:
+      self.moving = moving
+      self.switches += 1
+    return self.level
+
+  def addFrameTime(self, seconds):
+    """Record the duration of a 3D render made at the current level. Returns the level to show."""
+    level = self.level
+    previous = self.frameTimes.get(level)
+    self.frameTimes[level] = seconds if previous is None else previous + self.smoothing * (seconds - previous)
+    if not self.moving:
+      return self.level
+    if self.frameTimes[level] > self.targetFrameTime and self.movingLevel < self.numberOfLevels - 1:
+      self.movingLevel += 1
+    elif self.movingLevel > 0 and self.frameTimes[level] < 0.5 * self.targetFrameTime:
+      finer = self.frameTimes.get(self.movingLevel - 1)
+      if finer is None or finer < 0.8 * self.targetFrameTime:
+        self.movingLevel -= 1
+    return self.level
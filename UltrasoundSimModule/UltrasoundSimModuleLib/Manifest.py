@@ -0,0 +1,218 @@
+import os
+import re
+import json
+import hashlib
+import threading
+
+#
+# Patient manifest. Patients and their files are discovered by scanning the Resources folder (file names and
+# stat() only, no patient data is read) and the result is kept in a JSON file. A refresh re-stats the files and
+# only forgets what changed; content hashes are filled in lazily or by loaders that hash the data anyway.
+#
+
+MANIFEST_VERSION = 1
+SCENE_PATTERN = re.compile(r'^scene(\d+)\.mrb$')
+PATIENT_DIRECTORY_PATTERN = re.compile(r'^Patient_(\d+)$')
+BUNDLE_PATTERN = re.compile(r'^Patient_(\d+)\.usbundle$')
+ZONES_PATTERN = re.compile(r'^Zones(?:_(\d+))?\.seg\.nrrd$')
+
+
+def hashFile(path, blockSize=1 << 20):
+  sha = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(blockSize), b''):
+      sha.update(block)
+  return sha.hexdigest()
+
+
+class PatientManifest(object):
+  """Index of the patients in the Resources folder and their assets.
+
+  Each patient record holds 'scene', 'trus', 'zones', 'bundle' (file records or None), 'zonesVariants' (file
+  records of Zones_k.seg.nrrd, in k order) and 'derived' ({product: [file records]} found in the
+  derivedDirectories, matched by the 'Patient_N_' file name prefix). A file record is
+  {'path', 'size', 'mtime', 'sha256'} with sha256 None until it is known.
+  """
+
+  def __init__(self, resourceDirectory, manifestPath, derivedDirectories=None):
+    self.resourceDirectory = resourceDirectory
+    self.manifestPath = manifestPath
+    self.derivedDirectories = dict(derivedDirectories or {})
+    self.patients = {}
+    self.shared = {}
+    self._lock = threading.Lock()
+    self.load()
+
+  def load(self):
+    try:
+      with open(self.manifestPath) as f:
+        data = json.load(f)
+    except (IOError, OSError, ValueError):
+      return
+    if data.get('version') != MANIFEST_VERSION or data.get('resourceDirectory') != self.resourceDirectory:
+      return
+    self.patients = dict((int(patient), record) for patient, record in data.get('patients', {}).items())
+    self.shared = data.get('shared', {})
+
+  def save(self):
+    directory = os.path.dirname(self.manifestPath)
+    if directory and not os.path.exists(directory):
+      os.makedirs(directory)
+    # loaders record hashes from the prefetch thread, so the records and the file are only touched under the lock
+    with self._lock:
+      data = {'version': MANIFEST_VERSION, 'resourceDirectory': self.resourceDirectory,
+              'patients': dict((str(patient), record) for patient, record in self.patients.items()),
+              'shared': self.shared}
+      with open(self.manifestPath + '.tmp', 'w') as f:
+        json.dump(data, f, indent=1)
+      os.replace(self.manifestPath + '.tmp', self.manifestPath)
+
+  def _fileRecord(self, path, previous):
+    stat = os.stat(path)
+    if previous is not None and previous['path'] == path and previous['size'] == stat.st_size \
+        and previous['mtime'] == stat.st_mtime:
+      return previous
+    return {'path': path, 'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': None}
+
+  def _listDirectory(self, directory):
+    try:
+      return sorted(os.listdir(directory))
+    except OSError:
+      return []
+
+  def refresh(self):
+    """Rescan the Resources folder. Unchanged files keep their records (and hashes). Returns the patients whose
+    records changed and saves the manifest if anything did.
+    """
+    found = {}
+
+    def patientFiles(patient):
+      return found.setdefault(patient, {'zonesVariants': {}})
+
+    for filename in self._listDirectory(self.resourceDirectory):
+      match = SCENE_PATTERN.match(filename)
+      if match:
+        patientFiles(int(match.group(1)))['scene'] = os.path.join(self.resourceDirectory, filename)
+    zonesDirectory = os.path.join(self.resourceDirectory, 'registered_zones')
+    for directoryName in self._listDirectory(zonesDirectory):
+      match = PATIENT_DIRECTORY_PATTERN.match(directoryName)
+      if not match:
+        continue
+      files = patientFiles(int(match.group(1)))
+      patientDirectory = os.path.join(zonesDirectory, directoryName)
+      for filename in self._listDirectory(patientDirectory):
+        zonesMatch = ZONES_PATTERN.match(filename)
+        if filename == 'TRUS.nrrd':
+          files['trus'] = os.path.join(patientDirectory, filename)
+        elif zonesMatch and zonesMatch.group(1) is None:
+          files['zones'] = os.path.join(patientDirectory, filename)
+        elif zonesMatch:
+          files['zonesVariants'][int(zonesMatch.group(1))] = os.path.join(patientDirectory, filename)
+    for filename in self._listDirectory(os.path.join(self.resourceDirectory, 'bundles')):
+      match = BUNDLE_PATTERN.match(filename)
+      if match and int(match.group(1)) in found:
+        found[int(match.group(1))]['bundle'] = os.path.join(self.resourceDirectory, 'bundles', filename)
+
+    patients = {}
+    for patient, files in found.items():
+      previous = self.patients.get(patient, {})
+      record = {'name': previous.get('name', 'Patient {0}'.format(patient))}
+      for asset in ('scene', 'trus', 'zones', 'bundle'):
+        record[asset] = self._fileRecord(files[asset], previous.get(asset)) if asset in files else None
+      previousVariants = dict((variant['path'], variant) for variant in previous.get('zonesVariants', []))
+      record['zonesVariants'] = [self._fileRecord(path, previousVariants.get(path))
+                                 for variantIndex, path in sorted(files['zonesVariants'].items())]
+      record['derived'] = {}
+      for product, directory in self.derivedDirectories.items():
+        prefix = 'Patient_{0}_'.format(patient)
+        previousProducts = dict((item['path'], item) for item in previous.get('derived', {}).get(product, []))
+        paths = [os.path.join(directory, filename) for filename in self._listDirectory(directory)
+                 if filename.startswith(prefix) and not filename.endswith('.tmp')]
+        record['derived'][product] = [self._fileRecord(path, previousProducts.get(path)) for path in paths]
+      patients[patient] = record
+
+    sharedPaths = {'probeModel': os.path.join(self.resourceDirectory, 'probe_v01.stl'),
+                   'pzIntersection': os.path.join(self.resourceDirectory, 'registered_zones', 'PZ_Intersection.vtk')}
+    shared = dict((name, self._fileRecord(path, self.shared.get(name)))
+                  for name, path in sharedPaths.items() if os.path.exists(path))
+
+    with self._lock:
+      changed = sorted(patient for patient in set(patients) | set(self.patients)
+                       if patients.get(patient) != self.patients.get(patient))
+      sharedChanged = shared != self.shared
+      self.patients = patients
+      self.shared = shared
+    if changed or sharedChanged:
+      self.save()
+    return changed
+
+  def patientIds(self):
+    """Patients that have a scene or an asset bundle, in ascending order"""
+    return sorted(patient for patient, record in self.patients.items() if record['scene'] or record['bundle'])
+
+  def patientName(self, patient):
+    record = self.patients.get(patient)
+    return record['name'] if record else 'Patient {0}'.format(patient)
+
+  def assetPath(self, patient, asset):
+    """Absolute path of 'scene', 'trus', 'zones' or 'bundle', None if the patient does not have it"""
+    record = self.patients.get(patient, {}).get(asset)
+    return record['path'] if record else None
+
+  def zonesVariants(self, patient):
+    """Zone segmentation variants of a patient: 0 for Zones.seg.nrrd and k for Zones_k.seg.nrrd"""
+    record = self.patients.get(patient, {})
+    variants = [0] if record.get('zones') else []
+    return variants + [int(ZONES_PATTERN.match(os.path.basename(variant['path'])).group(1))
+                       for variant in record.get('zonesVariants', [])]
+
+  def zonesPath(self, patient, variant=0):
+    """Path of a zone segmentation variant, None if the patient does not have it"""
+    if variant == 0:
+      return self.assetPath(patient, 'zones')
+    for record in self.patients.get(patient, {}).get('zonesVariants', []):
+      if int(ZONES_PATTERN.match(os.path.basename(record['path'])).group(1)) == variant:
+        return record['path']
+    return None
+
+  def sharedAssetPath(self, name):
+    record = self.shared.get(name)
+    return record['path'] if record else None
+
+  def _records(self):
+    for record in self.patients.values():
+      for asset in ('scene', 'trus', 'zones', 'bundle'):
+        if record[asset]:
+          yield record[asset]
+      for variant in record['zonesVariants']:
+        yield variant
+    for item in self.shared.values():
+      yield item
+
+  def recordHash(self, path, contentHash):
+    """Remember the SHA-256 of a file a loader has just read, if the file is still the one in the manifest.
+    Returns True if the hash was new; the caller saves the manifest then. Safe to call from worker threads.
+    """
+    with self._lock:
+      for record in self._records():
+        if record['path'] == path and record['sha256'] != contentHash:
+          stat = os.stat(path)
+          if record['size'] == stat.st_size and record['mtime'] == stat.st_mtime:
+            record['sha256'] = contentHash
+            return True
+    return False
+
+  def contentHash(self, patient, asset):
+    """SHA-256 of a patient file, computed (and saved) the first time it is asked for"""
+    return self._contentHash(self.patients.get(patient, {}).get(asset))
+
+  def sharedContentHash(self, name):
+    return self._contentHash(self.shared.get(name))
+
+  def _contentHash(self, record):
+    if record is None:
+      return None
+    if record['sha256'] is None:
+      self.recordHash(record['path'], hashFile(record['path']))
+      self.save()
+    return record['sha256']
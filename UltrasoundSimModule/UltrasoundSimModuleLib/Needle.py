@@ -0,0 +1,115 @@
+import numpy as np
+
+from .Sampling import transformPoints, trilinearSample
+
+#
+# Biopsy needle trajectories. A trajectory is the segment the biopsy gun cuts (start to end, in RAS). It is
+# sampled at the centres of equal bins, so a zone's core length is its bin count times the bin length.
+#
+
+# typical spring-loaded biopsy gun throw
+DEFAULT_THROW = 22.0
+
+
+def trajectoriesInSlicePlanes(sliceToRas, entry, angles, depth, throw=DEFAULT_THROW):
+  """Needle segments lying in the slice planes, for every combination of slice pose and angle.
+
+  entry is the (x, y) point in slice coordinates where the needle leaves the guide, angles are in degrees from
+  the slice y axis towards x, depth is how far the needle is advanced before firing and throw the core length.
+  Returns (N * len(angles), 3) start and end points.
+  """
+  sliceToRas = np.asarray(sliceToRas, dtype=float).reshape(-1, 4, 4)
+  angles = np.radians(np.atleast_1d(np.asarray(angles, dtype=float)))
+  directions = np.zeros((len(angles), 3))
+  directions[:, 0] = np.sin(angles)
+  directions[:, 1] = np.cos(angles)
+  entry = np.array([entry[0], entry[1], 0.0])
+  startsInSlice = entry + depth * directions
+  endsInSlice = startsInSlice + throw * directions
+  starts = transformPoints(sliceToRas[:, np.newaxis], startsInSlice[np.newaxis])
+  ends = transformPoints(sliceToRas[:, np.newaxis], endsInSlice[np.newaxis])
+  return starts.reshape(-1, 3), ends.reshape(-1, 3)
+
+
+class NeedleResults(object):
+  """Zones hit by a batch of M trajectories.
+
+  labels and intensities are (M, S) samples along each trajectory. coreLengths, entryPoints and exitPoints are
+  dictionaries keyed by label value with (M,) lengths in mm and (M, 3) RAS points (nan if the zone is missed).
+  """
+
+  def __init__(self, starts, ends, labels, intensities, labelNames):
+    self.starts = starts
+    self.ends = ends
+    self.labels = labels
+    self.intensities = intensities
+    self.labelNames = labelNames
+    numberOfSamples = labels.shape[1]
+    self.binLength = np.linalg.norm(ends - starts, axis=1) / numberOfSamples
+    direction = (ends - starts) / numberOfSamples
+    self.coreLengths = {}
+    self.entryPoints = {}
+    self.exitPoints = {}
+
+    for label in labelNames:
+      inZone = labels == label
+      hit = inZone.any(axis=1)
+      first = inZone.argmax(axis=1)
+      last = numberOfSamples - 1 - inZone[:, ::-1].argmax(axis=1)
+      self.coreLengths[label] = inZone.sum(axis=1) * self.binLength
+      entryPoints = starts + first[:, np.newaxis] * direction
+      exitPoints = starts + (last + 1)[:, np.newaxis] * direction
+      entryPoints[~hit] = np.nan
+      exitPoints[~hit] = np.nan
+      self.entryPoints[label] = entryPoints
+      self.exitPoints[label] = exitPoints
+
+  def __len__(self):
+    return len(self.starts)
+
+  def zonesTraversed(self, index):
+    """Segment names along one trajectory, in the order the needle passes them"""
+    labels = self.labels[index]
+    labels = labels[np.isin(labels, list(self.labelNames))]
+    if len(labels) == 0:
+      return []
+    changes = np.flatnonzero(np.diff(labels)) + 1
+    runs = labels[np.concatenate(([0], changes))]
+    return [self.labelNames[label] for label in runs]
+
+  def summary(self, index):
+    zones = {}
+    for label, name in self.labelNames.items():
+      if self.coreLengths[label][index] > 0:
+        zones[name] = {
+          'coreLength': float(self.coreLengths[label][index]),
+          'entry': self.entryPoints[label][index].tolist(),
+          'exit': self.exitPoints[label][index].tolist(),
+        }
+    return {'zonesTraversed': self.zonesTraversed(index), 'zones': zones,
+            'meanIntensity': float(np.mean(self.intensities[index])) if self.intensities is not None else None}
+
+  def bestTrajectory(self, zone):
+    """Index of the trajectory with the longest core in a zone (label value)"""
+    return int(np.argmax(self.coreLengths[zone]))
+
+
+def simulateNeedles(zoneIndex, starts, ends, intensityVoxels=None, rasToIjk=None, sampleSpacing=0.25,
+                    chunkSize=4096):
+  """Sample the zone labels (and optionally an intensity volume) along M needle trajectories at once"""
+  starts = np.asarray(starts, dtype=float).reshape(-1, 3)
+  ends = np.asarray(ends, dtype=float).reshape(-1, 3)
+  length = np.linalg.norm(ends - starts, axis=1).max() if len(starts) else 0.0
+  numberOfSamples = max(1, int(np.ceil(length / sampleSpacing)))
+  fractions = (np.arange(numberOfSamples) + 0.5) / numberOfSamples
+
+  labels = np.empty((len(starts), numberOfSamples), dtype=zoneIndex.labels.dtype)
+  intensities = None if intensityVoxels is None else np.empty((len(starts), numberOfSamples), dtype=np.float32)
+  for first in range(0, len(starts), chunkSize):
+    chunkStarts = starts[first:first + chunkSize]
+    chunkEnds = ends[first:first + chunkSize]
+    points = chunkStarts[:, np.newaxis] + fractions[np.newaxis, :, np.newaxis] * (chunkEnds - chunkStarts)[:, np.newaxis]
+    labels[first:first + chunkSize] = zoneIndex.labelAt(points)
+    if intensities is not None:
+      intensities[first:first + chunkSize] = trilinearSample(intensityVoxels, transformPoints(rasToIjk, points))
+  return NeedleResults(starts, ends, labels, intensities, zoneIndex.labelNames)
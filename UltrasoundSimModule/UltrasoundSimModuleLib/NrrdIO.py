@@ -0,0 +1,125 @@
+import re
+import hashlib
+import zlib
+import bz2
+import numpy as np
+
+#
+# Minimal NRRD reader. Only needs numpy, so it can decode patient volumes on worker threads and processes
+# where the MRML scene must not be touched.
+#
+
+NRRD_TYPES = {
+  'signed char': 'i1', 'int8': 'i1', 'int8_t': 'i1',
+  'uchar': 'u1', 'unsigned char': 'u1', 'uint8': 'u1', 'uint8_t': 'u1',
+  'short': 'i2', 'short int': 'i2', 'signed short': 'i2', 'signed short int': 'i2', 'int16': 'i2', 'int16_t': 'i2',
+  'ushort': 'u2', 'unsigned short': 'u2', 'unsigned short int': 'u2', 'uint16': 'u2', 'uint16_t': 'u2',
+  'int': 'i4', 'signed int': 'i4', 'int32': 'i4', 'int32_t': 'i4',
+  'uint': 'u4', 'unsigned int': 'u4', 'uint32': 'u4', 'uint32_t': 'u4',
+  'longlong': 'i8', 'long long': 'i8', 'long long int': 'i8', 'signed long long': 'i8',
+  'signed long long int': 'i8', 'int64': 'i8', 'int64_t': 'i8',
+  'ulonglong': 'u8', 'unsigned long long': 'u8', 'unsigned long long int': 'u8', 'uint64': 'u8', 'uint64_t': 'u8',
+  'float': 'f4', 'double': 'f8',
+}
+
+# spaces whose first two axes point the opposite way to RAS
+LPS_SPACES = ('left-posterior-superior', 'lps')
+
+
+class NrrdVolume(object):
+  """Decoded NRRD file: voxels in KJI order (same as slicer.util.arrayFromVolume), IJK to RAS matrix,
+  header fields and the SHA-256 of the file contents.
+  """
+
+  def __init__(self, voxels, ijkToRas, header, contentHash):
+    self.voxels = voxels
+    self.ijkToRas = ijkToRas
+    self.header = header
+    self.contentHash = contentHash
+
+  @property
+  def spacing(self):
+    return np.linalg.norm(self.ijkToRas[:3, :3], axis=0)
+
+  def labelVoxels(self):
+    """Voxels as integer labels. Some zone files are stored as float, with resampling noise around the labels."""
+    if self.voxels.dtype.kind == 'f':
+      return np.rint(self.voxels).astype(np.int16)
+    return self.voxels
+
+  def segmentNames(self):
+    """Map label value to segment name for .seg.nrrd files"""
+    return segmentNames(self.header)
+
+
+def _parseVector(text):
+  return [float(v) for v in text.strip().strip('()').split(',')]
+
+
+def parseHeader(data):
+  """Split raw file contents into a header dictionary and the (still encoded) data bytes"""
+  end = data.find(b'\n\n')
+  if not data.startswith(b'NRRD') or end < 0:
+    raise ValueError('Not an attached-header NRRD file')
+  header = {}
+  for line in data[:end].decode('latin-1').splitlines()[1:]:
+    if not line or line.startswith('#'):
+      continue
+    if ':=' in line:
+      key, value = line.split(':=', 1)
+    else:
+      key, value = line.split(':', 1)
+    header[key.strip()] = value.strip()
+  return header, data[end + 2:]
+
+
+def segmentNames(header):
+  names = {}
+  index = 0
+  while 'Segment{0}_LabelValue'.format(index) in header:
+    label = int(header['Segment{0}_LabelValue'.format(index)])
+    names[label] = header.get('Segment{0}_Name'.format(index), str(label))
+    index += 1
+  return names
+
+
+def readNrrd(path):
+  with open(path, 'rb') as f:
+    return decodeNrrd(f.read())
+
+
+def decodeNrrd(data):
+  contentHash = hashlib.sha256(data).hexdigest()
+  header, payload = parseHeader(data)
+  if 'data file' in header or 'datafile' in header:
+    raise ValueError('Detached NRRD data files are not supported')
+
+  encoding = header.get('encoding', 'raw')
+  if encoding in ('gzip', 'gz'):
+    payload = zlib.decompress(payload, 16 + zlib.MAX_WBITS)
+  elif encoding in ('bzip2', 'bz2'):
+    payload = bz2.decompress(payload)
+  elif encoding != 'raw':
+    raise ValueError('Unsupported NRRD encoding: ' + encoding)
+
+  dtype = np.dtype(NRRD_TYPES[header['type']])
+  if dtype.itemsize > 1:
+    dtype = dtype.newbyteorder('<' if header.get('endian', 'little') == 'little' else '>')
+  sizes = [int(s) for s in header['sizes'].split()]
+  voxels = np.frombuffer(payload, dtype=dtype, count=int(np.prod(sizes))).reshape(sizes[::-1])
+
+  ijkToRas = np.eye(4)
+  if 'space directions' in header:
+    # 'none' marks non-spatial axes such as segment layers
+    directions = re.findall(r'\(([^)]*)\)', header['space directions'])
+    for column, direction in enumerate(directions[:3]):
+      ijkToRas[:3, column] = _parseVector(direction)
+  elif 'spacings' in header:
+    spacings = [float(s) for s in header['spacings'].split() if s.lower() != 'nan']
+    ijkToRas[:3, :3] = np.diag(spacings[:3])
+  if 'space origin' in header:
+    ijkToRas[:3, 3] = _parseVector(header['space origin'])
+  if header.get('space', '').lower() in LPS_SPACES:
+    ijkToRas[:2, :] *= -1
+
+  return NrrdVolume(voxels, ijkToRas, header, contentHash)
@@ -0,0 +1,64 @@
+import os
+import sys
+import multiprocessing
+import concurrent.futures
+from multiprocessing import shared_memory
+import numpy as np
+
+#
+# Process pool helpers. Workers are spawned (not forked) so they never inherit the Qt/MRML state of the Slicer
+# application, and large read-only arrays are handed to them through shared memory instead of being pickled.
+#
+
+def processContext():
+  """Spawn context whose workers run a plain Python interpreter, also when called from inside Slicer"""
+  context = multiprocessing.get_context('spawn')
+  executableName = os.path.basename(sys.executable).lower()
+  if not executableName.startswith('python'):
+    # inside the Slicer application sys.executable is the application itself, workers need PythonSlicer
+    pythonSlicer = os.path.join(os.path.dirname(sys.executable), 'PythonSlicer' + ('.exe' if os.name == 'nt' else ''))
+    if os.path.exists(pythonSlicer):
+      context.set_executable(pythonSlicer)
+  return context
+
+
+def defaultNumberOfProcesses():
+  return max(1, (os.cpu_count() or 1) - 1)
+
+
+def createProcessPool(numberOfProcesses, initializer=None, initargs=()):
+  return concurrent.futures.ProcessPoolExecutor(max_workers=numberOfProcesses, mp_context=processContext(),
+                                                initializer=initializer, initargs=initargs)
+
+
+class SharedArray(object):
+  """Numpy array in a named shared memory block. The owner creates it from an array and must call release();
+  workers attach with the descriptor returned by descriptor().
+  """
+
+  def __init__(self, memory, shape, dtype, owner):
+    self.memory = memory
+    self.array = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+    self.owner = owner
+
+  @classmethod
+  def fromArray(cls, array):
+    array = np.ascontiguousarray(array)
+    memory = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    shared = cls(memory, array.shape, array.dtype, True)
+    shared.array[...] = array
+    return shared
+
+  @classmethod
+  def attach(cls, descriptor):
+    name, shape, dtype = descriptor
+    return cls(shared_memory.SharedMemory(name=name), shape, np.dtype(dtype), False)
+
+  def descriptor(self):
+    return (self.memory.name, self.array.shape, self.array.dtype.str)
+
+  def release(self):
+    self.array = None
+    self.memory.close()
+    if self.owner:
+      self.memory.unlink()
@@ -0,0 +1,118 @@
+import math
+import numpy as np
+
+#
+# Probe pose engine. Pitch (up/down) and yaw (left/right) are kept as step counters and the RotatedToProbeModel
+# and ImageToProbe matrices are built in closed form as T(-c) * Rx(pitch) * Ry(yaw) * T(c), which is what the
+# concatenated vtkTransforms used to compute.
+#
+
+PROBE_CENTER_OF_ROTATION = (8.0, 4.0, -150.0)
+IMAGE_CENTER_OF_ROTATION = (0.0, 20.0, 90.0)
+
+
+def rotationsAboutCenter(pitchDegrees, yawDegrees, center):
+  """Return (N,4,4) matrices rotating by pitch about X, then yaw about Y, around the given center"""
+  pitch = np.radians(np.asarray(pitchDegrees, dtype=float).ravel())
+  yaw = np.radians(np.asarray(yawDegrees, dtype=float).ravel())
+  cx, sx = np.cos(pitch), np.sin(pitch)
+  cy, sy = np.cos(yaw), np.sin(yaw)
+
+  matrices = np.zeros((len(pitch), 4, 4))
+  matrices[:, 0, 0] = cy
+  matrices[:, 0, 2] = sy
+  matrices[:, 1, 0] = sx * sy
+  matrices[:, 1, 1] = cx
+  matrices[:, 1, 2] = -sx * cy
+  matrices[:, 2, 0] = -cx * sy
+  matrices[:, 2, 1] = sx
+  matrices[:, 2, 2] = cx * cy
+  matrices[:, 3, 3] = 1.0
+  center = np.asarray(center, dtype=float)
+  matrices[:, :3, 3] = matrices[:, :3, :3].dot(center) - center
+  return matrices
+
+
+def _fillRotationAboutCenter(matrix, pitchDegrees, yawDegrees, center):
+  """Scalar version of rotationsAboutCenter that writes into an existing 4x4 array without allocating"""
+  cx, sx = math.cos(math.radians(pitchDegrees)), math.sin(math.radians(pitchDegrees))
+  cy, sy = math.cos(math.radians(yawDegrees)), math.sin(math.radians(yawDegrees))
+  rows = ((cy, 0.0, sy), (sx * sy, cx, -sx * cy), (-cx * sy, sx, cx * cy))
+  for row in range(3):
+    r0, r1, r2 = rows[row]
+    matrix[row, 0] = r0
+    matrix[row, 1] = r1
+    matrix[row, 2] = r2
+    matrix[row, 3] = r0 * center[0] + r1 * center[1] + r2 * center[2] - center[row]
+
+
+class ProbePoseEngine(object):
+  """Explicit pitch/yaw state of the probe and the transforms that follow from it"""
+
+  PITCH_STEP_DEGREES = 2.0
+  YAW_STEP_DEGREES = 1.0
+  # the image turns faster than the probe model when yawing
+  IMAGE_YAW_STEP_DEGREES = 1.5
+  # Do not allow the user to move the probe more than this many steps in one direction when there is no
+  # anatomy to check the poses against
+  MAXIMUM_PITCH_STEPS = 2
+  MAXIMUM_YAW_STEPS = 7
+  # mechanical range of the stepper, the poses within it are checked by the pose validator
+  RANGE_PITCH_STEPS = 10
+  RANGE_YAW_STEPS = 30
+
+  def __init__(self):
+    self.pitchSteps = 0
+    self.yawSteps = 0
+    # callable(pitchSteps, yawSteps, newPitchSteps, newYawSteps) that accepts or rejects a step, see Constraints
+    self.poseValidator = None
+    self.rotatedToProbeModel = np.eye(4)
+    self.imageToProbe = np.eye(4)
+
+  def reset(self):
+    self.pitchSteps = 0
+    self.yawSteps = 0
+    self._update()
+
+  def stepRange(self):
+    """Largest number of pitch and yaw steps in one direction"""
+    if self.poseValidator is None:
+      return self.MAXIMUM_PITCH_STEPS, self.MAXIMUM_YAW_STEPS
+    return self.RANGE_PITCH_STEPS, self.RANGE_YAW_STEPS
+
+  def canStep(self, pitch=0, yaw=0):
+    pitchSteps, yawSteps = self.pitchSteps + pitch, self.yawSteps + yaw
+    maximumPitchSteps, maximumYawSteps = self.stepRange()
+    if abs(pitchSteps) > maximumPitchSteps or abs(yawSteps) > maximumYawSteps:
+      return False
+    return self.poseValidator is None or bool(self.poseValidator(self.pitchSteps, self.yawSteps, pitchSteps, yawSteps))
+
+  def step(self, pitch=0, yaw=0):
+    """Move by the given number of steps. Returns False and leaves the pose unchanged if a limit would be passed."""
+    if not self.canStep(pitch, yaw):
+      return False
+    self.pitchSteps += pitch
+    self.yawSteps += yaw
+    self._update()
+    return True
+
+  def setSteps(self, pitchSteps, yawSteps):
+    self.pitchSteps = pitchSteps
+    self.yawSteps = yawSteps
+    self._update()
+
+  def _update(self):
+    _fillRotationAboutCenter(self.rotatedToProbeModel, self.pitchSteps * self.PITCH_STEP_DEGREES,
+                             self.yawSteps * self.YAW_STEP_DEGREES, PROBE_CENTER_OF_ROTATION)
+    _fillRotationAboutCenter(self.imageToProbe, self.pitchSteps * self.PITCH_STEP_DEGREES,
+                             self.yawSteps * self.IMAGE_YAW_STEP_DEGREES, IMAGE_CENTER_OF_ROTATION)
+
+  def batchMatrices(self, pitchSteps, yawSteps):
+    """Return (N,4,4) RotatedToProbeModel and ImageToProbe matrices for arrays of step counts"""
+    pitchDegrees = np.asarray(pitchSteps, dtype=float) * self.PITCH_STEP_DEGREES
+    yawSteps = np.asarray(yawSteps, dtype=float)
+    rotatedToProbeModel = rotationsAboutCenter(pitchDegrees, yawSteps * self.YAW_STEP_DEGREES,
+                                               PROBE_CENTER_OF_ROTATION)
+    imageToProbe = rotationsAboutCenter(pitchDegrees, yawSteps * self.IMAGE_YAW_STEP_DEGREES,
+                                        IMAGE_CENTER_OF_ROTATION)
+    return rotatedToProbeModel, imageToProbe
@@ -0,0 +1,45 @@
+import numpy as np
+
+#
+# Resolution pyramid of a volume. Each level averages factor x factor x factor blocks of voxels; the IJK to RAS
+# matrix is adjusted so that every coarse voxel sits at the centre of the block it was averaged from.
+#
+
+PYRAMID_FACTORS = (2, 4)
+
+
+def downsampleVolume(voxels, ijkToRas, factor):
+  """Block-average a [k, j, i] voxel array by factor along every axis that is at least factor voxels long.
+  Returns the coarse voxels (same dtype) and their IJK to RAS matrix.
+  """
+  factors = [factor if size >= factor else 1 for size in voxels.shape]
+  # replicate edge voxels so that every axis divides evenly
+  padding = [(0, (-size) % f) for size, f in zip(voxels.shape, factors)]
+  padded = np.pad(voxels, padding, mode='edge') if any(after for before, after in padding) else voxels
+  shape = padded.shape
+  blocks = padded.reshape(shape[0] // factors[0], factors[0], shape[1] // factors[1], factors[1],
+                          shape[2] // factors[2], factors[2])
+  coarse = blocks.mean(axis=(1, 3, 5), dtype=np.float32)
+  if voxels.dtype.kind in 'iu':
+    coarse = np.rint(coarse)
+  coarse = coarse.astype(voxels.dtype)
+
+  # factors are in K, J, I order, matrix columns in I, J, K order
+  scale = np.array(factors[::-1], dtype=float)
+  coarseIjkToRas = np.array(ijkToRas, dtype=float)
+  coarseIjkToRas[:3, 3] += coarseIjkToRas[:3, :3].dot(0.5 * (scale - 1))
+  coarseIjkToRas[:3, :3] *= scale
+  return coarse, coarseIjkToRas
+
+
+def buildPyramid(voxels, ijkToRas, factors=PYRAMID_FACTORS):
+  """Return [(factor, voxels, ijkToRas)] for each factor, each level computed from the previous one"""
+  levels = []
+  previousFactor, previousVoxels, previousIjkToRas = 1, voxels, ijkToRas
+  for factor in sorted(factors):
+    if factor % previousFactor:
+      previousFactor, previousVoxels, previousIjkToRas = 1, voxels, ijkToRas
+    levelVoxels, levelIjkToRas = downsampleVolume(previousVoxels, previousIjkToRas, factor // previousFactor)
+    levels.append((factor, levelVoxels, levelIjkToRas))
+    previousFactor, previousVoxels, previousIjkToRas = factor, levelVoxels, levelIjkToRas
+  return levels
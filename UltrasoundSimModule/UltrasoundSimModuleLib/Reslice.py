@@ -0,0 +1,80 @@
+import numpy as np
+
+from .Sampling import trilinearSample
+from .Parallel import SharedArray, createProcessPool
+
+#
+# Headless TRUS reslicing. A slice is sampled on a regular grid in the SliceToImage plane, centred on its
+# origin like the Yellow slice view, for a whole stack of probe poses at once.
+#
+
+def sliceToRasMatrices(imageToProbe, probeToReference, referenceToRas=None, sliceToImage=None):
+  """Compose ReferenceToRAS * ProbeToReference * ImageToProbe * SliceToImage for (N,4,4) or (4,4) inputs"""
+  imageToProbe = np.asarray(imageToProbe, dtype=float).reshape(-1, 4, 4)
+  probeToReference = np.asarray(probeToReference, dtype=float).reshape(-1, 4, 4)
+  referenceToRas = np.eye(4) if referenceToRas is None else np.asarray(referenceToRas, dtype=float)
+  sliceToImage = np.eye(4) if sliceToImage is None else np.asarray(sliceToImage, dtype=float)
+  return np.matmul(np.matmul(referenceToRas, probeToReference), np.matmul(imageToProbe, sliceToImage))
+
+
+def slicePixelPoints(outputSize, outputSpacing):
+  """(rows, columns, 3) slice plane coordinates of the output pixels"""
+  columns, rows = outputSize
+  x = (np.arange(columns) - 0.5 * (columns - 1)) * outputSpacing[0]
+  y = (np.arange(rows) - 0.5 * (rows - 1)) * outputSpacing[1]
+  points = np.zeros((rows, columns, 3))
+  points[..., 0] = x[np.newaxis, :]
+  points[..., 1] = y[:, np.newaxis]
+  return points
+
+
+def resliceChunk(voxels, rasToIjk, sliceToRas, outputSize, outputSpacing, fillValue=0.0):
+  """Resample one (N,4,4) chunk of slice poses, returns (N, rows, columns) float32"""
+  pixels = slicePixelPoints(outputSize, outputSpacing)
+  sliceToIjk = np.matmul(rasToIjk, sliceToRas)
+  # only x and y are non-zero in the plane: ijk = M[:, :, 0] * x + M[:, :, 1] * y + M[:, :, 3]
+  ijk = (np.einsum('nc,rw->nrwc', sliceToIjk[:, :3, 0], pixels[..., 0])
+         + np.einsum('nc,rw->nrwc', sliceToIjk[:, :3, 1], pixels[..., 1])
+         + sliceToIjk[:, np.newaxis, np.newaxis, :3, 3])
+  return trilinearSample(voxels, ijk, fillValue)
+
+
+_workerVolume = None
+
+
+def _attachVolume(descriptor):
+  global _workerVolume
+  _workerVolume = SharedArray.attach(descriptor)
+
+
+def _resliceSharedChunk(rasToIjk, sliceToRas, outputSize, outputSpacing, fillValue):
+  return resliceChunk(_workerVolume.array, rasToIjk, sliceToRas, outputSize, outputSpacing, fillValue)
+
+
+def resliceStack(voxels, rasToIjk, sliceToRas, outputSize, outputSpacing, fillValue=0.0,
+                 numberOfProcesses=1, chunkSize=32):
+  """Resample the volume for every slice pose. With numberOfProcesses > 1 chunks of poses are distributed to a
+  process pool that reads the volume from shared memory.
+  """
+  sliceToRas = np.asarray(sliceToRas, dtype=float).reshape(-1, 4, 4)
+  rasToIjk = np.asarray(rasToIjk, dtype=float)
+  columns, rows = outputSize
+  images = np.empty((len(sliceToRas), rows, columns), dtype=np.float32)
+  starts = range(0, len(sliceToRas), chunkSize)
+
+  if numberOfProcesses <= 1 or len(sliceToRas) <= chunkSize:
+    for start in starts:
+      images[start:start + chunkSize] = resliceChunk(voxels, rasToIjk, sliceToRas[start:start + chunkSize],
+                                                     outputSize, outputSpacing, fillValue)
+    return images
+
+  sharedVolume = SharedArray.fromArray(voxels)
+  try:
+    with createProcessPool(numberOfProcesses, _attachVolume, (sharedVolume.descriptor(),)) as pool:
+      futures = [(start, pool.submit(_resliceSharedChunk, rasToIjk, sliceToRas[start:start + chunkSize],
+                                     outputSize, outputSpacing, fillValue)) for start in starts]
+      for start, future in futures:
+        images[start:start + chunkSize] = future.result()
+  finally:
+    sharedVolume.release()
+  return images
@@ -0,0 +1,64 @@
+import numpy as np
+
+#
+# Vectorized sampling of voxel arrays. Arrays are indexed [k, j, i] like slicer.util.arrayFromVolume and
+# points are given in continuous I, J, K voxel coordinates.
+#
+
+def transformPoints(matrix, points):
+  """Apply a 4x4 matrix (or a stack of them broadcastable against points) to (..., 3) points"""
+  points = np.asarray(points, dtype=float)
+  matrix = np.asarray(matrix, dtype=float)
+  return np.einsum('...ij,...j->...i', matrix[..., :3, :3], points) + matrix[..., :3, 3]
+
+
+def _cornerOffsets(shape):
+  """Index offsets of the +i, +j and +k neighbours in the flattened array, 0 along axes of size 1"""
+  return (1 if shape[2] > 1 else 0,
+          shape[2] if shape[1] > 1 else 0,
+          shape[1] * shape[2] if shape[0] > 1 else 0)
+
+
+def _insideMask(shape, ijk):
+  return ((ijk[..., 0] >= -0.5) & (ijk[..., 0] <= shape[2] - 0.5)
+          & (ijk[..., 1] >= -0.5) & (ijk[..., 1] <= shape[1] - 0.5)
+          & (ijk[..., 2] >= -0.5) & (ijk[..., 2] <= shape[0] - 0.5))
+
+
+def nearestSample(voxels, ijk, fillValue=0):
+  """Value of the nearest voxel for each point, fillValue outside of the volume"""
+  shape = voxels.shape
+  ijk = np.asarray(ijk)
+  inside = _insideMask(shape, ijk)
+  index = np.rint(ijk).astype(np.intp)
+  np.clip(index[..., 0], 0, shape[2] - 1, out=index[..., 0])
+  np.clip(index[..., 1], 0, shape[1] - 1, out=index[..., 1])
+  np.clip(index[..., 2], 0, shape[0] - 1, out=index[..., 2])
+  values = voxels[index[..., 2], index[..., 1], index[..., 0]]
+  return np.where(inside, values, np.asarray(fillValue, dtype=voxels.dtype))
+
+
+def trilinearSample(voxels, ijk, fillValue=0.0, dtype=np.float32):
+  """Trilinearly interpolated value for each point, fillValue outside of the volume"""
+  shape = voxels.shape
+  ijk = np.asarray(ijk)
+  inside = _insideMask(shape, ijk)
+  flat = voxels.reshape(-1)
+  di, dj, dk = _cornerOffsets(shape)
+
+  base = []
+  weights = []
+  for axis, size in ((0, shape[2]), (1, shape[1]), (2, shape[0])):
+    coordinate = np.clip(ijk[..., axis], 0, size - 1)
+    lower = np.minimum(np.floor(coordinate).astype(np.intp), max(size - 2, 0))
+    base.append(lower)
+    weights.append((coordinate - lower).astype(dtype))
+  index = (base[2] * shape[1] + base[1]) * shape[2] + base[0]
+  wi, wj, wk = weights
+
+  c00 = flat[index] * (1 - wi) + flat[index + di] * wi
+  c10 = flat[index + dj] * (1 - wi) + flat[index + dj + di] * wi
+  c01 = flat[index + dk] * (1 - wi) + flat[index + dk + di] * wi
+  c11 = flat[index + dk + dj] * (1 - wi) + flat[index + dk + dj + di] * wi
+  values = (c00 * (1 - wj) + c10 * wj) * (1 - wk) + (c01 * (1 - wj) + c11 * wj) * wk
+  return np.where(inside, values, dtype(fillValue)).astype(dtype, copy=False)
@@ -0,0 +1,214 @@
+import os
+import logging
+import zipfile
+import collections
+import concurrent.futures
+
+from .NrrdIO import readNrrd
+from .AssetBundle import AssetBundle, BUNDLE_EXTENSION
+
+#
+# Per-patient scene cache. File decoding (unzipping the .mrb, decompressing the .nrrd volumes) runs on a
+# background worker. MRML nodes are only ever created and removed by the caller on the main thread.
+#
+
+class PatientAssets(object):
+  """Decoded files for one patient, ready to be turned into MRML nodes"""
+
+  def __init__(self, patient):
+    self.patient = patient
+    self.mrmlPath = None
+    self.bundle = None
+    self.trus = None
+    self.zones = None
+    self.zonesPath = None
+
+
+class PatientSceneEntry(object):
+  """MRML nodes of one patient that are kept resident in the scene, looked up by node name"""
+
+  def __init__(self, patient):
+    self.patient = patient
+    self.nodeIDs = {}
+    self.memorySize = 0
+    self.zoneIndex = None
+    self.zonesPath = None
+    self.zonesHash = None
+    self.tissueMap = None
+    self.signedDistanceField = None
+    # decimated closed surfaces, one list of levels per segment
+    self.meshLevels = []
+
+
+class PatientSceneCache(object):
+  """LRU cache of patient node sets with a memory budget and background prefetch of patient files.
+
+  resourcePath is a callable that maps a path relative to the module Resources folder to an absolute path.
+  With a PatientManifest, file paths come from the manifest instead of the naming convention. The zone
+  segmentation is Zones.seg.nrrd unless another Zones_k variant was selected with setZonesVariant().
+  """
+
+  def __init__(self, resourcePath, extractDirectory, maximumEntries=4, memoryBudgetMB=1024, manifest=None):
+    self.resourcePath = resourcePath
+    self.manifest = manifest
+    self.extractDirectory = extractDirectory
+    self.maximumEntries = maximumEntries
+    self.memoryBudgetMB = memoryBudgetMB
+    self._entries = collections.OrderedDict()
+    self._pending = {}
+    self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    self.zonesVariants = {}
+
+  def assetPath(self, patient, asset):
+    """Path of a patient's 'scene', 'trus', 'zones' or 'bundle' file, None if it does not exist"""
+    variant = self.zonesVariant(patient)
+    if self.manifest is not None:
+      return self.manifest.zonesPath(patient, variant) if asset == 'zones' else self.manifest.assetPath(patient, asset)
+    zonesFilename = 'Zones_{0}.seg.nrrd'.format(variant) if variant else 'Zones.seg.nrrd'
+    path = {'scene': self.scenePath, 'bundle': self.bundlePath}.get(asset)
+    path = path(patient) if path else self.patientPath(patient, {'trus': 'TRUS.nrrd', 'zones': zonesFilename}[asset])
+    return path if os.path.exists(path) else None
+
+  def zonesVariant(self, patient):
+    return self.zonesVariants.get(patient, 0)
+
+  def setZonesVariant(self, patient, variant):
+    """Use Zones_<variant>.seg.nrrd (0 for Zones.seg.nrrd) the next time the patient is decoded. Asset bundles
+    only hold the default zones, so they are not used for other variants.
+    """
+    self.zonesVariants[patient] = variant
+    future = self._pending.pop(patient, None)
+    if future is not None:
+      future.cancel()
+
+  def scenePath(self, patient):
+    return self.resourcePath('scene' + str(patient) + '.mrb')
+
+  def patientPath(self, patient, filename):
+    return self.resourcePath('registered_zones/Patient_' + str(patient) + '/' + filename)
+
+  def bundlePath(self, patient):
+    return self.resourcePath('bundles/Patient_' + str(patient) + BUNDLE_EXTENSION)
+
+  def readZones(self, zonesPath):
+    zones = readNrrd(zonesPath)
+    # the hash comes for free with the decode
+    if self.manifest is not None and self.manifest.recordHash(zonesPath, zones.contentHash):
+      self.manifest.save()
+    return zones
+
+  def extractScene(self, patient):
+    """Unzip the patient scene bundle once and return the path of its .mrml file"""
+    scenePath = self.assetPath(patient, 'scene')
+    if scenePath is None:
+      raise IOError('No scene for patient {0}'.format(patient))
+    stat = os.stat(scenePath)
+    stamp = '{0} {1}'.format(stat.st_size, int(stat.st_mtime))
+    targetDirectory = os.path.join(self.extractDirectory, 'scene' + str(patient))
+    stampPath = os.path.join(targetDirectory, 'stamp.txt')
+
+    currentStamp = None
+    if os.path.exists(stampPath):
+      with open(stampPath) as f:
+        currentStamp = f.read()
+    if currentStamp != stamp:
+      with zipfile.ZipFile(scenePath) as bundle:
+        bundle.extractall(targetDirectory)
+      with open(stampPath, 'w') as f:
+        f.write(stamp)
+
+    for root, dirs, files in os.walk(targetDirectory):
+      for filename in files:
+        if filename.endswith('.mrml'):
+          return os.path.join(root, filename)
+    raise IOError('No .mrml file in ' + scenePath)
+
+  def decodePatient(self, patient, useBundle=True):
+    """Read everything needed for a patient without touching the MRML scene. Safe to run on a worker thread.
+    An asset bundle of the patient is memory-mapped instead of decoding the .mrb and .nrrd files.
+    """
+    assets = PatientAssets(patient)
+    bundlePath = self.assetPath(patient, 'bundle')
+    if useBundle and bundlePath is not None and self.zonesVariant(patient) == 0:
+      assets.bundle = AssetBundle(bundlePath)
+      volumes = assets.bundle.metadata['volumes']
+      assets.trus = assets.bundle.volume('TRUS') if 'TRUS' in volumes else None
+      assets.zones = assets.bundle.volume('Zones') if 'Zones' in volumes else None
+      assets.zonesPath = assets.bundle.metadata.get('zonesPath')
+      return assets
+
+    assets.mrmlPath = self.extractScene(patient)
+    trusPath = self.assetPath(patient, 'trus')
+    if trusPath is not None:
+      assets.trus = readNrrd(trusPath)
+    assets.zonesPath = self.assetPath(patient, 'zones')
+    if assets.zonesPath is not None:
+      assets.zones = self.readZones(assets.zonesPath)
+    return assets
+
+  def decodeZones(self, patient, useBundle=True):
+    """Only the zone segmentation of a patient, as (NrrdVolume or None, zones path)"""
+    bundlePath = self.assetPath(patient, 'bundle')
+    if useBundle and bundlePath is not None and self.zonesVariant(patient) == 0:
+      bundle = AssetBundle(bundlePath)
+      if 'Zones' in bundle.metadata['volumes']:
+        return bundle.volume('Zones'), bundle.metadata.get('zonesPath')
+    zonesPath = self.assetPath(patient, 'zones')
+    return (self.readZones(zonesPath) if zonesPath is not None else None), zonesPath
+
+  def prefetch(self, patients):
+    """Start decoding patients in the background unless they are already resident or queued"""
+    for patient in patients:
+      if patient in self._entries or patient in self._pending:
+        continue
+      if self.assetPath(patient, 'scene') is None and self.assetPath(patient, 'bundle') is None:
+        continue
+      self._pending[patient] = self._executor.submit(self.decodePatient, patient)
+
+  def takeAssets(self, patient):
+    """Return decoded assets for a patient, waiting for a running prefetch or decoding right away"""
+    future = self._pending.pop(patient, None)
+    if future is not None:
+      try:
+        return future.result()
+      except Exception as e:
+        logging.warning('Prefetch of patient {0} failed, retrying: {1}'.format(patient, e))
+    return self.decodePatient(patient)
+
+  def getEntry(self, patient):
+    entry = self._entries.get(patient)
+    if entry is not None:
+      self._entries.move_to_end(patient)
+    return entry
+
+  def addEntry(self, entry):
+    self._entries[entry.patient] = entry
+    self._entries.move_to_end(entry.patient)
+
+  def removeEntry(self, patient):
+    return self._entries.pop(patient, None)
+
+  def entries(self):
+    return list(self._entries.values())
+
+  def memorySize(self):
+    return sum(entry.memorySize for entry in self._entries.values())
+
+  def evict(self, keepPatients=()):
+    """Drop least recently used entries, other than those of keepPatients, until the cache fits its limits.
+    Returns the evicted entries so that the caller can remove their nodes from the scene.
+    """
+    evicted = []
+    budget = self.memoryBudgetMB * 1024 * 1024
+    while len(self._entries) > 1 and (len(self._entries) > self.maximumEntries or self.memorySize() > budget):
+      patient = next((patient for patient in self._entries if patient not in keepPatients), None)
+      if patient is None:
+        break
+      evicted.append(self._entries.pop(patient))
+    return evicted
+
+  def shutdown(self):
+    for future in self._pending.values():
+      future.cancel()
+    self._pending.clear()
+    self._executor.shutdown(wait=False)
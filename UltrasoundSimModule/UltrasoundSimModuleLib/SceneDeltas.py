@@ -0,0 +1,184 @@
+import os
+import re
+import threading
+import concurrent.futures
+import numpy as np
+
+#
+# Incremental saving of the editable state of a patient scene. The state is a flat dictionary of named numpy
+# arrays (transform matrices, fiducial points, session state). A save compares the items with what was last
+# saved and writes only the changed and removed ones as a numbered delta file on a background thread:
+#
+#   <directory>/Patient_N/base.npz          state folded in by the last compaction
+#   <directory>/Patient_N/delta_000007.npz  items changed by one save, plus __removed__ (names of removed items)
+#
+# Loading applies the base and then the deltas in order. Files are written to a .tmp name and renamed, so a
+# save that is interrupted never leaves a half written delta behind. If a write fails, the next save compares
+# against what is actually on disk again, so the changes of the failed delta are written with it.
+#
+
+DELTA_PATTERN = re.compile(r'^delta_(\d+)\.npz$')
+REMOVED_ITEMS = '__removed__'
+
+
+def _readItems(path):
+  with np.load(path, allow_pickle=False) as data:
+    items = dict((name, data[name]) for name in data.files)
+  removed = items.pop(REMOVED_ITEMS, np.zeros(0, dtype=str))
+  return items, [str(name) for name in removed]
+
+
+def _writeItems(path, items, removed=()):
+  arrays = dict(items)
+  arrays[REMOVED_ITEMS] = np.array(sorted(removed), dtype=str)
+  with open(path + '.tmp', 'wb') as f:
+    np.savez(f, **arrays)
+  os.replace(path + '.tmp', path)
+
+
+def itemsEqual(a, b):
+  return a.dtype == b.dtype and a.shape == b.shape and np.array_equal(a, b)
+
+
+class SceneDeltaStore(object):
+  """Delta files of the patients' saved scene state in one directory.
+
+  save() is called on the main thread with the current items; it only compares small arrays and hands the
+  changes to a single writer thread, which encodes and writes them, so the deltas of a patient are always
+  written in order.
+  """
+
+  def __init__(self, directory):
+    self.directory = directory
+    self._saved = {}
+    self._nextSequence = {}
+    self._lock = threading.Lock()
+    self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    self._pending = []
+    # patients whose in-memory baseline includes a delta that failed to write
+    self._stale = set()
+
+  def patientDirectory(self, patient):
+    return os.path.join(self.directory, 'Patient_{0}'.format(patient))
+
+  def deltaPaths(self, patient):
+    """(sequence number, path) of the patient's delta files, in save order"""
+    directory = self.patientDirectory(patient)
+    try:
+      filenames = os.listdir(directory)
+    except OSError:
+      return []
+    deltas = [(int(match.group(1)), os.path.join(directory, filename))
+              for filename, match in ((filename, DELTA_PATTERN.match(filename)) for filename in filenames) if match]
+    return sorted(deltas)
+
+  def hasSavedState(self, patient):
+    return bool(self.deltaPaths(patient)) or os.path.exists(os.path.join(self.patientDirectory(patient), 'base.npz'))
+
+  def load(self, patient):
+    """Saved items of a patient: the base with all deltas applied"""
+    self.wait()
+    return self._read(patient)
+
+  def _read(self, patient):
+    items = {}
+    basePath = os.path.join(self.patientDirectory(patient), 'base.npz')
+    if os.path.exists(basePath):
+      items, removed = _readItems(basePath)
+    for sequence, path in self.deltaPaths(patient):
+      changed, removed = _readItems(path)
+      for name in removed:
+        items.pop(name, None)
+      items.update(changed)
+    return items
+
+  def _baseline(self, patient):
+    with self._lock:
+      if patient in self._stale:
+        self._stale.discard(patient)
+        self._saved.pop(patient, None)
+    saved = self._saved.get(patient)
+    if saved is None:
+      # failed writes were reported through their futures already
+      self.wait(raiseErrors=False)
+      saved = self._saved[patient] = self._read(patient)
+      deltas = self.deltaPaths(patient)
+      self._nextSequence[patient] = deltas[-1][0] + 1 if deltas else 1
+    return saved
+
+  def changes(self, patient, items):
+    """Items that differ from the last save and names of saved items that are gone"""
+    saved = self._baseline(patient)
+    changed = dict((name, value) for name, value in items.items()
+                   if name not in saved or not itemsEqual(saved[name], value))
+    removed = [name for name in saved if name not in items]
+    return changed, removed
+
+  def save(self, patient, items):
+    """Queue a delta with the items that changed since the last save. Returns a future that resolves to the
+    path of the delta file, or None if nothing changed.
+    """
+    changed, removed = self.changes(patient, items)
+    if not changed and not removed:
+      return None
+    # copies, so that the caller may keep updating its arrays while the writer runs
+    changed = dict((name, np.array(value)) for name, value in changed.items())
+    saved = self._saved[patient]
+    for name in removed:
+      del saved[name]
+    saved.update(changed)
+    sequence = self._nextSequence[patient]
+    self._nextSequence[patient] = sequence + 1
+    path = os.path.join(self.patientDirectory(patient), 'delta_{0:06d}.npz'.format(sequence))
+    future = self._executor.submit(self._writeDelta, patient, path, changed, removed)
+    with self._lock:
+      self._pending = [pending for pending in self._pending if not pending.done()] + [future]
+    return future
+
+  def _writeDelta(self, patient, path, changed, removed):
+    try:
+      directory = os.path.dirname(path)
+      if not os.path.exists(directory):
+        os.makedirs(directory)
+      _writeItems(path, changed, removed)
+    except Exception:
+      # marked before the future completes, so that a save right after a failed write already sees it
+      with self._lock:
+        self._stale.add(patient)
+      raise
+    return path
+
+  def wait(self, raiseErrors=True):
+    """Block until the queued deltas are written. Raises the error of a failed write unless raiseErrors is
+    False.
+    """
+    with self._lock:
+      pending, self._pending = self._pending, []
+    concurrent.futures.wait(pending)
+    if raiseErrors:
+      for future in pending:
+        future.result()
+
+  def compact(self, patient):
+    """Fold the patient's deltas into the base file and delete them. Returns the merged items."""
+    items = self.load(patient)
+    deltas = self.deltaPaths(patient)
+    if deltas:
+      _writeItems(os.path.join(self.patientDirectory(patient), 'base.npz'), items)
+      for sequence, path in deltas:
+        os.remove(path)
+    return items
+
+  def clear(self, patient):
+    self.wait()
+    for sequence, path in self.deltaPaths(patient):
+      os.remove(path)
+    basePath = os.path.join(self.patientDirectory(patient), 'base.npz')
+    if os.path.exists(basePath):
+      os.remove(basePath)
+    self._saved.pop(patient, None)
+    with self._lock:
+      self._stale.discard(patient)
+
+  def shutdown(self):
+    self._executor.shutdown(wait=True)
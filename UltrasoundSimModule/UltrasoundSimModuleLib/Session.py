@@ -0,0 +1,153 @@
+import os
+import json
+import time
+import struct
+import numpy as np
+
+#
+# Session recording. Events go into a preallocated structured-array ring buffer (recording an event only writes
+# into existing rows) and are appended to a binary file when flushed. File layout:
+#
+#   magic (8 bytes) | format version (uint32) | header size (uint32) | JSON header | event records ...
+#
+# Records are the raw bytes of SESSION_EVENT_DTYPE rows, so a session that was cut short is still readable up to
+# the last complete record.
+#
+
+SESSION_MAGIC = b'USIMSESS'
+SESSION_FORMAT_VERSION = 1
+SESSION_PREAMBLE = struct.Struct('<8sII')
+SESSION_EXTENSION = '.ussession'
+
+# event types
+SESSION_PATIENT = 1
+SESSION_PROBE_STEP = 2
+SESSION_ZONE_SELECTED = 3
+SESSION_FIDUCIAL = 4
+SESSION_NEEDLE = 5
+
+SESSION_EVENT_DTYPE = np.dtype([
+  ('time', '<f8'),
+  ('type', 'u1'),
+  ('value', '<i4'),
+  ('pitchSteps', '<i2'),
+  ('yawSteps', '<i2'),
+  ('point', '<f8', (3,)),
+  # needle events: the core runs from point to point + vector
+  ('vector', '<f8', (3,)),
+  # top three rows, the last row is always 0 0 0 1
+  ('rotatedToProbeModel', '<f8', (3, 4)),
+  ('imageToProbe', '<f8', (3, 4)),
+])
+
+
+class SessionRecorder(object):
+  """Records timestamped events of one training session.
+
+  rotatedToProbeModel and imageToProbe are the pose engine's (4,4) arrays; they are updated in place by the
+  engine and copied into the event row whenever an event is recorded. Call flush() regularly (for example from
+  a timer), the buffer is also flushed when it fills up.
+  """
+
+  def __init__(self, path, rotatedToProbeModel, imageToProbe, capacity=4096, metadata=None):
+    self.path = path
+    self.capacity = capacity
+    self.recordedEvents = 0
+    self.flushedEvents = 0
+    self._buffer = np.zeros(capacity, dtype=SESSION_EVENT_DTYPE)
+    # field views and pose sources are created once so that record() does not create arrays
+    self._times = self._buffer['time']
+    self._types = self._buffer['type']
+    self._values = self._buffer['value']
+    self._pitchSteps = self._buffer['pitchSteps']
+    self._yawSteps = self._buffer['yawSteps']
+    self._points = self._buffer['point']
+    self._vectors = self._buffer['vector']
+    self._rotatedToProbeModel = self._buffer['rotatedToProbeModel']
+    self._imageToProbe = self._buffer['imageToProbe']
+    self._rotatedToProbeModelSource = rotatedToProbeModel[:3]
+    self._imageToProbeSource = imageToProbe[:3]
+    self._startTime = time.perf_counter()
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+      os.makedirs(directory)
+    header = dict(metadata or {})
+    header.update({'startTime': time.time(), 'dtype': SESSION_EVENT_DTYPE.descr})
+    headerBytes = json.dumps(header).encode()
+    self._file = open(path, 'wb')
+    self._file.write(SESSION_PREAMBLE.pack(SESSION_MAGIC, SESSION_FORMAT_VERSION, len(headerBytes)))
+    self._file.write(headerBytes)
+    self._file.flush()
+
+  @property
+  def closed(self):
+    return self._file is None
+
+  def record(self, eventType, value=0, pitchSteps=0, yawSteps=0, point=None, vector=None):
+    """Store one event with the current pose. point is an optional RAS position (fiducials, needle start) and
+    vector an optional RAS direction (needle start to end).
+    """
+    if self.recordedEvents - self.flushedEvents >= self.capacity:
+      self.flush()
+    row = self.recordedEvents % self.capacity
+    self._times[row] = time.perf_counter() - self._startTime
+    self._types[row] = eventType
+    self._values[row] = value
+    self._pitchSteps[row] = pitchSteps
+    self._yawSteps[row] = yawSteps
+    if point is None:
+      self._points[row] = 0.0
+    else:
+      self._points[row] = point
+    if vector is None:
+      self._vectors[row] = 0.0
+    else:
+      self._vectors[row] = vector
+    self._rotatedToProbeModel[row] = self._rotatedToProbeModelSource
+    self._imageToProbe[row] = self._imageToProbeSource
+    self.recordedEvents += 1
+
+  def flush(self):
+    """Append the events recorded since the last flush to the file"""
+    if self._file is None or self.flushedEvents == self.recordedEvents:
+      return
+    first = self.flushedEvents % self.capacity
+    count = self.recordedEvents - self.flushedEvents
+    if first + count <= self.capacity:
+      self._file.write(self._buffer[first:first + count].data)
+    else:
+      self._file.write(self._buffer[first:].data)
+      self._file.write(self._buffer[:first + count - self.capacity].data)
+    self._file.flush()
+    self.flushedEvents = self.recordedEvents
+
+  def close(self):
+    if self._file is None:
+      return
+    self.flush()
+    self._file.close()
+    self._file = None
+
+
+def loadSession(path):
+  """Return the header dictionary and the structured array of events of a recorded session"""
+  with open(path, 'rb') as f:
+    magic, version, headerSize = SESSION_PREAMBLE.unpack(f.read(SESSION_PREAMBLE.size))
+    if magic != SESSION_MAGIC:
+      raise ValueError(path + ' is not a session recording')
+    if version != SESSION_FORMAT_VERSION:
+      raise ValueError('Unsupported session version {0} in {1}'.format(version, path))
+    header = json.loads(f.read(headerSize).decode())
+    data = f.read()
+  # the header records the layout the file was written with
+  dtype = np.dtype([tuple(field) for field in header['dtype']])
+  events = np.frombuffer(data, dtype=dtype, count=len(data) // dtype.itemsize).copy()
+  return header, events
+
+
+def poseMatrix(rows):
+  """4x4 matrix from the three rows stored in an event"""
+  matrix = np.eye(4)
+  matrix[:3] = rows
+  return matrix
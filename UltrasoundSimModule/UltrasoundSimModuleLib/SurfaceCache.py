@@ -0,0 +1,95 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import vtk
+
+#
+# Persistent cache of zone closed surface meshes, keyed by the labelmap contents and the conversion parameters
+#
+
+class ZoneSurfaceCache(object):
+  """Stores one .vtp file per segment under <cacheDirectory>/<key>/. An index maps each source .seg.nrrd file to
+  its current key, so entries of a changed file are dropped when the file is rebuilt.
+  """
+
+  INDEX_FILENAME = 'index.json'
+
+  def __init__(self, cacheDirectory):
+    self.cacheDirectory = cacheDirectory
+
+  def cacheKey(self, contentHash, conversionParameters):
+    key = hashlib.sha256()
+    key.update(contentHash.encode())
+    key.update(conversionParameters.encode())
+    return key.hexdigest()
+
+  def _indexPath(self):
+    return os.path.join(self.cacheDirectory, self.INDEX_FILENAME)
+
+  def _readIndex(self):
+    try:
+      with open(self._indexPath()) as f:
+        return json.load(f)
+    except (IOError, OSError, ValueError):
+      return {}
+
+  def _writeIndex(self, index):
+    temporaryPath = self._indexPath() + '.tmp'
+    with open(temporaryPath, 'w') as f:
+      json.dump(index, f, indent=1)
+    os.replace(temporaryPath, self._indexPath())
+
+  def load(self, sourcePath, key):
+    """Return the cached surfaces for the key as a list of vtkPolyData, or None on a cache miss"""
+    entryDirectory = os.path.join(self.cacheDirectory, key)
+    manifestPath = os.path.join(entryDirectory, 'segments.json')
+    if not os.path.exists(manifestPath):
+      return None
+    try:
+      with open(manifestPath) as f:
+        filenames = json.load(f)['segments']
+      surfaces = []
+      for filename in filenames:
+        reader = vtk.vtkXMLPolyDataReader()
+        reader.SetFileName(os.path.join(entryDirectory, filename))
+        reader.Update()
+        polyData = vtk.vtkPolyData()
+        polyData.DeepCopy(reader.GetOutput())
+        surfaces.append(polyData)
+    except (IOError, OSError, ValueError, KeyError) as e:
+      logging.warning('Discarding unreadable surface cache entry {0}: {1}'.format(key, e))
+      shutil.rmtree(entryDirectory, ignore_errors=True)
+      return None
+    return surfaces
+
+  def store(self, sourcePath, key, surfaces):
+    """Write the surfaces of all segments and replace the previous entry of the source file"""
+    entryDirectory = os.path.join(self.cacheDirectory, key)
+    temporaryDirectory = entryDirectory + '.tmp'
+    shutil.rmtree(temporaryDirectory, ignore_errors=True)
+    os.makedirs(temporaryDirectory)
+
+    filenames = []
+    for index, polyData in enumerate(surfaces):
+      filename = 'segment{0}.vtp'.format(index)
+      writer = vtk.vtkXMLPolyDataWriter()
+      writer.SetFileName(os.path.join(temporaryDirectory, filename))
+      writer.SetInputData(polyData)
+      writer.SetDataModeToAppended()
+      writer.Write()
+      filenames.append(filename)
+    with open(os.path.join(temporaryDirectory, 'segments.json'), 'w') as f:
+      json.dump({'source': sourcePath, 'segments': filenames}, f)
+
+    shutil.rmtree(entryDirectory, ignore_errors=True)
+    os.replace(temporaryDirectory, entryDirectory)
+
+    # drop the entry built from an older version of the same file
+    index = self._readIndex()
+    previousKey = index.get(sourcePath)
+    if previousKey and previousKey != key and previousKey not in [k for s, k in index.items() if s != sourcePath]:
+      shutil.rmtree(os.path.join(self.cacheDirectory, previousKey), ignore_errors=True)
+    index[sourcePath] = key
+    self._writeIndex(index)
@@ -0,0 +1,216 @@
+import os
+import numpy as np
+
+from .Sampling import trilinearSample
+from .Reslice import slicePixelPoints
+from .ZoneIndex import canonicalZoneName
+
+#
+# Synthetic TRUS image stage. A frame is the TRUS reslice blended with a tissue model driven by the zone labels:
+#
+#   image = ((1 - blend) * reslice + blend * level[tissue]) * speckle[tissue] * gain
+#
+# level is the tissue's echogenicity times the patient's median TRUS intensity, speckle comes from precomputed
+# periodic tiles (one per tissue) and gain is the round trip attenuation in excess of the time gain compensation,
+# accumulated along depth, so that strongly attenuating tissue casts a shadow. All per-tissue values are lookup
+# tables and the pixel grid and tile indices are computed once, so a frame is two volume lookups, a few table
+# lookups, one cumulative sum and the blend.
+#
+# The sagittal TRUS image comes from the linear array, so depth runs straight along the slice y axis.
+#
+
+# relative echogenicity, attenuation in dB/cm at the imaging frequency
+TISSUE_PROPERTIES = [
+  ('background', 1.0, 3.0),
+  ('PZ', 1.15, 3.5),
+  ('TZ', 0.75, 4.0),
+  ('CZ', 0.85, 4.0),
+  ('AFS', 0.5, 6.0),
+  ('U', 0.3, 15.0),
+]
+
+
+def speckleTiles(numberOfTiles, tileSize=(128, 128), correlation=(1.0, 2.5), seed=0):
+  """Fully developed speckle: the magnitude of complex Gaussian noise filtered with an anisotropic Gaussian
+  point spread function (axial and lateral correlation length in pixels). Filtering is done in the Fourier
+  domain, so the tiles are periodic and repeat without seams. Returns (numberOfTiles, rows, columns) float32
+  with mean 1.
+  """
+  rows, columns = tileSize
+  random = np.random.RandomState(seed)
+  noise = random.standard_normal((numberOfTiles, rows, columns)) + 1j * random.standard_normal(
+    (numberOfTiles, rows, columns))
+  fy = np.fft.fftfreq(rows)[:, np.newaxis]
+  fx = np.fft.fftfreq(columns)[np.newaxis, :]
+  transfer = np.exp(-2.0 * np.pi ** 2 * ((fy * correlation[0]) ** 2 + (fx * correlation[1]) ** 2))
+  tiles = np.abs(np.fft.ifft2(np.fft.fft2(noise) * transfer))
+  tiles /= tiles.mean(axis=(1, 2), keepdims=True)
+  return tiles.astype(np.float32)
+
+
+class SpeckleTileCache(object):
+  """Speckle tiles kept in memory and in .npy files, generated once per parameter set"""
+
+  def __init__(self, cacheDirectory):
+    self.cacheDirectory = cacheDirectory
+    self._tiles = {}
+
+  def cachePath(self, numberOfTiles, tileSize, correlation, seed):
+    return os.path.join(self.cacheDirectory, 'speckle_{0}_{1}x{2}_{3:g}x{4:g}_{5}.npy'.format(
+      numberOfTiles, tileSize[0], tileSize[1], correlation[0], correlation[1], seed))
+
+  def tiles(self, numberOfTiles, tileSize=(128, 128), correlation=(1.0, 2.5), seed=0):
+    key = (numberOfTiles, tuple(tileSize), tuple(correlation), seed)
+    if key in self._tiles:
+      return self._tiles[key]
+    path = self.cachePath(numberOfTiles, tileSize, correlation, seed)
+    tiles = None
+    if os.path.exists(path):
+      try:
+        tiles = np.load(path)
+      except (IOError, OSError, ValueError):
+        tiles = None
+    if tiles is None or tiles.shape != (numberOfTiles,) + tuple(tileSize):
+      tiles = speckleTiles(numberOfTiles, tileSize, correlation, seed)
+      try:
+        if not os.path.exists(self.cacheDirectory):
+          os.makedirs(self.cacheDirectory)
+        np.save(path + '.tmp.npy', tiles)
+        os.replace(path + '.tmp.npy', path)
+      except (IOError, OSError):
+        pass
+    self._tiles[key] = tiles
+    return tiles
+
+
+class TissueMap(object):
+  """Tissue class of each zone label voxel (index into the tissue properties) and the patient's reference
+  intensity. Built once per patient from its ZoneIndex and TRUS voxels.
+  """
+
+  def __init__(self, tissue, rasToIjk, referenceLevel):
+    # a background border lets lookup() clip instead of masking points outside of the volume
+    self.padded = np.pad(np.asarray(tissue, dtype=np.uint8), 1)
+    self.shape = np.asarray(tissue).shape
+    self.rasToIjk = np.asarray(rasToIjk, dtype=float)
+    self.referenceLevel = float(referenceLevel)
+    self._flat = self.padded.reshape(-1)
+    self._strides = (1, self.padded.shape[2], self.padded.shape[1] * self.padded.shape[2])
+
+  @property
+  def tissue(self):
+    return self.padded[1:-1, 1:-1, 1:-1]
+
+  def lookup(self, ijk):
+    """Tissue class of the nearest voxel for (..., 3) float32 ijk points, background outside"""
+    index = np.zeros(ijk.shape[:-1], dtype=np.intp)
+    for axis, size in enumerate(self.padded.shape[::-1]):
+      # + 1 for the border, + 0.5 so that truncation rounds
+      coordinate = ijk[..., axis] + np.float32(1.5)
+      np.clip(coordinate, 0, size - 1, out=coordinate)
+      index += coordinate.astype(np.intp) * self._strides[axis]
+    return self._flat[index]
+
+  @classmethod
+  def fromZoneIndex(cls, zoneIndex, trusVoxels, properties=TISSUE_PROPERTIES):
+    tissueNames = [name for name, echogenicity, attenuation in properties]
+    lookup = np.zeros(max(max(zoneIndex.labelNames), int(zoneIndex.labels.max())) + 1, dtype=np.uint8)
+    for label, name in zoneIndex.labelNames.items():
+      name = canonicalZoneName(name)
+      if name in tissueNames:
+        lookup[label] = tissueNames.index(name)
+    labels = np.clip(zoneIndex.labels, 0, len(lookup) - 1).astype(np.intp)
+    # a strided subsample is plenty for the median
+    sample = np.asarray(trusVoxels)[::4, ::4, ::4]
+    sample = sample[sample > 0]
+    referenceLevel = np.median(sample) if sample.size else 1.0
+    return cls(lookup[labels], zoneIndex.rasToIjk, referenceLevel)
+
+
+class SyntheticUltrasound(object):
+  """Renders synthetic TRUS frames on a fixed slice grid (outputSize is (columns, rows), outputSpacing in mm).
+
+  blend is the weight of the tissue model against the reslice, speckleContrast scales the speckle around its
+  mean and compensation is the fraction of the background attenuation undone by time gain compensation.
+  transducerAtTop puts the transducer at the first row (smallest slice y).
+  """
+
+  def __init__(self, outputSize, outputSpacing, tiles, properties=TISSUE_PROPERTIES, blend=0.5,
+               speckleContrast=0.8, compensation=1.0, transducerAtTop=True):
+    self.outputSize = tuple(outputSize)
+    self.outputSpacing = tuple(outputSpacing)
+    self.properties = properties
+    self.transducerAtTop = transducerAtTop
+    columns, rows = self.outputSize
+    pixels = slicePixelPoints(self.outputSize, self.outputSpacing)
+    self._x = pixels[..., 0].astype(np.float32)
+    self._y = pixels[..., 1].astype(np.float32)
+    self._ijk = np.empty((rows, columns, 3), dtype=np.float32)
+
+    # speckle lookup: tile of the tissue, then the pixel's position in the tile
+    numberOfTiles, tileRows, tileColumns = tiles.shape
+    if numberOfTiles < len(properties):
+      raise ValueError('Need one speckle tile per tissue, got {0} for {1}'.format(numberOfTiles, len(properties)))
+    self._tiles = (1.0 + speckleContrast * (tiles[:len(properties)] - 1.0)).astype(np.float32).reshape(-1)
+    self._tileArea = tileRows * tileColumns
+    self._tileIndex = ((np.arange(rows) % tileRows)[:, np.newaxis] * tileColumns
+                       + (np.arange(columns) % tileColumns)[np.newaxis, :]).astype(np.intp)
+
+    echogenicity = np.array([value for name, value, attenuation in properties], dtype=np.float32)
+    attenuation = np.array([value for name, echo, value in properties], dtype=np.float32) / 10.0
+    # log of the round trip gain per pixel step in depth, relative to the compensated background
+    excess = attenuation - compensation * attenuation[0]
+    self._logGainStep = (-2.0 * excess * self.outputSpacing[1] * np.log(10.0) / 20.0).astype(np.float32)
+    self._echogenicity = echogenicity
+    self.blend = float(blend)
+    self._levels = None
+    self._gain = np.empty((rows, columns), dtype=np.float32)
+    self.setPatient(None, None, None)
+
+  def setPatient(self, trusVoxels, trusRasToIjk, tissueMap):
+    """Volumes of the patient to render from. trusVoxels may be None (tissue model only)."""
+    self.trusVoxels = trusVoxels
+    self.trusRasToIjk = None if trusRasToIjk is None else np.asarray(trusRasToIjk, dtype=float)
+    self.tissueMap = tissueMap
+    referenceLevel = tissueMap.referenceLevel if tissueMap is not None else 1.0
+    self._levels = (self._echogenicity * referenceLevel).astype(np.float32)
+
+  def _slicePoints(self, matrix):
+    """Fill the ijk buffer with the pixel positions for a slice to ijk matrix (the plane has z = 0)"""
+    for axis in range(3):
+      np.multiply(self._x, matrix[axis, 0], out=self._ijk[..., axis])
+      self._ijk[..., axis] += self._y * matrix[axis, 1]
+      self._ijk[..., axis] += matrix[axis, 3]
+    return self._ijk
+
+  def tissueClasses(self, sliceToRas):
+    """(rows, columns) tissue index of each pixel, background where there are no labels"""
+    if self.tissueMap is None:
+      return np.zeros(self._gain.shape, dtype=np.uint8)
+    return self.tissueMap.lookup(self._slicePoints(np.matmul(self.tissueMap.rasToIjk, sliceToRas)))
+
+  def render(self, sliceToRas, out=None):
+    """One (rows, columns) float32 frame for a 4x4 SliceToRAS matrix"""
+    sliceToRas = np.asarray(sliceToRas, dtype=float)
+    tissue = self.tissueClasses(sliceToRas).astype(np.intp)
+    if out is None:
+      out = np.empty(self._gain.shape, dtype=np.float32)
+
+    # blend the reslice with the tissue levels
+    np.take(self._levels, tissue, out=out)
+    if self.trusVoxels is not None and self.blend < 1.0:
+      reslice = trilinearSample(self.trusVoxels, self._slicePoints(np.matmul(self.trusRasToIjk, sliceToRas)))
+      out *= self.blend
+      out += (1.0 - self.blend) * reslice
+
+    # depth dependent attenuation, accumulated away from the transducer
+    np.take(self._logGainStep, tissue, out=self._gain)
+    if self.transducerAtTop:
+      np.cumsum(self._gain, axis=0, out=self._gain)
+    else:
+      self._gain[::-1] = np.cumsum(self._gain[::-1], axis=0)
+    np.exp(self._gain, out=self._gain)
+    out *= self._gain
+
+    out *= np.take(self._tiles, tissue * self._tileArea + self._tileIndex)
+    return out
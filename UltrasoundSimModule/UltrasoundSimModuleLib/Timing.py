@@ -0,0 +1,159 @@
+import csv
+import json
+import math
+import time
+import numpy as np
+
+#
+# Switchable timing probes. Each stage keeps a fixed log-scale histogram (10 bins per decade from 1 us to 100 s)
+# plus count, total, minimum and maximum, so recording a sample never grows memory. When disabled, stage()
+# returns a shared no-op context and record() returns immediately.
+#
+
+HISTOGRAM_MINIMUM_EXPONENT = -6
+HISTOGRAM_BINS_PER_DECADE = 10
+HISTOGRAM_BINS = 8 * HISTOGRAM_BINS_PER_DECADE
+HISTOGRAM_EDGES = 10.0 ** (HISTOGRAM_MINIMUM_EXPONENT + np.arange(HISTOGRAM_BINS + 1) / float(HISTOGRAM_BINS_PER_DECADE))
+
+
+class StageStatistics(object):
+  """Histogram and running statistics of one stage, in seconds"""
+
+  def __init__(self):
+    self.counts = np.zeros(HISTOGRAM_BINS, dtype=np.int64)
+    self.count = 0
+    self.total = 0.0
+    self.minimum = math.inf
+    self.maximum = 0.0
+
+  def add(self, seconds):
+    if seconds > 0.0:
+      index = int((math.log10(seconds) - HISTOGRAM_MINIMUM_EXPONENT) * HISTOGRAM_BINS_PER_DECADE)
+    else:
+      index = 0
+    self.counts[min(max(index, 0), HISTOGRAM_BINS - 1)] += 1
+    self.count += 1
+    self.total += seconds
+    self.minimum = min(self.minimum, seconds)
+    self.maximum = max(self.maximum, seconds)
+
+  def percentile(self, fraction):
+    """Upper edge of the histogram bin holding the given fraction of the samples"""
+    if self.count == 0:
+      return None
+    index = int(np.searchsorted(np.cumsum(self.counts), fraction * self.count))
+    return min(float(HISTOGRAM_EDGES[min(index, HISTOGRAM_BINS - 1) + 1]), self.maximum)
+
+  def summary(self):
+    if self.count == 0:
+      return {'count': 0}
+    milliseconds = lambda seconds: seconds * 1000.0
+    return {
+      'count': self.count,
+      'totalMs': milliseconds(self.total),
+      'meanMs': milliseconds(self.total / self.count),
+      'minimumMs': milliseconds(self.minimum),
+      'maximumMs': milliseconds(self.maximum),
+      'p50Ms': milliseconds(self.percentile(0.5)),
+      'p95Ms': milliseconds(self.percentile(0.95)),
+      'p99Ms': milliseconds(self.percentile(0.99)),
+    }
+
+
+class _NoStage(object):
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    return False
+
+
+class _Stage(object):
+  """Reusable timing context of one stage; nesting the same stage is supported"""
+
+  def __init__(self, probes, name):
+    self.probes = probes
+    self.name = name
+    self.startTimes = []
+
+  def __enter__(self):
+    self.startTimes.append(time.perf_counter())
+    return self
+
+  def __exit__(self, *args):
+    self.probes.record(self.name, time.perf_counter() - self.startTimes.pop())
+    return False
+
+
+class TimingProbes(object):
+  """Per-stage latency histograms. Wrap code in `with probes.stage('name'):` or call record() directly."""
+
+  def __init__(self, enabled=False):
+    self.enabled = enabled
+    self.stages = {}
+    self._contexts = {}
+    self._noStage = _NoStage()
+
+  def setEnabled(self, enabled):
+    self.enabled = enabled
+
+  def reset(self):
+    self.stages = {}
+
+  def stage(self, name):
+    if not self.enabled:
+      return self._noStage
+    context = self._contexts.get(name)
+    if context is None:
+      context = self._contexts[name] = _Stage(self, name)
+    return context
+
+  def record(self, name, seconds):
+    if not self.enabled:
+      return
+    statistics = self.stages.get(name)
+    if statistics is None:
+      statistics = self.stages[name] = StageStatistics()
+    statistics.add(seconds)
+
+  def summary(self):
+    return dict((name, statistics.summary()) for name, statistics in sorted(self.stages.items()))
+
+  def exportJson(self, path, includeHistograms=True):
+    """Write the summary, and optionally the histogram counts with their bin edges in ms, as JSON"""
+    data = {'stages': self.summary()}
+    if includeHistograms:
+      data['histogramEdgesMs'] = (HISTOGRAM_EDGES * 1000.0).tolist()
+      for name, statistics in self.stages.items():
+        data['stages'][name]['histogram'] = statistics.counts.tolist()
+    with open(path, 'w') as f:
+      json.dump(data, f, indent=1)
+
+  def exportCsv(self, path):
+    """One row per stage with the summary statistics"""
+    fields = ['stage', 'count', 'totalMs', 'meanMs', 'minimumMs', 'maximumMs', 'p50Ms', 'p95Ms', 'p99Ms']
+    with open(path, 'w', newline='') as f:
+      writer = csv.DictWriter(f, fields, restval='')
+      writer.writeheader()
+      for name, summary in self.summary().items():
+        row = dict(summary)
+        row['stage'] = name
+        writer.writerow(row)
+
+
+def compareToBaseline(summary, baseline, tolerance=1.5, statistic='meanMs', minimumMs=1.0):
+  """Stages of a summary whose statistic exceeds tolerance times the baseline value. Stages faster than
+  minimumMs in the baseline are ignored since they are dominated by timer noise. Returns
+  [(stage, value, baseline value)].
+  """
+  regressions = []
+  for name, reference in baseline.items():
+    current = summary.get(name, {})
+    if statistic not in reference or statistic not in current:
+      continue
+    if reference[statistic] < minimumMs:
+      continue
+    if current[statistic] > tolerance * reference[statistic]:
+      regressions.append((name, current[statistic], reference[statistic]))
+  return regressions
@@ -0,0 +1,271 @@
+import time
+import socket
+import struct
+import logging
+import threading
+import numpy as np
+
+#
+# Minimal OpenIGTLink TRANSFORM client and a replay server that stands in for PlusServer. The client reads on a
+# background thread and only keeps the newest sample of each device; the display side takes at most one sample
+# per frame, so stale frames are dropped instead of queueing up behind the probe.
+#
+
+IGTL_HEADER = struct.Struct('>H12s20sQQQ')
+IGTL_EXTENDED_HEADER = struct.Struct('>HHII')
+IGTL_TRANSFORM = struct.Struct('>12f')
+DEFAULT_PORT = 18944
+
+
+def encodeTimestamp(seconds):
+  whole = int(seconds)
+  return (whole << 32) | int((seconds - whole) * 2 ** 32)
+
+
+def decodeTimestamp(timestamp):
+  return (timestamp >> 32) + (timestamp & 0xFFFFFFFF) / 2.0 ** 32
+
+
+def encodeTransformMessage(deviceName, matrix, timestamp=None):
+  """Version 1 TRANSFORM message. The CRC field is left 0, receivers here do not check it."""
+  matrix = np.asarray(matrix, dtype=float)
+  # rotation columns first, then the translation
+  body = IGTL_TRANSFORM.pack(*(list(matrix[:3, :3].T.ravel()) + list(matrix[:3, 3])))
+  timestamp = time.time() if timestamp is None else timestamp
+  header = IGTL_HEADER.pack(1, b'TRANSFORM', deviceName.encode()[:20], encodeTimestamp(timestamp), len(body), 0)
+  return header + body
+
+
+def decodeTransformBody(version, body):
+  if version >= 2:
+    extendedHeaderSize, metadataHeaderSize, metadataSize, messageId = IGTL_EXTENDED_HEADER.unpack_from(body)
+    body = body[extendedHeaderSize:len(body) - metadataHeaderSize - metadataSize]
+  values = IGTL_TRANSFORM.unpack_from(body)
+  matrix = np.eye(4)
+  matrix[:3, :3] = np.reshape(values[:9], (3, 3)).T
+  matrix[:3, 3] = values[9:]
+  return matrix
+
+
+class TrackerSample(object):
+  """Newest transform of one device with the sender timestamp and the local receive time"""
+
+  def __init__(self, matrix, timestamp, receiveTime, sequence):
+    self.matrix = matrix
+    self.timestamp = timestamp
+    self.receiveTime = receiveTime
+    self.sequence = sequence
+
+
+class TrackerStatistics(object):
+  """Counters reported by the tracked probe input"""
+
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.receivedFrames = 0
+    self.appliedFrames = 0
+    self.droppedFrames = 0
+    self.staleFrames = 0
+    self.latencies = []
+
+  def addLatency(self, latency, maximumCount=1000):
+    self.latencies.append(latency)
+    if len(self.latencies) > maximumCount:
+      del self.latencies[:-maximumCount]
+
+  def summary(self):
+    latencies = np.asarray(self.latencies) * 1000.0
+    return {
+      'receivedFrames': self.receivedFrames,
+      'appliedFrames': self.appliedFrames,
+      'droppedFrames': self.droppedFrames,
+      'staleFrames': self.staleFrames,
+      'meanLatencyMs': float(latencies.mean()) if len(latencies) else None,
+      'maximumLatencyMs': float(latencies.max()) if len(latencies) else None,
+    }
+
+
+class IgtlTransformClient(object):
+  """Receives TRANSFORM messages on a background thread.
+
+  Only the newest sample per device is kept. takeLatest() returns it once; samples that were replaced before
+  being taken count as dropped frames, and samples older than maximumAge seconds count as stale.
+  """
+
+  def __init__(self, host='localhost', port=DEFAULT_PORT, maximumAge=0.2):
+    self.host = host
+    self.port = port
+    self.maximumAge = maximumAge
+    self.statistics = TrackerStatistics()
+    self.recording = None
+    self._latest = {}
+    self._taken = {}
+    self._lock = threading.Lock()
+    self._socket = None
+    self._thread = None
+    self._running = False
+
+  @property
+  def connected(self):
+    return self._socket is not None
+
+  def start(self, timeout=2.0):
+    self._socket = socket.create_connection((self.host, self.port), timeout=timeout)
+    self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self._socket.settimeout(0.2)
+    self._running = True
+    self._thread = threading.Thread(target=self._receiveLoop, name='IgtlTransformClient')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    self._running = False
+    if self._thread is not None:
+      self._thread.join(1.0)
+      self._thread = None
+    if self._socket is not None:
+      self._socket.close()
+      self._socket = None
+
+  def startRecording(self):
+    self.recording = []
+
+  def stopRecording(self):
+    recording, self.recording = self.recording, None
+    return recording
+
+  def _receiveExactly(self, size):
+    data = bytearray()
+    while len(data) < size:
+      try:
+        chunk = self._socket.recv(size - len(data))
+      except socket.timeout:
+        if not self._running:
+          return None
+        continue
+      if not chunk:
+        return None
+      data.extend(chunk)
+    return bytes(data)
+
+  def _receiveLoop(self):
+    sequence = 0
+    while self._running:
+      header = self._receiveExactly(IGTL_HEADER.size)
+      if header is None:
+        break
+      version, messageType, deviceName, timestamp, bodySize, crc = IGTL_HEADER.unpack(header)
+      body = self._receiveExactly(bodySize)
+      if body is None:
+        break
+      if messageType.rstrip(b'\0') != b'TRANSFORM':
+        continue
+      receiveTime = time.time()
+      deviceName = deviceName.rstrip(b'\0').decode()
+      try:
+        matrix = decodeTransformBody(version, body)
+      except struct.error:
+        logging.warning('Malformed TRANSFORM message from ' + deviceName)
+        continue
+      sequence += 1
+      sample = TrackerSample(matrix, decodeTimestamp(timestamp), receiveTime, sequence)
+      with self._lock:
+        previous = self._latest.get(deviceName)
+        if previous is not None and previous.sequence != self._taken.get(deviceName):
+          self.statistics.droppedFrames += 1
+        self._latest[deviceName] = sample
+        self.statistics.receivedFrames += 1
+        if self.recording is not None:
+          self.recording.append((receiveTime, deviceName, matrix))
+    self._running = False
+
+  def takeLatest(self, deviceName):
+    """Newest sample of the device that has not been taken yet, or None"""
+    with self._lock:
+      sample = self._latest.get(deviceName)
+      if sample is None or sample.sequence == self._taken.get(deviceName):
+        return None
+      self._taken[deviceName] = sample.sequence
+    if time.time() - sample.receiveTime > self.maximumAge:
+      self.statistics.staleFrames += 1
+      return None
+    return sample
+
+
+def saveRecording(path, recording):
+  """Store samples as returned by IgtlTransformClient.stopRecording() in a .npz file"""
+  times = np.array([sample[0] for sample in recording])
+  np.savez(path, times=times - (times[0] if len(times) else 0.0),
+           devices=np.array([sample[1] for sample in recording]),
+           matrices=np.array([sample[2] for sample in recording]).reshape(-1, 4, 4))
+
+
+def loadRecording(path):
+  recording = np.load(path)
+  return recording['times'], recording['devices'], recording['matrices']
+
+
+class IgtlReplayServer(object):
+  """Stand-in for PlusServer that replays a recorded marker stream to every connected client.
+  times are seconds from the start of the recording; messages are stamped with the current time when sent.
+  """
+
+  def __init__(self, times, devices, matrices, port=0, speed=1.0, loop=False):
+    self.times = np.asarray(times, dtype=float)
+    self.devices = list(devices)
+    self.matrices = np.asarray(matrices, dtype=float)
+    self.speed = speed
+    self.loop = loop
+    self.sentMessages = 0
+    self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self._server.bind(('localhost', port))
+    self._server.listen(1)
+    self.port = self._server.getsockname()[1]
+    self._running = False
+    self._thread = None
+    self.finished = threading.Event()
+
+  @classmethod
+  def fromFile(cls, path, **kwargs):
+    times, devices, matrices = loadRecording(path)
+    return cls(times, devices, matrices, **kwargs)
+
+  def start(self):
+    self._running = True
+    self._thread = threading.Thread(target=self._serve, name='IgtlReplayServer')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def stop(self):
+    self._running = False
+    self._server.close()
+    if self._thread is not None:
+      self._thread.join(1.0)
+
+  def _serve(self):
+    try:
+      connection, address = self._server.accept()
+    except OSError:
+      return
+    connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    try:
+      while self._running:
+        startTime = time.time()
+        for index in range(len(self.times)):
+          if not self._running:
+            break
+          delay = startTime + self.times[index] / self.speed - time.time()
+          if delay > 0:
+            time.sleep(delay)
+          connection.sendall(encodeTransformMessage(self.devices[index], self.matrices[index]))
+          self.sentMessages += 1
+        if not self.loop:
+          break
+    except OSError:
+      pass
+    finally:
+      connection.close()
+      self.finished.set()
@@ -0,0 +1,96 @@
+import time
+import collections
+import qt, vtk, slicer
+
+#
+# Coalescing transform update scheduler. Input handlers only record the newest matrix for each transform node;
+# all pending matrices are written once per display frame, inside one render.
+#
+# The batch is made of nested per-node StartModify/EndModify calls: every matrix is written before the first
+# node ends its modification, so observers always see the complete new pose, and each node fires one Modified
+# event. A scene wide batch (vtkMRMLScene BatchProcessState) would fire a single event, but ending it makes the
+# views and displayable managers rebuild from the whole scene, which costs far more than the two transform
+# events of a probe step.
+#
+
+class TransformUpdateScheduler(object):
+  """Applies pending transform matrices at most maximumFrameRate times per second.
+
+  A pending matrix is a 4x4 numpy array (or anything vtkMatrix4x4.DeepCopy accepts once flattened) that is only
+  read at flush time, so callers can keep updating the same buffer in place and every request in between is
+  coalesced into a single write.
+  """
+
+  def __init__(self, maximumFrameRate=60.0, timingProbes=None):
+    self.maximumFrameRate = maximumFrameRate
+    # optional TimingProbes: flush duration and the time from the first coalesced request to its flush
+    self.timingProbes = timingProbes
+    self._firstRequestTime = None
+    self._pending = collections.OrderedDict()
+    self._matrices = {}
+    self._lastFlushTime = 0.0
+    self.flushCount = 0
+    self.coalescedCount = 0
+    # called without arguments after every flush, from the main thread
+    self.flushCallbacks = []
+    self._timer = qt.QTimer()
+    self._timer.setSingleShot(True)
+    self._timer.connect('timeout()', self.flush)
+
+  def setMaximumFrameRate(self, maximumFrameRate):
+    self.maximumFrameRate = max(1.0, float(maximumFrameRate))
+
+  def framePeriod(self):
+    return 1.0 / self.maximumFrameRate
+
+  def requestUpdate(self, transformNode, matrix):
+    """Schedule writing matrix to the node's transform to parent on the next frame"""
+    nodeID = transformNode.GetID()
+    if not self._pending:
+      self._firstRequestTime = time.perf_counter()
+    if nodeID in self._pending:
+      self.coalescedCount += 1
+    self._pending[nodeID] = matrix
+    if not self._timer.isActive():
+      delay = self._lastFlushTime + self.framePeriod() - time.perf_counter()
+      self._timer.start(max(0, int(delay * 1000.0)))
+
+  def hasPendingUpdates(self):
+    return len(self._pending) > 0
+
+  def cancel(self):
+    self._timer.stop()
+    self._pending.clear()
+
+  def flush(self):
+    """Write all pending matrices now. Each node fires a single Modified event, after all of them are written,
+    and views render once.
+    """
+    self._timer.stop()
+    if not self._pending:
+      return
+    pending = self._pending
+    self._pending = collections.OrderedDict()
+    self._lastFlushTime = time.perf_counter()
+
+    nodes = []
+    with slicer.util.RenderBlocker():
+      for nodeID, matrix in pending.items():
+        node = slicer.mrmlScene.GetNodeByID(nodeID)
+        if node is None:
+          continue
+        nodes.append((node, node.StartModify()))
+        vtkMatrix = self._matrices.get(nodeID)
+        if vtkMatrix is None:
+          vtkMatrix = self._matrices[nodeID] = vtk.vtkMatrix4x4()
+        vtkMatrix.DeepCopy(matrix.ravel())
+        node.SetMatrixTransformToParent(vtkMatrix)
+      for node, wasModified in reversed(nodes):
+        node.EndModify(wasModified)
+    self.flushCount += 1
+    if self.timingProbes is not None:
+      flushTime = time.perf_counter()
+      self.timingProbes.record('transformFlush', flushTime - self._lastFlushTime)
+      self.timingProbes.record('requestToFlush', flushTime - self._firstRequestTime)
+    for callback in self.flushCallbacks:
+      callback()
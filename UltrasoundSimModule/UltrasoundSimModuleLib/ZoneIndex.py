@@ -0,0 +1,115 @@
+import numpy as np
+
+from .Sampling import transformPoints, nearestSample, trilinearSample
+
+#
+# Precomputed point to zone lookup over the Zones labelmap. A query is one matrix multiply and one array
+# index per point, no VTK pipeline is involved.
+#
+
+# names used by the zone selector and the segment names used in the Zones.seg.nrrd files
+ZONE_SEGMENT_NAMES = {
+  "Peripheral": "PZ",
+  "Central": "CZ",
+  "Anterior": "AFS",
+  "Transitional": "TZ",
+}
+
+# long segment names used by some of the zone files
+ZONE_NAME_ALIASES = {
+  "peripheral": "PZ",
+  "central": "CZ",
+  "anterior": "AFS",
+  "transition": "TZ",
+  "transitional": "TZ",
+  "urethra": "U",
+}
+
+
+def canonicalZoneName(name):
+  """Short segment name ('PZ') for any of the names used in the zone files or the zone selector"""
+  return ZONE_NAME_ALIASES.get(name.strip().lower(), name)
+
+
+def distanceTransform(mask, spacing):
+  """Euclidean distance in mm from every voxel to the nearest voxel where mask is True"""
+  from scipy import ndimage
+  if not mask.any():
+    return np.full(mask.shape, np.inf, dtype=np.float32)
+  # spacing is in I, J, K order, the array in K, J, I
+  return ndimage.distance_transform_edt(~mask, sampling=tuple(spacing[::-1])).astype(np.float32)
+
+
+class ZoneIndex(object):
+  """Label array and RAS to IJK matrix of one patient's zone segmentation.
+
+  labelNames maps label values to segment names (for example {2: 'PZ'}), long names such as 'peripheral' are
+  shortened. Distance maps are optional since they need scipy, call computeDistanceMaps() before distanceToZone().
+  """
+
+  def __init__(self, labels, ijkToRas, labelNames):
+    self.labels = np.ascontiguousarray(labels)
+    self.ijkToRas = np.asarray(ijkToRas, dtype=float)
+    self.rasToIjk = np.linalg.inv(self.ijkToRas)
+    self.labelNames = dict((label, canonicalZoneName(name)) for label, name in labelNames.items())
+    self.labelValues = dict((name, label) for label, name in self.labelNames.items())
+    self.distanceMaps = {}
+
+  @classmethod
+  def fromNrrdVolume(cls, volume):
+    return cls(volume.labelVoxels(), volume.ijkToRas, volume.segmentNames())
+
+  @property
+  def spacing(self):
+    return np.linalg.norm(self.ijkToRas[:3, :3], axis=0)
+
+  def labelValue(self, zone):
+    """Label value of a zone given by segment name ('PZ') or selector name ('Peripheral')"""
+    return self.labelValues[canonicalZoneName(zone)]
+
+  def toIjk(self, points):
+    return transformPoints(self.rasToIjk, points)
+
+  def labelAt(self, points):
+    """Label value at each RAS point, 0 outside of the labelmap. points is (3,) or (N,3)."""
+    return nearestSample(self.labels, self.toIjk(points), 0)
+
+  def zoneAt(self, points):
+    """Segment name at each RAS point, None for background"""
+    labels = np.atleast_1d(self.labelAt(points))
+    names = [self.labelNames.get(int(label)) for label in labels]
+    return names if np.ndim(points) > 1 else names[0]
+
+  def isInZone(self, points, zone):
+    return self.labelAt(points) == self.labelValue(zone)
+
+  def computeDistanceMaps(self, labels=None):
+    """Distance from each voxel to the nearest voxel of each zone, in mm"""
+    spacing = self.spacing
+    for label in (labels if labels is not None else self.labelNames):
+      if label not in self.distanceMaps:
+        self.distanceMaps[label] = distanceTransform(self.labels == label, spacing)
+
+  def distanceToZone(self, points, zone):
+    """Distance in mm from each RAS point to the zone (0 inside). Linearly interpolated, so it is also defined
+    slightly outside of the labelmap; further out it is infinite.
+    """
+    label = self.labelValue(zone)
+    if label not in self.distanceMaps:
+      self.computeDistanceMaps([label])
+    distances = trilinearSample(self.distanceMaps[label], self.toIjk(points), np.inf)
+    # maps of empty zones are infinite everywhere and interpolate to nan
+    return np.nan_to_num(distances, nan=np.inf, posinf=np.inf)
+
+  def scorePlacements(self, points, zones):
+    """Check a batch of placements, each with its own target zone. Returns (inZone, distanceToZone) arrays."""
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    zones = np.asarray(zones)
+    labels = self.labelAt(points)
+    inZone = np.zeros(len(points), dtype=bool)
+    distances = np.zeros(len(points), dtype=np.float32)
+    for zone in np.unique(zones):
+      selected = zones == zone
+      inZone[selected] = labels[selected] == self.labelValue(zone)
+      distances[selected] = self.distanceToZone(points[selected], zone)
+    return inZone, distances
@@ -0,0 +1,29 @@
+from .NrrdIO import NrrdVolume, readNrrd, decodeNrrd
+from .SceneCache import PatientAssets, PatientSceneEntry, PatientSceneCache
+from .SurfaceCache import ZoneSurfaceCache
+from .ProbePose import ProbePoseEngine, rotationsAboutCenter
+from .Sampling import transformPoints, nearestSample, trilinearSample
+from .Parallel import SharedArray, createProcessPool, defaultNumberOfProcesses
+from .Reslice import sliceToRasMatrices, resliceStack
+from .ZoneIndex import ZONE_SEGMENT_NAMES, ZoneIndex, canonicalZoneName
+from .BoundingBoxes import SegmentBoundingBoxCache, orientedBoundingBox, boundingBoxToRas
+from .Pyramid import PYRAMID_FACTORS, buildPyramid, downsampleVolume
+from .AssetBundle import AssetBundle, writeAssetBundle, volumeDescription
+from .Coverage import PROTOCOLS, ProtocolScorer, DistanceMapCache, protocolRegions
+from .Needle import DEFAULT_THROW, NeedleResults, simulateNeedles, trajectoriesInSlicePlanes
+from .Session import (SESSION_EXTENSION, SESSION_PATIENT, SESSION_PROBE_STEP, SESSION_ZONE_SELECTED, SESSION_FIDUCIAL,
+                      SESSION_NEEDLE, SESSION_EVENT_DTYPE, SessionRecorder, loadSession, poseMatrix)
+from .Grading import GRADED_ZONES, gradeCohort, gradeSession
+from .Timing import TimingProbes, compareToBaseline
+from .Manifest import PatientManifest, hashFile
+from .SceneDeltas import SceneDeltaStore
+from .Synthetic import TISSUE_PROPERTIES, SpeckleTileCache, SyntheticUltrasound, TissueMap, speckleTiles
+from .LevelOfDetail import LOD_REDUCTIONS, LevelOfDetailController, MeshLevelCache, decimateLevels
+from .Constraints import ProbeConstraint, SignedDistanceField, signedDistance
+from .Tracking import DEFAULT_PORT, IgtlTransformClient, IgtlReplayServer, saveRecording, loadRecording
+
+# Qt is only available inside the Slicer application, not in the PythonSlicer worker processes
+try:
+  from .UpdateScheduler import TransformUpdateScheduler
+except ImportError:
+  pass